@@ -0,0 +1,74 @@
+''' Measures the startup cost of every xflow command.
+
+Every command only sets up the engine services it uses. This benchmark
+constructs the engine and the services of each command, counting the AWS
+clients that get created and the IAM role lookups. Remote calls are not
+made, the role lookup is replaced by a stub and the role cache is neither
+read nor written.
+
+    python benchmarks/startup.py [CONFIG] [-n RUNS]
+'''
+import os
+import sys
+import time
+import argparse
+from mock import patch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from xflow import core, aws
+
+
+# The engine services each command uses
+MODES = [
+    ('validate (-v)', []),
+    ('publish (-p)', ['kinesis', 'producer']),
+    ('publish lines (-p STREAM -)', ['kinesis', 'pipeline']),
+    ('track (-t)', ['cwlogs']),
+    ('plan (--plan)', ['awslambda']),
+    ('configure (-c)', ['awslambda', 'kinesis', 'cwlogs']),
+    ('server (-s)', ['awslambda', 'kinesis', 'cwlogs', 'pipeline'])
+]
+
+
+def run_mode(config_path, services):
+    clients = []
+    create_client = aws.boto3.client
+
+    def client(name, *args, **kwargs):
+        clients.append(name)
+        return create_client(name, *args, **kwargs)
+
+    with patch('xflow.aws.boto3.client', side_effect=client), \
+         patch('xflow.aws.IAM.get_or_create_role', return_value='arn:aws:iam::000000000000:role/xflow') as role_mock, \
+         patch('xflow.core.RoleCache.get', return_value=None), \
+         patch('xflow.core.RoleCache.put'):
+        started = time.time()
+        engine = core.Engine(config_path)
+        for name in services:
+            getattr(engine, name)
+        elapsed = time.time() - started
+        engine.close()
+    return elapsed, clients, role_mock.call_count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measures the startup cost of every xflow command.')
+    parser.add_argument('CONFIG', nargs='?',
+                        default=os.path.join(os.path.dirname(__file__), '..', 'examples', 'wordcount', 'wordcount.yaml'))
+    parser.add_argument('-n', type=int, default=5, help='Number of runs per command')
+    args = parser.parse_args()
+    os.environ.setdefault('REGION', 'eu-west-1')
+
+    print '%-30s %10s %8s %6s  %s' % ('command', 'ms', 'clients', 'iam', 'services')
+    for mode, services in MODES:
+        timings = []
+        for _ in range(args.n):
+            elapsed, clients, role_lookups = run_mode(args.CONFIG, services)
+            timings.append(elapsed)
+        print '%-30s %10.1f %8s %6s  %s' % (mode, 1000 * min(timings), len(clients), role_lookups,
+                                            ', '.join(clients) or '-')
+
+
+if __name__ == '__main__':
+    main()
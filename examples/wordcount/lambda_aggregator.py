@@ -1,6 +1,6 @@
 import json
 import boto3
-import base64
+import envelope
 
 
 OUTBOUND_EVENT = 'FileAggregated'
@@ -9,9 +9,8 @@ OUTBOUND_EVENT = 'FileAggregated'
 def aggregate(event, context):
     kinesis = boto3.client('kinesis')
     print("Received event: " + json.dumps(event, indent=4))
-    for record in event['Records']:
-        # Kinesis data is base64 encoded so decode here
-        payload = base64.b64decode(record['kinesis']['data'])
+    # Records can be aggregated or compressed, envelope unpacks them
+    for payload in envelope.decode_records(event):
         print("Decoded payload: " + payload)
 
         try:
@@ -1,6 +1,6 @@
 import json
 import boto3
-import base64
+import envelope
 
 
 OUTBOUND_EVENT = 'FileFiltered'
@@ -26,9 +26,8 @@ def is_word(word):
 def filter_out_non_words(event, context):
     kinesis = boto3.client('kinesis')
     print("Received event: " + json.dumps(event, indent=4))
-    for record in event['Records']:
-        # Kinesis data is base64 encoded so decode here
-        payload = base64.b64decode(record['kinesis']['data'])
+    # Records can be aggregated or compressed, envelope unpacks them
+    for payload in envelope.decode_records(event):
         print("Decoded payload: " + payload)
 
         try:
@@ -50,7 +49,10 @@ def filter_out_non_words(event, context):
                 'execution_id': execution_id,
                 'words_filtered': words_filtered
             })
-            kinesis.put_record(StreamName=OUTBOUND_EVENT, Data=data, PartitionKey=data)
+            # Word lists are large, so they are compressed like xFlow does for
+            # streams with `compression` set
+            kinesis.put_record(StreamName=OUTBOUND_EVENT, Data=envelope.compress(data),
+                               PartitionKey=execution_id)
         except Exception as ex:
             print "Error processing record, error=%s" % str(object=ex)
 
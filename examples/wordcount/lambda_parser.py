@@ -1,6 +1,6 @@
-import base64
 import boto3
 import json
+import envelope
 
 OUTBOUND_EVENT = 'FileParsed'
 
@@ -8,9 +8,8 @@ OUTBOUND_EVENT = 'FileParsed'
 def parse(event, context):
     kinesis = boto3.client('kinesis')
     print("Received event: " + json.dumps(event, indent=4))
-    for record in event['Records']:
-        # Kinesis data is base64 encoded so decode here
-        payload = base64.b64decode(record['kinesis']['data'])
+    # Records can be aggregated or compressed, envelope unpacks them
+    for payload in envelope.decode_records(event):
         print("Decoded payload: " + payload)
 
         payload = json.loads(payload)
@@ -23,7 +22,10 @@ def parse(event, context):
                 'execution_id': execution_id,
                 'words_arr': words_arr
             })
-            kinesis.put_record(StreamName=OUTBOUND_EVENT, Data=data, PartitionKey=data)
+            # Word lists are large, so they are compressed like xFlow does for
+            # streams with `compression` set
+            kinesis.put_record(StreamName=OUTBOUND_EVENT, Data=envelope.compress(data),
+                               PartitionKey=execution_id)
             print("Published: %s" % data)
         except Exception as ex:
             print "Error processing record, error=%s" % str(object=ex)
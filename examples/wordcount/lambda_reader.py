@@ -1,6 +1,6 @@
 import json
 import boto3
-import base64
+import envelope
 
 OUTBOUND_EVENT = 'FileDownloaded'
 
@@ -8,9 +8,8 @@ OUTBOUND_EVENT = 'FileDownloaded'
 def read(event, context):
     kinesis = boto3.client('kinesis')
     print("Received event: " + json.dumps(event, indent=4))
-    for record in event['Records']:
-        # Kinesis data is base64 encoded so decode here
-        payload = base64.b64decode(record['kinesis']['data'])
+    # Records published by xFlow can be aggregated, envelope unpacks them
+    for payload in envelope.decode_records(event):
         print("Decoded payload: " + payload)
 
         payload = json.loads(payload)
@@ -19,6 +18,9 @@ def read(event, context):
             'execution_id': execution_id,
             'contents': payload['message']
         })
-        kinesis.put_record(StreamName=OUTBOUND_EVENT, Data=data, PartitionKey=data)
+        # File contents are large, so they are compressed like xFlow does
+        # for streams with `compression` set
+        kinesis.put_record(StreamName=OUTBOUND_EVENT, Data=envelope.compress(data),
+                           PartitionKey=execution_id)
 
     return 'Processed all records.'
@@ -6,11 +6,12 @@ import logging
 
 import botocore
 
-from xflow import utils
+from xflow import utils, envelope
 from xflow.aws import CloudWatchLogs, CloudWatchLogDoesNotExist, \
                 CloudWatchStreamDoesNotExist, \
-                Kinesis, KinesisStreamDoesNotExist, \
-                IAM, Lambda, MissingSourceCodeFileError
+                Kinesis, KinesisStreamDoesNotExist, FailureDestinationAccessDenied, \
+                IAM, Lambda, MissingSourceCodeFileError, \
+                TokenBucket, ShardMap, ShardRateLimiter
 
 
 class TestLambda(object):
@@ -19,9 +20,9 @@ class TestLambda(object):
     def setup(self, client_mock):
         self.llambda = Lambda("eu-west-1", "my-role-arn")
 
-    @patch('xflow.utils.zip_file')
-    @patch('xflow.utils.get_zip_contents')
-    def test_successfully_creates_function(self, zip_contents_mock, zip_file_mock):
+    @patch('xflow.utils.read_files')
+    def test_successfully_creates_function(self, read_files_mock):
+        read_files_mock.side_effect = lambda filenames: [(f.rsplit('/', 1)[-1], 'code') for f in filenames]
         resonse = {"Error": {"Code": "ResourceNotFoundException", "Message": ""}}
         err = botocore.exceptions.ClientError(resonse, "update_function_code")
         self.llambda.awslambda.update_function_code.side_effect = err
@@ -31,24 +32,242 @@ class TestLambda(object):
                                                local_filename="/mycode.py")
         nt.assert_equals(1, self.llambda.awslambda.create_function.call_count)
 
-    @patch('xflow.utils.zip_file')
-    @patch('xflow.utils.get_zip_contents')
-    def test_successfully_updates_function(self, zip_contents_mock, zip_file_mock):
+    @patch('xflow.aws.boto3.client')
+    @patch('xflow.utils.read_files')
+    def test_rejected_cached_role_is_evicted(self, read_files_mock, client_mock):
+        read_files_mock.side_effect = lambda filenames: [(f.rsplit('/', 1)[-1], 'code') for f in filenames]
+        role_cache = Mock()
+        self.llambda = Lambda("eu-west-1", "my-role-arn", role_cache=role_cache, role_cache_key="role-key")
+        not_found = botocore.exceptions.ClientError({"Error": {"Code": "ResourceNotFoundException", "Message": ""}},
+                                                    "update_function_configuration")
+        rejected = botocore.exceptions.ClientError({"Error": {
+            "Code": "InvalidParameterValueException",
+            "Message": "The role defined for the function cannot be assumed by Lambda."
+        }}, "create_function")
+        self.llambda.awslambda.update_function_configuration.side_effect = not_found
+        self.llambda.awslambda.create_function.side_effect = rejected
+        nt.assert_raises(botocore.exceptions.ClientError, self.llambda.deploy_function,
+                         "myfunc", "python2.7", "myhandler", local_filename="/mycode.py")
+        nt.assert_equals(1, self.llambda.awslambda.create_function.call_count)
+        role_cache.remove.assert_called_once_with("role-key")
+
+    @patch('xflow.utils.read_files')
+    def test_successfully_updates_function(self, read_files_mock):
+        read_files_mock.side_effect = lambda filenames: [(f.rsplit('/', 1)[-1], 'code') for f in filenames]
         self.llambda.create_or_update_function("myfunc",
                                                "python2.7",
                                                "myhandler",
                                                local_filename="/mycode.py")
         nt.assert_equals(1, self.llambda.awslambda.update_function_code.call_count)
 
+    @patch('xflow.utils.read_files')
+    def test_function_is_created_with_its_settings(self, read_files_mock):
+        read_files_mock.side_effect = lambda filenames: [(f.rsplit('/', 1)[-1], 'code') for f in filenames]
+        resonse = {"Error": {"Code": "ResourceNotFoundException", "Message": ""}}
+        err = botocore.exceptions.ClientError(resonse, "update_function_code")
+        self.llambda.awslambda.update_function_configuration.side_effect = err
+        self.llambda.awslambda.create_function.return_value = {'FunctionArn': 'arn:function:myfunc'}
+        function_arn = self.llambda.create_or_update_function("myfunc",
+                                                              "python2.7",
+                                                              "myhandler",
+                                                              local_filename="/mycode.py",
+                                                              memory_size=512,
+                                                              timeout=30,
+                                                              reserved_concurrency=10)
+        nt.assert_equals('arn:function:myfunc', function_arn)
+        kwargs = self.llambda.awslambda.create_function.call_args[1]
+        nt.assert_equals(512, kwargs['MemorySize'])
+        nt.assert_equals(30, kwargs['Timeout'])
+        self.llambda.awslambda.put_function_concurrency.assert_called_once_with(FunctionName="myfunc",
+                                                                                ReservedConcurrentExecutions=10)
+
+    def test_provisioned_concurrency_is_set_on_alias(self):
+        resonse = {"Error": {"Code": "ResourceNotFoundException", "Message": ""}}
+        self.llambda.awslambda.update_alias.side_effect = botocore.exceptions.ClientError(resonse, "update_alias")
+        self.llambda.awslambda.publish_version.return_value = {'Version': '3'}
+        self.llambda.awslambda.create_alias.return_value = {'AliasArn': 'arn:function:myfunc:provisioned'}
+        function_arn = self.llambda.set_concurrency("myfunc", {'FunctionArn': 'arn:function:myfunc'},
+                                                    provisioned_concurrency=2)
+        nt.assert_equals('arn:function:myfunc:provisioned', function_arn)
+        self.llambda.awslambda.get_waiter.assert_any_call('function_active')
+        self.llambda.awslambda.create_alias.assert_called_once_with(FunctionName="myfunc",
+                                                                    Name="provisioned",
+                                                                    FunctionVersion='3')
+        self.llambda.awslambda.put_provisioned_concurrency_config.assert_called_once_with(
+            FunctionName="myfunc", Qualifier="provisioned", ProvisionedConcurrentExecutions=2)
+        nt.assert_equals(0, self.llambda.awslambda.delete_function_concurrency.call_count)
+
+    def test_concurrency_is_only_changed_when_set(self):
+        function_arn = self.llambda.set_concurrency("myfunc", {'FunctionArn': 'arn:function:myfunc'})
+        nt.assert_equals('arn:function:myfunc', function_arn)
+        nt.assert_equals([], self.llambda.awslambda.method_calls)
+        self.llambda.set_concurrency("myfunc", {'FunctionArn': 'arn:function:myfunc'},
+                                     clear_reserved=True, clear_provisioned=True)
+        self.llambda.awslambda.delete_function_concurrency.assert_called_once_with(FunctionName="myfunc")
+        self.llambda.awslambda.delete_provisioned_concurrency_config.assert_called_once_with(
+            FunctionName="myfunc", Qualifier="provisioned")
+
+    def test_subscriptions_of_other_qualifiers_are_removed(self):
+        self.llambda.awslambda.list_event_source_mappings.return_value = {'EventSourceMappings': [
+            {'UUID': 'old', 'FunctionArn': 'arn:aws:lambda:eu-west-1:1:function:myfunc'},
+            {'UUID': 'new', 'FunctionArn': 'arn:aws:lambda:eu-west-1:1:function:myfunc:provisioned'},
+            {'UUID': 'other', 'FunctionArn': 'arn:aws:lambda:eu-west-1:1:function:otherfunc'}
+        ]}
+        self.llambda.subscribe_to_stream('arn:aws:lambda:eu-west-1:1:function:myfunc:provisioned', "my-stream-arn")
+        self.llambda.awslambda.delete_event_source_mapping.assert_called_once_with(UUID='old')
+
+    def test_packages_files_in_memory(self):
+        self.llambda.create_or_update_function("myfunc",
+                                               "python2.7",
+                                               "myhandler",
+                                               files=[('myfunc.py', 'def myhandler(e, c): pass')])
+        zip_blob = self.llambda.awslambda.update_function_code.call_args[1]['ZipFile']
+        nt.assert_equals(utils.zip_files([('myfunc.py', 'def myhandler(e, c): pass')]), zip_blob)
+
     @nt.raises(MissingSourceCodeFileError)
     def test_raises_error_when_source_code_file_not_provided(self):
         self.llambda.create_or_update_function("myfunc",
                                                "python2.7",
                                                "myhandler")
 
+    def test_unchanged_s3_source_is_not_downloaded_again(self):
+        download_cache = Mock()
+        download_cache.get.return_value = ('"etag1"', 'print 1')
+        self.llambda.download_cache = download_cache
+        resonse = {"Error": {"Code": "304", "Message": "Not Modified"}}
+        err = botocore.exceptions.ClientError(resonse, "get_object")
+        self.llambda.s3.get_object.side_effect = err
+        nt.assert_equals('print 1', self.llambda.download_from_s3('bucket', 'myfunc.py'))
+        self.llambda.s3.get_object.assert_called_once_with(Bucket='bucket', Key='myfunc.py',
+                                                           IfNoneMatch='"etag1"')
+        nt.assert_equals(0, download_cache.put.call_count)
+
+    def test_changed_s3_source_is_downloaded(self):
+        download_cache = Mock()
+        download_cache.get.return_value = None
+        self.llambda.download_cache = download_cache
+        body = Mock()
+        body.read.return_value = 'print 2'
+        self.llambda.s3.get_object.return_value = {'ETag': '"etag2"', 'Body': body}
+        nt.assert_equals('print 2', self.llambda.download_from_s3('bucket', 'myfunc.py'))
+        download_cache.put.assert_called_once_with('bucket', 'myfunc.py', '"etag2"', 'print 2')
+
+    def test_large_artifacts_are_staged_in_s3(self):
+        self.llambda.staging_bucket = 'staging'
+        self.llambda.staging_threshold = 10
+        resonse = {"Error": {"Code": "404", "Message": "Not Found"}}
+        self.llambda.s3.head_object.side_effect = botocore.exceptions.ClientError(resonse, "head_object")
+        self.llambda.create_or_update_function("myfunc",
+                                               "python2.7",
+                                               "myhandler",
+                                               files=[('myfunc.py', 'def myhandler(e, c): pass')])
+        nt.assert_equals(1, self.llambda.s3.upload_fileobj.call_count)
+        key = self.llambda.s3.upload_fileobj.call_args[0][2]
+        self.llambda.awslambda.update_function_code.assert_called_once_with(FunctionName="myfunc",
+                                                                            S3Bucket='staging',
+                                                                            S3Key=key,
+                                                                            Publish=True)
+
+    def test_staged_artifacts_are_not_uploaded_again(self):
+        self.llambda.staging_bucket = 'staging'
+        self.llambda.staging_threshold = 10
+        code = self.llambda.get_code('x' * 20)
+        nt.assert_equals('staging', code['S3Bucket'])
+        nt.assert_equals(0, self.llambda.s3.upload_fileobj.call_count)
+        nt.assert_equals({'ZipFile': 'x'}, self.llambda.get_code('x'))
+
+    def test_latest_layer_version_is_used(self):
+        self.llambda.awslambda.list_layer_versions.return_value = {'LayerVersions': [
+            {'Version': 1, 'LayerVersionArn': 'arn:layer:deps:1'},
+            {'Version': 2, 'LayerVersionArn': 'arn:layer:deps:2'}
+        ]}
+        nt.assert_equals('arn:layer:deps:2', self.llambda.get_layer_version_arn('deps'))
+        self.llambda.awslambda.list_layer_versions.return_value = {'LayerVersions': []}
+        nt.assert_equals(None, self.llambda.get_layer_version_arn('deps'))
+
     def test_successfully_subscribes_to_stream(self):
-        self.llambda.subscribe_to_stream("my-function-arn", "my-stream-arn")
+        self.llambda.subscribe_to_stream("my-function-arn", "my-stream-arn", {'BatchSize': 100})
         nt.assert_equals(1, self.llambda.awslambda.create_event_source_mapping.call_count)
+        self.llambda.awslambda.create_event_source_mapping.assert_called_once_with(
+            EventSourceArn="my-stream-arn", FunctionName="my-function-arn", BatchSize=100,
+            MaximumBatchingWindowInSeconds=0, ParallelizationFactor=1, StartingPosition='TRIM_HORIZON',
+            BisectBatchOnFunctionError=False, MaximumRetryAttempts=-1, MaximumRecordAgeInSeconds=-1)
+
+    @nt.raises(FailureDestinationAccessDenied)
+    def test_denied_failure_destination_is_not_retried(self):
+        denied = botocore.exceptions.ClientError({'Error': {
+            'Code': 'InvalidParameterValueException',
+            'Message': 'The provided execution role does not have permissions to call SendMessage on SQS'
+        }}, 'CreateEventSourceMapping')
+        self.llambda.awslambda.create_event_source_mapping.side_effect = denied
+        destination = {'OnFailure': {'Destination': 'arn:aws:sqs:eu-west-1:xxxxxxxxxxxx:failures'}}
+        try:
+            self.llambda.subscribe_to_stream("my-function-arn", "my-stream-arn", {'DestinationConfig': destination})
+        finally:
+            nt.assert_equals(1, self.llambda.awslambda.create_event_source_mapping.call_count)
+
+    def test_existing_subscription_is_updated_when_changed(self):
+        conflict = botocore.exceptions.ClientError({'Error': {'Code': 'ResourceConflictException'}},
+                                                   'CreateEventSourceMapping')
+        self.llambda.awslambda.create_event_source_mapping.side_effect = conflict
+        self.llambda.awslambda.list_event_source_mappings.return_value = {'EventSourceMappings': [
+            {'UUID': 'mapping-uuid', 'BatchSize': 1, 'MaximumBatchingWindowInSeconds': 0,
+             'ParallelizationFactor': 1, 'StartingPosition': 'TRIM_HORIZON'}
+        ]}
+        self.llambda.subscribe_to_stream("my-function-arn", "my-stream-arn",
+                                         {'BatchSize': 100, 'StartingPosition': 'LATEST'})
+        self.llambda.awslambda.update_event_source_mapping.assert_called_once_with(UUID='mapping-uuid',
+                                                                                   BatchSize=100,
+                                                                                   BisectBatchOnFunctionError=False,
+                                                                                   MaximumRetryAttempts=-1,
+                                                                                   MaximumRecordAgeInSeconds=-1)
+
+    def test_failure_handling_of_subscription_is_applied_once(self):
+        conflict = botocore.exceptions.ClientError({'Error': {'Code': 'ResourceConflictException'}},
+                                                   'CreateEventSourceMapping')
+        self.llambda.awslambda.create_event_source_mapping.side_effect = conflict
+        destination = {'OnFailure': {'Destination': 'arn:aws:sqs:eu-west-1:xxxxxxxxxxxx:failures'}}
+        settings = {'BisectBatchOnFunctionError': True, 'MaximumRetryAttempts': 3,
+                    'DestinationConfig': destination}
+        mapping = {'UUID': 'mapping-uuid', 'BatchSize': 1, 'MaximumBatchingWindowInSeconds': 0,
+                   'ParallelizationFactor': 1, 'StartingPosition': 'TRIM_HORIZON',
+                   'BisectBatchOnFunctionError': False, 'MaximumRetryAttempts': -1,
+                   'MaximumRecordAgeInSeconds': -1, 'DestinationConfig': {'OnFailure': {}}}
+        self.llambda.awslambda.list_event_source_mappings.return_value = {'EventSourceMappings': [mapping]}
+        self.llambda.subscribe_to_stream("my-function-arn", "my-stream-arn", settings)
+        self.llambda.awslambda.update_event_source_mapping.assert_called_once_with(UUID='mapping-uuid', **settings)
+
+        mapping.update(settings)
+        self.llambda.subscribe_to_stream("my-function-arn", "my-stream-arn", settings)
+        nt.assert_equals(1, self.llambda.awslambda.update_event_source_mapping.call_count)
+
+    def test_removed_failure_destination_is_cleared(self):
+        conflict = botocore.exceptions.ClientError({'Error': {'Code': 'ResourceConflictException'}},
+                                                   'CreateEventSourceMapping')
+        self.llambda.awslambda.create_event_source_mapping.side_effect = conflict
+        self.llambda.awslambda.list_event_source_mappings.return_value = {'EventSourceMappings': [
+            {'UUID': 'mapping-uuid', 'BatchSize': 1, 'MaximumBatchingWindowInSeconds': 0,
+             'ParallelizationFactor': 1, 'StartingPosition': 'TRIM_HORIZON',
+             'BisectBatchOnFunctionError': False, 'MaximumRetryAttempts': -1,
+             'MaximumRecordAgeInSeconds': -1,
+             'DestinationConfig': {'OnFailure': {'Destination': 'arn:aws:sqs:eu-west-1:xxxxxxxxxxxx:failures'}}}
+        ]}
+        self.llambda.subscribe_to_stream("my-function-arn", "my-stream-arn")
+        self.llambda.awslambda.update_event_source_mapping.assert_called_once_with(
+            UUID='mapping-uuid', DestinationConfig={'OnFailure': {}})
+
+    def test_unchanged_subscription_is_not_updated(self):
+        conflict = botocore.exceptions.ClientError({'Error': {'Code': 'ResourceConflictException'}},
+                                                   'CreateEventSourceMapping')
+        self.llambda.awslambda.create_event_source_mapping.side_effect = conflict
+        self.llambda.awslambda.list_event_source_mappings.return_value = {'EventSourceMappings': [
+            {'UUID': 'mapping-uuid', 'BatchSize': 1, 'MaximumBatchingWindowInSeconds': 0,
+             'ParallelizationFactor': 1, 'StartingPosition': 'TRIM_HORIZON',
+             'BisectBatchOnFunctionError': False, 'MaximumRetryAttempts': -1,
+             'MaximumRecordAgeInSeconds': -1}
+        ]}
+        self.llambda.subscribe_to_stream("my-function-arn", "my-stream-arn")
+        nt.assert_equals(0, self.llambda.awslambda.update_event_source_mapping.call_count)
 
 
 class TestIAM(object):
@@ -58,12 +277,33 @@ class TestIAM(object):
         self.role = "test-role"
         self.iam = IAM("eu-west-1")
 
+    def _set_role_policies(self, attached_policies, inline_policy):
+        paginator = self.iam.iam.get_paginator.return_value
+        paginator.paginate.return_value = [{'AttachedPolicies': [{'PolicyArn': p} for p in attached_policies]}]
+        self.iam.iam.get_role_policy.return_value = {'PolicyDocument': inline_policy}
+
     def test_successfully_gets_role(self):
+        self._set_role_policies([], None)
         self.iam.get_or_create_role(self.role)
         nt.assert_equals(1, self.iam.iam.get_role.call_count)
         nt.assert_equals(2, self.iam.iam.attach_role_policy.call_count)
         nt.assert_equals(1, self.iam.iam.put_role_policy.call_count)
 
+    def test_provisioned_role_is_not_changed(self):
+        self._set_role_policies([IAM.POLICY_LAMBDA_KINESIS_EXECUTION_ROLE,
+                                 IAM.POLICY_LAMBDA_CWLOGS_READONLY_ROLE],
+                                json.loads(json.dumps(IAM.POLICY_LAMBDA_KINESIS_PUBLISH)))
+        self.iam.get_or_create_role(self.role)
+        nt.assert_equals(0, self.iam.iam.attach_role_policy.call_count)
+        nt.assert_equals(0, self.iam.iam.put_role_policy.call_count)
+
+    def test_only_missing_policies_are_attached(self):
+        self._set_role_policies([IAM.POLICY_LAMBDA_KINESIS_EXECUTION_ROLE], None)
+        self.iam.get_or_create_role(self.role)
+        self.iam.iam.attach_role_policy.assert_called_once_with(RoleName=self.role,
+                                                                PolicyArn=IAM.POLICY_LAMBDA_CWLOGS_READONLY_ROLE)
+        nt.assert_equals(1, self.iam.iam.put_role_policy.call_count)
+
     def test_successfully_creates_role(self):
         resonse = {"Error": {"Code": "NoSuchEntity", "Message": ""}}
         err = botocore.exceptions.ClientError(resonse, "get_role")
@@ -73,6 +313,26 @@ class TestIAM(object):
         nt.assert_equals(2, self.iam.iam.attach_role_policy.call_count)
         nt.assert_equals(1, self.iam.iam.put_role_policy.call_count)
 
+    def test_role_is_allowed_to_send_to_failure_destinations(self):
+        self._set_role_policies([], None)
+        destinations = ['arn:aws:sqs:eu-west-1:1:failures', 'arn:aws:sns:eu-west-1:1:failures']
+        self.iam.get_or_create_role(self.role, failure_destinations=destinations)
+        self.iam.iam.put_role_policy.assert_any_call(RoleName=self.role,
+                                                     PolicyName=IAM.POLICY_LAMBDA_FAILURE_DESTINATIONS_NAME,
+                                                     PolicyDocument=ANY)
+        policy = json.loads(self.iam.iam.put_role_policy.call_args[1]['PolicyDocument'])
+        nt.assert_equals({'sns:Publish': ['arn:aws:sns:eu-west-1:1:failures'],
+                          'sqs:SendMessage': ['arn:aws:sqs:eu-west-1:1:failures']},
+                         {s['Action'][0]: s['Resource'] for s in policy['Statement']})
+
+    def test_failure_destinations_policy_is_removed_when_unused(self):
+        self._set_role_policies([IAM.POLICY_LAMBDA_KINESIS_EXECUTION_ROLE,
+                                 IAM.POLICY_LAMBDA_CWLOGS_READONLY_ROLE],
+                                json.loads(json.dumps(IAM.get_failure_destinations_policy(['arn:aws:sqs:eu-west-1:1:q']))))
+        self.iam.get_or_create_role(self.role)
+        self.iam.iam.delete_role_policy.assert_called_once_with(RoleName=self.role,
+                                                                PolicyName=IAM.POLICY_LAMBDA_FAILURE_DESTINATIONS_NAME)
+
 
 class TestKinesis(object):
 
@@ -85,6 +345,84 @@ class TestKinesis(object):
         self.kinesis.get_or_create_stream(self.stream)
         nt.assert_equals(1, self.kinesis.kinesis.describe_stream.call_count)
 
+    def test_stream_exists(self):
+        nt.assert_true(self.kinesis.stream_exists(self.stream))
+        resonse = {"Error": {"Code": "ResourceNotFoundException","Message": ""}}
+        err = botocore.exceptions.ClientError(resonse, "describe_stream_summary")
+        self.kinesis.kinesis.describe_stream_summary.side_effect = err
+        nt.assert_false(self.kinesis.stream_exists(self.stream))
+
+    def test_successfully_creates_stream_with_shards(self):
+        resonse = {"Error": {"Code": "ResourceNotFoundException","Message": ""}}
+        err = botocore.exceptions.ClientError(resonse, "describe_stream")
+        self.kinesis.kinesis.describe_stream.side_effect = [err, {
+            "StreamDescription": {"StreamStatus": "ACTIVE", "StreamARN": "my-stream-arn"}
+        }]
+        self.kinesis.get_or_create_stream(self.stream, shard_count=4)
+        self.kinesis.kinesis.create_stream.assert_called_once_with(StreamName=self.stream, ShardCount=4)
+
+    def test_reshards_existing_stream(self):
+        self.kinesis.kinesis.describe_stream.return_value = {
+            "StreamDescription": {"StreamStatus": "ACTIVE", "StreamARN": "my-stream-arn"}
+        }
+        self.kinesis.kinesis.describe_stream_summary.return_value = {
+            "StreamDescriptionSummary": {"OpenShardCount": 1}
+        }
+        self.kinesis.get_or_create_stream(self.stream, shard_count=2)
+        self.kinesis.kinesis.update_shard_count.assert_called_once_with(StreamName=self.stream,
+                                                                        TargetShardCount=2,
+                                                                        ScalingType='UNIFORM_SCALING')
+
+    def test_reshards_in_steps_of_at_most_doubling(self):
+        self.kinesis.kinesis.describe_stream.return_value = {
+            "StreamDescription": {"StreamStatus": "ACTIVE", "StreamARN": "my-stream-arn"}
+        }
+        self.kinesis.kinesis.describe_stream_summary.return_value = {
+            "StreamDescriptionSummary": {"OpenShardCount": 1}
+        }
+        self.kinesis.get_or_create_stream(self.stream, shard_count=5)
+        targets = [c[1]['TargetShardCount'] for c in self.kinesis.kinesis.update_shard_count.call_args_list]
+        nt.assert_equals([2, 4, 5], targets)
+        nt.assert_equals(3, self.kinesis.kinesis.get_waiter.return_value.wait.call_count)
+
+    def test_reshards_in_steps_of_at_most_halving(self):
+        nt.assert_equals([3, 2, 1], self.kinesis._get_resharding_steps(5, 1))
+        nt.assert_equals([], self.kinesis._get_resharding_steps(2, 2))
+
+    def test_waits_for_updating_stream_before_resharding(self):
+        self.kinesis.kinesis.describe_stream.return_value = {
+            "StreamDescription": {"StreamStatus": "UPDATING", "StreamARN": "my-stream-arn"}
+        }
+        self.kinesis.kinesis.describe_stream_summary.return_value = {
+            "StreamDescriptionSummary": {"OpenShardCount": 2}
+        }
+        self.kinesis.get_or_create_stream(self.stream, shard_count=2)
+        self.kinesis.kinesis.get_waiter.assert_called_once_with('stream_exists')
+        nt.assert_equals(0, self.kinesis.kinesis.update_shard_count.call_count)
+
+    def test_partition_key_is_hash_of_execution_id(self):
+        key1 = self.kinesis.partition_key(json.dumps({"execution_id": "ex1", "n": 1}))
+        key2 = self.kinesis.partition_key(json.dumps({"execution_id": "ex1", "n": 2}))
+        key3 = self.kinesis.partition_key(json.dumps({"execution_id": "ex2", "n": 1}))
+        nt.assert_equals(key1, key2)
+        nt.assert_not_equals(key1, key3)
+
+    def test_partition_key_is_bounded_for_large_payloads(self):
+        key = self.kinesis.partition_key("x" * 1000)
+        nt.assert_true(len(key) <= 256)
+
+    def test_partition_key_from_configured_field(self):
+        self.kinesis.partition_key_strategy = "field"
+        self.kinesis.partition_key_field = "user"
+        key1 = self.kinesis.partition_key(json.dumps({"execution_id": "ex1", "user": "u1"}))
+        key2 = self.kinesis.partition_key(json.dumps({"execution_id": "ex2", "user": "u1"}))
+        nt.assert_equals(key1, key2)
+
+    def test_random_partition_key(self):
+        self.kinesis.partition_key_strategy = "random"
+        data = json.dumps({"execution_id": "ex1"})
+        nt.assert_not_equals(self.kinesis.partition_key(data), self.kinesis.partition_key(data))
+
     def test_successfully_creates_stream(self):
         resonse = {"Error": {"Code": "ResourceNotFoundException","Message": ""}}
         err = botocore.exceptions.ClientError(resonse, "describe_stream")
@@ -106,6 +444,131 @@ class TestKinesis(object):
         self.kinesis.kinesis.put_record.side_effect = err
         self.kinesis.publish(self.stream, "mydata")
 
+    def test_successfully_publishes_batch_to_stream(self):
+        self.kinesis.kinesis.put_records.return_value = {
+            "Records": [{"SequenceNumber": "1", "ShardId": "s1"},
+                        {"SequenceNumber": "2", "ShardId": "s1"}]
+        }
+        results = self.kinesis.publish_batch(self.stream, ["data1", "data2"])
+        nt.assert_equals(1, self.kinesis.kinesis.put_records.call_count)
+        nt.assert_equals(["1", "2"], [r["SequenceNumber"] for r in results])
+
+    @patch('xflow.aws.time.sleep')
+    def test_retries_only_failed_records_of_batch(self, sleep_mock):
+        self.kinesis.kinesis.put_records.side_effect = [
+            {"Records": [{"SequenceNumber": "1", "ShardId": "s1"},
+                         {"ErrorCode": "ProvisionedThroughputExceededException", "ErrorMessage": ""}]},
+            {"Records": [{"SequenceNumber": "2", "ShardId": "s1"}]}
+        ]
+        results = self.kinesis.publish_batch(self.stream, ["data1", "data2"])
+        retried = self.kinesis.kinesis.put_records.call_args_list[1][1]["Records"]
+        nt.assert_equals(["data2"], [r["Data"] for r in retried])
+        nt.assert_equals(["1", "2"], [r["SequenceNumber"] for r in results])
+
+    @patch('xflow.aws.time.sleep')
+    def test_retries_throttled_publish(self, sleep_mock):
+        resonse = {"Error": {"Code": "ProvisionedThroughputExceededException","Message": ""}}
+        err = botocore.exceptions.ClientError(resonse, "put_record")
+        self.kinesis.kinesis.put_record.side_effect = [err, err, {}]
+        self.kinesis.publish(self.stream, "mydata")
+        nt.assert_equals(3, self.kinesis.kinesis.put_record.call_count)
+        nt.assert_equals(2, self.kinesis.get_stats()['throttles'])
+        nt.assert_equals(2, self.kinesis.get_stats()['retries'])
+
+    @nt.raises(botocore.exceptions.ClientError)
+    @patch('xflow.aws.time.sleep')
+    def test_raises_error_when_throttled_publish_exhausts_retries(self, sleep_mock):
+        resonse = {"Error": {"Code": "ProvisionedThroughputExceededException","Message": ""}}
+        err = botocore.exceptions.ClientError(resonse, "put_record")
+        self.kinesis.kinesis.put_record.side_effect = err
+        self.kinesis.publish(self.stream, "mydata")
+
+    @nt.raises(botocore.exceptions.ClientError)
+    def test_does_not_retry_unexpected_publish_errors(self):
+        resonse = {"Error": {"Code": "ValidationException","Message": ""}}
+        err = botocore.exceptions.ClientError(resonse, "put_record")
+        self.kinesis.kinesis.put_record.side_effect = err
+        try:
+            self.kinesis.publish(self.stream, "mydata")
+        finally:
+            nt.assert_equals(1, self.kinesis.kinesis.put_record.call_count)
+
+    def test_compresses_records_of_compressed_streams(self):
+        self.kinesis.compression = {self.stream: "zlib"}
+        data = json.dumps({"execution_id": "ex1", "contents": "word " * 100})
+        self.kinesis.publish(self.stream, data)
+        kwargs = self.kinesis.kinesis.put_record.call_args[1]
+        nt.assert_equals([data], envelope.decode(kwargs["Data"]))
+        nt.assert_equals(self.kinesis.partition_key(data), kwargs["PartitionKey"])
+
+    def test_splits_batch_into_put_records_limits(self):
+        self.kinesis.kinesis.put_records.side_effect = lambda **kw: {
+            "Records": [{"SequenceNumber": "1", "ShardId": "s1"} for r in kw["Records"]]
+        }
+        results = self.kinesis.publish_batch(self.stream, ["d"] * 501)
+        nt.assert_equals(2, self.kinesis.kinesis.put_records.call_count)
+        nt.assert_equals(501, len(results))
+
+    def test_aggregates_records_of_the_same_shard(self):
+        self.kinesis.aggregate = True
+        self.kinesis.kinesis.list_shards.return_value = {
+            "Shards": [
+                {"ShardId": "shard-1", "SequenceNumberRange": {},
+                 "HashKeyRange": {"StartingHashKey": "0", "EndingHashKey": str(2 ** 127 - 1)}},
+                {"ShardId": "shard-2", "SequenceNumberRange": {},
+                 "HashKeyRange": {"StartingHashKey": str(2 ** 127), "EndingHashKey": str(2 ** 128 - 1)}}
+            ]
+        }
+        self.kinesis.kinesis.put_records.side_effect = lambda **kw: {
+            "Records": [{"SequenceNumber": str(i), "ShardId": "s"} for i, r in enumerate(kw["Records"])]
+        }
+        records = [json.dumps({"execution_id": "ex%s" % i}) for i in range(20)]
+        results = self.kinesis.publish_batch(self.stream, records)
+        entries = self.kinesis.kinesis.put_records.call_args[1]["Records"]
+        nt.assert_equals(2, len(entries))
+        unpacked = [p for e in entries for p in envelope.deaggregate(e["Data"])]
+        nt.assert_equals(sorted(records), sorted(unpacked))
+        nt.assert_equals(20, len(results))
+        nt.assert_equals(set(["0", "1"]), set(r["SequenceNumber"] for r in results))
+
+    @nt.raises(KinesisStreamDoesNotExist)
+    def test_raises_error_when_batch_stream_does_not_exist(self):
+        resonse = {"Error": {"Code": "ResourceNotFoundException","Message": ""}}
+        err = botocore.exceptions.ClientError(resonse, "put_records")
+        self.kinesis.kinesis.put_records.side_effect = err
+        self.kinesis.publish_batch(self.stream, ["mydata"])
+
+
+class TestTokenBucket(object):
+
+    def test_waits_when_tokens_are_exhausted(self):
+        bucket = TokenBucket(1000)
+        nt.assert_equals(0, bucket.acquire(1000))
+        nt.assert_true(bucket.acquire(5) > 0)
+
+
+class TestShardRateLimiter(object):
+
+    def setup(self):
+        self.kinesis = Mock()
+        self.kinesis.list_open_shards.return_value = [
+            {"ShardId": "shard-1", "HashKeyRange": {"StartingHashKey": "0",
+                                                    "EndingHashKey": str(2 ** 127 - 1)}},
+            {"ShardId": "shard-2", "HashKeyRange": {"StartingHashKey": str(2 ** 127),
+                                                    "EndingHashKey": str(2 ** 128 - 1)}}
+        ]
+        self.limiter = ShardRateLimiter(ShardMap(self.kinesis))
+
+    def test_limits_records_per_shard(self):
+        records = [("data", "key%s" % i) for i in range(1000)]
+        nt.assert_equals(0, self.limiter.acquire("test-stream", records))
+        nt.assert_equals(set(["shard-1", "shard-2"]), set(self.limiter.buckets.keys()))
+        nt.assert_equals(1, self.kinesis.list_open_shards.call_count)
+
+    def test_waits_when_shard_is_saturated(self):
+        self.limiter.acquire("test-stream", [("data", "key")] * 1000)
+        nt.assert_true(self.limiter.acquire("test-stream", [("data", "key")] * 5) > 0)
+
 
 class TestCloudWatchLogs(object):
 
@@ -115,6 +578,12 @@ class TestCloudWatchLogs(object):
         self.log_stream = "test_stream"
         self.logs = CloudWatchLogs("eu-west-1")
 
+    def test_log_group_exists(self):
+        self.logs.cwlogs.describe_log_groups.return_value = {"logGroups": [{"logGroupName": "test_group_2"}]}
+        nt.assert_false(self.logs.log_group_exists(self.log_group))
+        self.logs.cwlogs.describe_log_groups.return_value = {"logGroups": [{"logGroupName": self.log_group}]}
+        nt.assert_true(self.logs.log_group_exists(self.log_group))
+
     def test_successfully_creates_log_group(self):
         self.logs.create_log_group(self.log_group)
         nt.assert_equals(1, self.logs.cwlogs.create_log_group.call_count)
@@ -162,3 +631,19 @@ class TestCloudWatchLogs(object):
         err = botocore.exceptions.ClientError(resonse, "get_log_events")
         self.logs.cwlogs.get_log_events.side_effect = err
         self.logs.get_log_events(self.log_group, self.log_stream)
+
+    def test_successfully_filters_log_events(self):
+        mocked_timestamp = 1476050160000
+        mocked_message = '{"execution_id": "ex1", "event_name": "FileUploaded"}'
+        paginator = self.logs.cwlogs.get_paginator.return_value
+        paginator.paginate.return_value = [{"events": [{"timestamp": mocked_timestamp,
+                                                        "message": mocked_message}]}]
+        expected = [{
+            "timestamp": utils.format_datetime(datetime.fromtimestamp(mocked_timestamp / 1000)),
+            "data": json.loads(mocked_message)
+        }]
+        actual = self.logs.filter_log_events(self.log_group, self.log_stream, '{ $.execution_id = "ex1" }')
+        nt.assert_equals(expected, actual)
+        paginator.paginate.assert_called_once_with(logGroupName=self.log_group,
+                                                   logStreamNames=[self.log_stream],
+                                                   filterPattern='{ $.execution_id = "ex1" }')
@@ -0,0 +1,116 @@
+import io
+import os
+import shutil
+import zipfile
+import tempfile
+import nose.tools as nt
+from mock import patch
+
+from xflow import utils
+from xflow.cache import ArtifactCache, DownloadCache, RoleCache, files_digest
+
+
+class TestPackaging(object):
+
+    def test_archives_are_deterministic(self):
+        files = [('b.py', 'print 1'), ('a.py', 'print 2')]
+        archive = utils.zip_files(files)
+        nt.assert_equals(archive, utils.zip_files(list(reversed(files))))
+        zf = zipfile.ZipFile(io.BytesIO(archive))
+        nt.assert_equals(['a.py', 'b.py'], zf.namelist())
+        nt.assert_equals('print 2', zf.read('a.py'))
+        nt.assert_equals(utils.ZIP_DATE_TIME, zf.getinfo('b.py').date_time)
+
+    def test_digest_depends_on_names_and_contents(self):
+        digest = files_digest([('a.py', 'print 1')])
+        nt.assert_not_equals(digest, files_digest([('b.py', 'print 1')]))
+        nt.assert_not_equals(digest, files_digest([('a.py', 'print 2')]))
+
+
+class TestArtifactCache(object):
+
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache = ArtifactCache(self.dir)
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+
+    def test_packaged_archive_is_cached(self):
+        files = [('a.py', 'print 1')]
+        archive = self.cache.package(files)
+        nt.assert_equals(archive, self.cache.get(files_digest(files)))
+        with patch('xflow.utils.zip_files') as zip_files_mock:
+            nt.assert_equals(archive, self.cache.package(files))
+            nt.assert_equals(0, zip_files_mock.call_count)
+
+    def test_missing_artifact_is_none(self):
+        nt.assert_equals(None, self.cache.get('0' * 64))
+        nt.assert_equals([], os.listdir(self.dir))
+
+    def test_least_recently_used_artifacts_are_evicted(self):
+        self.cache = ArtifactCache(self.dir, max_bytes=10)
+        keys = ['a' * 64, 'b' * 64, 'c' * 64]
+        self.cache.put(keys[0], 'aaaa')
+        self.cache.put(keys[1], 'bbbb')
+        os.utime(self.cache._path(keys[0]), (1, 1))
+        os.utime(self.cache._path(keys[1]), (2, 2))
+        self.cache.get(keys[0])
+        self.cache.put(keys[2], 'cccc')
+        nt.assert_equals(None, self.cache.get(keys[1]))
+        nt.assert_equals('aaaa', self.cache.get(keys[0]))
+        nt.assert_equals('cccc', self.cache.get(keys[2]))
+
+
+class TestDownloadCache(object):
+
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache = DownloadCache(self.dir, max_bytes=10)
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+
+    def test_download_is_cached_with_its_etag(self):
+        nt.assert_equals(None, self.cache.get('bucket', 'a.py'))
+        self.cache.put('bucket', 'a.py', '"etag1"', 'print 1')
+        nt.assert_equals(('"etag1"', 'print 1'), self.cache.get('bucket', 'a.py'))
+
+    def test_least_recently_used_downloads_are_evicted(self):
+        self.cache.put('bucket', 'a.py', '"a"', 'aaaa')
+        self.cache.put('bucket', 'b.py', '"b"', 'bbbb')
+        a_path = self.cache._path('bucket', 'a.py')
+        b_path = self.cache._path('bucket', 'b.py')
+        os.utime(a_path, (1, 1))
+        os.utime(b_path, (2, 2))
+        self.cache.get('bucket', 'a.py')
+        self.cache.put('bucket', 'c.py', '"c"', 'cccc')
+        nt.assert_equals(None, self.cache.get('bucket', 'b.py'))
+        nt.assert_equals(('"a"', 'aaaa'), self.cache.get('bucket', 'a.py'))
+        nt.assert_equals(('"c"', 'cccc'), self.cache.get('bucket', 'c.py'))
+
+
+class TestRoleCache(object):
+
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'roles.json')
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+
+    def test_role_is_cached(self):
+        RoleCache(self.path, ttl=60).put('default:eu-west-1:role', 'arn:role')
+        nt.assert_equals('arn:role', RoleCache(self.path, ttl=60).get('default:eu-west-1:role'))
+        nt.assert_equals(None, RoleCache(self.path, ttl=60).get('default:us-east-1:role'))
+
+    def test_expired_role_is_not_returned(self):
+        RoleCache(self.path, ttl=-1).put('default:eu-west-1:role', 'arn:role')
+        nt.assert_equals(None, RoleCache(self.path).get('default:eu-west-1:role'))
+
+    def test_role_is_removed(self):
+        RoleCache(self.path, ttl=60).put('default:eu-west-1:role', 'arn:role')
+        RoleCache(self.path, ttl=60).put('default:us-east-1:role', 'arn:role')
+        RoleCache(self.path, ttl=60).remove('default:eu-west-1:role')
+        nt.assert_equals(None, RoleCache(self.path, ttl=60).get('default:eu-west-1:role'))
+        nt.assert_equals('arn:role', RoleCache(self.path, ttl=60).get('default:us-east-1:role'))
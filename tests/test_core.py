@@ -1,11 +1,15 @@
 import os
 import json
+import shutil
+import tempfile
+import time
+import threading
 import nose.tools as nt
 from mock import patch, ANY, Mock
 import logging
 
 import xflow
-from xflow import core, utils, aws, tracker
+from xflow import core, utils, aws, tracker, layers
 from xflow.core import IAM, Engine, ConfigValidationError, WorkflowDoesNotExist, \
                 CloudWatchLogDoesNotExist, CloudWatchStreamDoesNotExist
 
@@ -32,6 +36,48 @@ class TestEngineConfigValidation(object):
         config_path = config_dir + "/invalid_missing_event.yaml"
         Engine.validate_config(config_path)
 
+    @nt.raises(ConfigValidationError)
+    def test_raises_error_for_invalid_config_03(self):
+        ''' Test config is successfully invalidated when the partition
+        key strategy is `field` without a field defined '''
+        config_path = config_dir + "/invalid_partition_key_field.yaml"
+        Engine.validate_config(config_path)
+
+    @nt.raises(ConfigValidationError)
+    def test_raises_error_for_invalid_config_04(self):
+        ''' Test config is successfully invalidated when
+        the schema of an event is not a valid JSON schema '''
+        config_path = config_dir + "/invalid_event_schema.yaml"
+        Engine.validate_config(config_path)
+
+    @nt.raises(ConfigValidationError)
+    def test_raises_error_for_invalid_config_05(self):
+        ''' Test config is successfully invalidated when a lambda
+        has requirements for a runtime without layer support '''
+        config_path = config_dir + "/invalid_requirements_runtime.yaml"
+        Engine.validate_config(config_path)
+
+    @nt.raises(ConfigValidationError)
+    def test_raises_error_for_invalid_config_06(self):
+        ''' Test config is successfully invalidated when the maximum
+        record age of a subscription is below the minimum '''
+        config_path = config_dir + "/invalid_mapping_record_age.yaml"
+        Engine.validate_config(config_path)
+
+    @nt.raises(ConfigValidationError)
+    def test_raises_error_for_invalid_config_07(self):
+        ''' Test config is successfully invalidated when the provisioned
+        concurrency of a lambda exceeds its reserved concurrency '''
+        config_path = config_dir + "/invalid_provisioned_concurrency.yaml"
+        Engine.validate_config(config_path)
+
+    @nt.raises(ConfigValidationError)
+    def test_raises_error_for_invalid_config_08(self):
+        ''' Test config is successfully invalidated when the acknowledgement
+        timeout of asynchronous publishing is not positive '''
+        config_path = config_dir + "/invalid_ack_timeout.yaml"
+        Engine.validate_config(config_path)
+
     def test_config_successfully_validates(self):
         ''' Test config is validated for a correct config '''
         config_path = config_dir + "/valid.yaml"
@@ -78,9 +124,34 @@ class TestEngineConfiguration(object):
         nt.assert_equals(len(stream_names), self.engine.kinesis.get_or_create_stream.call_count)
         nt.assert_equals(len(subscribers), self.engine.awslambda.subscribe_to_stream.call_count)
 
-    @patch('xflow.utils.write_file')
-    @patch('xflow.tracker.generate_code')
-    def test_tracker_is_setup(self, generate_code_mock, write_mock):
+    def test_streams_are_created_with_configured_shards(self):
+        ''' Tests that streams are created with the shard count
+        of their subscription '''
+        lambda_mappings = self.engine.setup_lambdas()
+        self.engine.setup_streams_and_subscriptions(lambda_mappings)
+        for ss in self.test_config['subscriptions']:
+            self.engine.kinesis.get_or_create_stream.assert_any_call(ss['event'], shard_count=ss.get('shards'), wait=False)
+        self.engine.kinesis.wait_for_streams.assert_called_once_with([ss['event'] for ss in self.test_config['subscriptions']])
+
+    def test_subscriptions_are_created_with_configured_mapping(self):
+        ''' Tests that subscribers are subscribed with the event source
+        mapping settings of their subscription '''
+        lambda_mappings = self.engine.setup_lambdas()
+        stream_mappings = self.engine.setup_streams_and_subscriptions(lambda_mappings)
+        self.engine.awslambda.subscribe_to_stream.assert_any_call(lambda_mappings['lambda_parser'],
+                                                                  stream_mappings['FileDownloaded'],
+                                                                  {'BatchSize': 100,
+                                                                   'MaximumBatchingWindowInSeconds': 1,
+                                                                   'ParallelizationFactor': 2,
+                                                                   'BisectBatchOnFunctionError': True,
+                                                                   'MaximumRetryAttempts': 3,
+                                                                   'MaximumRecordAgeInSeconds': 3600,
+                                                                   'DestinationConfig': {'OnFailure': {
+                                                                       'Destination': 'arn:aws:sqs:eu-west-1:xxxxxxxxxxxx:FileDownloadedFailures'}}})
+        self.engine.awslambda.subscribe_to_stream.assert_any_call(lambda_mappings['lambda_file_reader'],
+                                                                  stream_mappings['FileUploaded'], {})
+
+    def test_tracker_is_setup(self):
         ''' Tests that the tracker lambda is created along with its
         log group and that it is subscribed to all streams in the workflow '''
         workflow_id = "test_workflow"
@@ -94,9 +165,7 @@ class TestEngineConfiguration(object):
         nt.assert_equals(len(stream_arns), self.engine.awslambda.subscribe_to_stream.call_count)
         nt.assert_equals(1, self.engine.cwlogs.create_log_group.call_count)
 
-    @patch('xflow.utils.write_file')
-    @patch('xflow.tracker.generate_code')
-    def test_workflows_are_setup(self, generate_code_mock, write_mock):
+    def test_workflows_are_setup(self):
         ''' Tests that all workflows as defined in the config are created along
         with their trackers '''
         lambda_mappings = self.engine.setup_lambdas()
@@ -107,9 +176,7 @@ class TestEngineConfiguration(object):
         num_log_groups_created = self.engine.cwlogs.create_log_group.call_count
         nt.assert_equals(num_workflows, num_log_groups_created)
 
-    @patch('xflow.utils.write_file')
-    @patch('xflow.tracker.generate_code')
-    def test_engine_is_successfully_configured(self, generate_code_mock, write_mock):
+    def test_engine_is_successfully_configured(self):
         ''' Tests that the engine is configurated successfully, i.e. the lambda,
         streams, subscriptions, workflows and their trackers are setup. '''
         num_workflows = len(self.test_config.get('workflows') or [])
@@ -127,10 +194,300 @@ class TestEngineConfiguration(object):
         nt.assert_equals(num_workflows, num_workflows_created)
 
 
+    def test_stream_compression_is_read_from_subscriptions(self):
+        ''' Tests that the streams with compression configured
+        are compressed '''
+        expected = {ss['event']: ss['compression'] for ss in self.test_config['subscriptions'] \
+                    if ss.get('compression')}
+        nt.assert_equals(expected, self.engine._get_stream_compression())
+        nt.assert_not_equals({}, expected)
+
+
+    def test_engine_is_successfully_configured_in_parallel(self):
+        ''' Tests that the engine configures all lambdas, streams, subscriptions
+        and trackers when resources are set up in parallel '''
+        lambda_arns = {}
+        def create_or_update_function(name, *args, **kwargs):
+            lambda_arns[name] = "arn:lambda:%s" % name
+            return lambda_arns[name]
+        self.engine.awslambda.create_or_update_function.side_effect = create_or_update_function
+        self.engine.kinesis.get_or_create_stream.side_effect = lambda name, **kw: "arn:stream/%s" % name
+
+        # Create the child mocks before they are called from many threads
+        self.engine.awslambda.subscribe_to_stream.return_value = None
+        self.engine.cwlogs.create_log_group.return_value = None
+
+        self.engine.configure(workers=4)
+
+        num_lambdas = len(self.test_config.get('lambdas') or [])
+        num_trackers = len(self.test_config.get('workflows') or [])
+        num_subscriptions = len(self.test_config.get('subscriptions') or [])
+        num_tracked_events = sum(len(w['flow']) for w in self.test_config.get('workflows') or [])
+        nt.assert_equals(num_lambdas + num_trackers, self.engine.awslambda.create_or_update_function.call_count)
+        nt.assert_equals(num_subscriptions, self.engine.kinesis.get_or_create_stream.call_count)
+        nt.assert_equals(num_trackers, self.engine.cwlogs.create_log_group.call_count)
+        self.engine.awslambda.subscribe_to_stream.assert_any_call("arn:lambda:lambda_parser",
+                                                                  "arn:stream/FileDownloaded", ANY)
+        nt.assert_equals(2 + num_tracked_events, self.engine.awslambda.subscribe_to_stream.call_count)
+
+
+class TestEngineReadiness(object):
+    ''' Tests that streams become ready as configure sets them up '''
+
+    @patch('xflow.core.Engine.setup_lambda')
+    @patch('xflow.core.Engine.setup_kinesis')
+    @patch('xflow.core.Engine.setup_cloud_watch_logs')
+    def setup(self, cwlogs_mock, kinesis_mock, lambda_mock):
+        self.engine = Engine(config_dir + "/valid.yaml")
+        self.engine.awslambda, self.engine.kinesis, self.engine.cwlogs
+
+    def test_streams_are_ready_without_configure(self):
+        nt.assert_true(self.engine.is_ready())
+        nt.assert_true(self.engine.is_stream_ready("FileUploaded"))
+
+    def test_streams_become_ready_during_background_configure(self):
+        started, proceed = threading.Event(), threading.Event()
+        def setup_function(l):
+            started.set()
+            proceed.wait(5)
+            return "arn:lambda:%s" % l['name']
+        self.engine.setup_function = setup_function
+
+        thread = self.engine.configure_in_background()
+        started.wait(5)
+        nt.assert_false(self.engine.is_ready())
+        # Streams are set up before the lambdas are deployed
+        nt.assert_true(self.engine.is_stream_ready("FileUploaded"))
+        proceed.set()
+        thread.join(5)
+        nt.assert_equals(core.CONFIGURE_DONE, self.engine.get_readiness()['status'])
+        nt.assert_true(self.engine.is_stream_ready("FileUploaded"))
+
+    def test_failed_configure_is_not_ready(self):
+        self.engine.kinesis.wait_for_streams.side_effect = Exception("streams not active")
+        thread = self.engine.configure_in_background()
+        thread.join(5)
+        readiness = self.engine.get_readiness()
+        nt.assert_false(readiness['ready'])
+        nt.assert_equals("streams not active", readiness['error'])
+        nt.assert_false(self.engine.is_stream_ready("FileUploaded"))
+
+
+class TestEngineIncrementalConfiguration(object):
+    ''' Tests that an incremental configure only sets up the resources
+    that changed since the last one '''
+
+    @patch('xflow.core.Engine.setup_lambda')
+    @patch('xflow.core.Engine.setup_kinesis')
+    @patch('xflow.core.Engine.setup_cloud_watch_logs')
+    def setup(self, cwlogs_mock, kinesis_mock, lambda_mock):
+        config_path = config_dir + "/valid.yaml"
+        self.test_config = utils.parse_yaml(utils.read_file(config_path))
+        self.dir = tempfile.mkdtemp()
+        self.engine = Engine(config_path)
+        self.engine.manifest_path = os.path.join(self.dir, 'valid.manifest.json')
+
+        functions = {}
+        def get_function_configuration(name):
+            return functions.get(name)
+        def deploy_function(name, *args, **kwargs):
+            functions[name] = {'FunctionArn': 'arn:lambda:%s' % name, 'CodeSha256': 'sha'}
+            return functions[name]
+        awslambda = self.engine.awslambda
+        awslambda.get_function_configuration.side_effect = get_function_configuration
+        awslambda.deploy_function.side_effect = deploy_function
+        awslambda.set_concurrency.side_effect = lambda name, function, **kwargs: function['FunctionArn']
+        awslambda.get_function_settings.side_effect = \
+            lambda runtime, handler, description, layers=None, **options: \
+                [runtime, handler, description, layers or [], options]
+        self.engine.kinesis.get_or_create_stream.side_effect = lambda name, **kw: "arn:stream/%s" % name
+        self.code_digest = 'digest'
+        self.engine._get_code_digest = lambda l: self.code_digest
+
+    def teardown(self):
+        self.engine = None
+        shutil.rmtree(self.dir)
+
+    def _num_functions(self):
+        return len(self.test_config['lambdas']) + len(self.test_config['workflows'])
+
+    def test_manifest_is_written(self):
+        self.engine.configure(incremental=True)
+        nt.assert_equals(self._num_functions(), self.engine.awslambda.deploy_function.call_count)
+        with open(self.engine.manifest_path) as f:
+            resources = json.load(f)['resources']
+        nt.assert_equals('arn:lambda:lambda_parser', resources['lambda:lambda_parser']['arn'])
+        nt.assert_equals('arn:stream/FileDownloaded', resources['stream:FileDownloaded']['arn'])
+        nt.assert_true('subscription:FileDownloaded:lambda_parser' in resources)
+        nt.assert_true('tracker_subscription:compute_word_count:FileParsed' in resources)
+        nt.assert_true('log_group:compute_word_count' in resources)
+        nt.assert_equals(None, self.engine.manifest)
+
+    def test_unchanged_resources_are_skipped(self):
+        self.engine.configure(incremental=True)
+        awslambda, kinesis, cwlogs = self.engine.awslambda, self.engine.kinesis, self.engine.cwlogs
+        for m in [awslambda.deploy_function, awslambda.subscribe_to_stream,
+                  kinesis.get_or_create_stream, cwlogs.create_log_group]:
+            m.reset_mock()
+
+        self.engine.configure(incremental=True)
+        nt.assert_equals(0, awslambda.deploy_function.call_count)
+        nt.assert_equals(0, awslambda.subscribe_to_stream.call_count)
+        nt.assert_equals(0, kinesis.get_or_create_stream.call_count)
+        nt.assert_equals(0, cwlogs.create_log_group.call_count)
+
+    def test_only_changed_code_is_updated(self):
+        self.engine.configure(incremental=True)
+        self.engine.awslambda.deploy_function.reset_mock()
+        self.code_digest = 'changed'
+
+        self.engine.configure(incremental=True, workers=2)
+        nt.assert_equals(len(self.test_config['lambdas']), self.engine.awslambda.deploy_function.call_count)
+        self.engine.awslambda.deploy_function.assert_any_call('lambda_parser', 'python2.7', 'parse',
+                                                              description=ANY, update_code=True,
+                                                              update_configuration=False,
+                                                              layers=[], memory_size=512, timeout=10,
+                                                              zip_filename=None, s3_filename=None,
+                                                              local_filename=ANY, otherfiles=ANY)
+        self.engine.awslambda.set_concurrency.assert_any_call('lambda_parser', ANY,
+                                                              reserved_concurrency=20,
+                                                              provisioned_concurrency=2,
+                                                              clear_reserved=True,
+                                                              clear_provisioned=True)
+
+    def test_removed_concurrency_is_cleared(self):
+        self.engine.configure(incremental=True)
+        awslambda = self.engine.awslambda
+        awslambda.set_concurrency.assert_any_call('lambda_file_reader', ANY,
+                                                  reserved_concurrency=None, provisioned_concurrency=None,
+                                                  clear_reserved=False, clear_provisioned=False)
+        awslambda.set_concurrency.reset_mock()
+        for l in self.test_config['lambdas']:
+            if l['name'] == 'lambda_parser':
+                del l['reserved_concurrency'], l['provisioned_concurrency']
+        self.engine.config = self.test_config
+
+        self.engine.configure(incremental=True)
+        awslambda.set_concurrency.assert_called_once_with('lambda_parser', ANY,
+                                                          reserved_concurrency=None, provisioned_concurrency=None,
+                                                          clear_reserved=True, clear_provisioned=True)
+
+    def test_unchanged_streams_are_ready_while_lambdas_deploy(self):
+        self.engine.configure(incremental=True)
+        # As after a restart, nothing is ready until configure says so
+        self.engine.ready_streams = set()
+        started, proceed = threading.Event(), threading.Event()
+        def setup_function(l):
+            started.set()
+            proceed.wait(5)
+            return "arn:lambda:%s" % l['name']
+        self.engine.setup_function = setup_function
+        self.engine.awslambda.subscribe_to_stream.return_value = None
+        self.engine.cwlogs.create_log_group.return_value = None
+
+        thread = self.engine.configure_in_background(workers=8, incremental=True)
+        started.wait(5)
+        for _ in range(50):
+            if self.engine.is_stream_ready("FileUploaded"):
+                break
+            time.sleep(0.1)
+        nt.assert_false(self.engine.is_ready())
+        nt.assert_true(self.engine.is_stream_ready("FileUploaded"))
+        proceed.set()
+        thread.join(5)
+        nt.assert_true(self.engine.is_ready())
+
+    def test_resources_deleted_outside_of_xflow_are_recreated(self):
+        self.engine.configure(incremental=True)
+        awslambda, kinesis, cwlogs = self.engine.awslambda, self.engine.kinesis, self.engine.cwlogs
+        for m in [awslambda.subscribe_to_stream, kinesis.get_or_create_stream, cwlogs.create_log_group]:
+            m.reset_mock()
+        kinesis.stream_exists.side_effect = lambda name: name != "FileUploaded"
+        awslambda.get_event_source_mapping.side_effect = \
+            lambda function_arn, stream_arn: None if function_arn.endswith("lambda_parser") else {"UUID": "uuid"}
+        cwlogs.log_group_exists.return_value = False
+
+        plan = {c['resource']: c['action'] for c in self.engine.plan()}
+        nt.assert_equals(core.ACTION_CREATE, plan['stream:FileUploaded'])
+        nt.assert_equals(core.ACTION_CREATE, plan['subscription:FileDownloaded:lambda_parser'])
+        nt.assert_equals(core.ACTION_CREATE, plan['log_group:compute_word_count'])
+
+        self.engine.configure(incremental=True)
+        kinesis.get_or_create_stream.assert_called_once_with("FileUploaded", shard_count=ANY, wait=ANY)
+        awslambda.subscribe_to_stream.assert_called_once_with("arn:lambda:lambda_parser",
+                                                              "arn:stream/FileDownloaded", ANY)
+        nt.assert_equals(1, cwlogs.create_log_group.call_count)
+
+    def test_plan_lists_changed_subscriptions_as_updates(self):
+        self.engine.configure(incremental=True)
+        self.test_config['subscriptions'][0]['mapping'] = {'batch_size': 10}
+        self.engine.config = self.test_config
+        plan = {c['resource']: c['action'] for c in self.engine.plan()}
+        nt.assert_equals(core.ACTION_UPDATE, plan['subscription:FileUploaded:lambda_file_reader'])
+
+    def test_plan_lists_changes(self):
+        plan = {c['resource']: c['action'] for c in self.engine.plan()}
+        nt.assert_equals(core.ACTION_CREATE, plan['lambda:lambda_parser'])
+        nt.assert_equals(core.ACTION_CREATE, plan['stream:FileUploaded'])
+
+        self.engine.configure(incremental=True)
+        self.test_config['subscriptions'][0]['shards'] = 3
+        self.engine.config = self.test_config
+        plan = {c['resource']: c['action'] for c in self.engine.plan()}
+        nt.assert_equals(core.ACTION_UPDATE, plan.pop('stream:FileUploaded'))
+        nt.assert_equals(set([core.ACTION_NOOP]), set(plan.values()))
+
+
+class TestEngineLayers(object):
+    ''' Tests that the requirements of lambdas are published as shared layers '''
+
+    @patch('xflow.core.Engine.setup_lambda')
+    @patch('xflow.core.Engine.setup_kinesis')
+    @patch('xflow.core.Engine.setup_cloud_watch_logs')
+    def setup(self, cwlogs_mock, kinesis_mock, lambda_mock):
+        self.dir = tempfile.mkdtemp()
+        self.requirements = os.path.join(self.dir, 'requirements.txt')
+        utils.write_file(self.requirements, 'requests==2.18.4\n')
+        os.environ['XFLOW_ARTIFACT_CACHE_DIR'] = os.path.join(self.dir, 'artifacts')
+        self.engine = Engine(config_dir + "/valid.yaml")
+        for l in self.engine.config['lambdas']:
+            l['requirements'] = self.requirements
+        self.engine.awslambda.get_layer_version_arn.return_value = None
+        self.engine.awslambda.publish_layer_version.return_value = "arn:layer:deps:1"
+
+    def teardown(self):
+        del os.environ['XFLOW_ARTIFACT_CACHE_DIR']
+        shutil.rmtree(self.dir)
+
+    @patch('xflow.core.build_layer')
+    def test_layer_is_built_once_and_shared(self, build_layer_mock):
+        build_layer_mock.return_value = 'layer-zip'
+        self.engine.setup_lambdas()
+        nt.assert_equals(1, build_layer_mock.call_count)
+        nt.assert_equals(1, self.engine.awslambda.publish_layer_version.call_count)
+        for call in self.engine.awslambda.create_or_update_function.call_args_list:
+            nt.assert_equals(["arn:layer:deps:1"], call[1]['layers'])
+
+    @patch('xflow.core.build_layer')
+    def test_published_layer_is_reused(self, build_layer_mock):
+        self.engine.awslambda.get_layer_version_arn.return_value = "arn:layer:deps:3"
+        nt.assert_equals("arn:layer:deps:3", self.engine.setup_layer(self.requirements, 'python2.7'))
+        nt.assert_equals(0, build_layer_mock.call_count)
+        nt.assert_equals(0, self.engine.awslambda.publish_layer_version.call_count)
+
+    @patch('xflow.layers.subprocess.check_call')
+    def test_layer_is_built_for_the_lambda_platform(self, check_call_mock):
+        layers.build_layer(self.requirements, 'python2.7')
+        args = check_call_mock.call_args[0][0]
+        nt.assert_true('manylinux1_x86_64' in args)
+        nt.assert_true('--only-binary=:all:' in args)
+
+
 class TestEngineInitialization(object):
     ''' Tests that the engine is successfully initialized '''
 
-    def tests_init_is_successful(self):
+    @patch('xflow.core.RoleCache')
+    def tests_init_is_successful(self, role_cache_mock):
         ''' Tests that the engine is successfully initialized i.e.
         awslambda, awskinesis and awscwlogs are setup and initialized '''
         config_path = config_dir + "/valid.yaml"
@@ -141,6 +498,87 @@ class TestEngineInitialization(object):
         nt.assert_not_equals(engine.cwlogs, None)
 
 
+class TestEngineLazyServices(object):
+    ''' Tests that services are only set up once they are used '''
+
+    @patch('xflow.core.Engine.setup_lambda')
+    @patch('xflow.core.Engine.setup_kinesis')
+    @patch('xflow.core.Engine.setup_cloud_watch_logs')
+    def test_services_are_set_up_on_first_use(self, cwlogs_mock, kinesis_mock, lambda_mock):
+        engine = core.Engine(config_dir + "/valid.yaml")
+        nt.assert_equals(0, lambda_mock.call_count + kinesis_mock.call_count + cwlogs_mock.call_count)
+        engine.publish("FileUploaded", json.dumps({"execution_id": "ex1"}))
+        engine.kinesis
+        nt.assert_equals(1, kinesis_mock.call_count)
+        nt.assert_equals(0, lambda_mock.call_count + cwlogs_mock.call_count)
+        engine.close()
+
+
+class TestEngineRoleCache(object):
+    ''' Tests that the execution role is resolved by IAM at most once per TTL '''
+
+    @patch('xflow.core.Engine.setup_kinesis')
+    @patch('xflow.core.Engine.setup_cloud_watch_logs')
+    @patch('xflow.core.Lambda')
+    @patch('xflow.core.IAM')
+    @patch('xflow.core.RoleCache')
+    def test_cached_role_skips_iam(self, role_cache_mock, iam_mock, lambda_mock, cwlogs_mock, kinesis_mock):
+        iam_mock.get_access_key_id.return_value = "AKIAEXAMPLE"
+        role_cache_mock.return_value.get.return_value = "arn:role/lambda-execute"
+        core.Engine(config_dir + "/valid.yaml").awslambda
+        nt.assert_equals(0, iam_mock.call_count)
+        nt.assert_equals("arn:role/lambda-execute", lambda_mock.call_args[0][1])
+        nt.assert_equals(role_cache_mock.return_value, lambda_mock.call_args[1]['role_cache'])
+
+    @patch('xflow.core.Engine.setup_kinesis')
+    @patch('xflow.core.Engine.setup_cloud_watch_logs')
+    @patch('xflow.core.Lambda')
+    @patch('xflow.core.IAM')
+    @patch('xflow.core.RoleCache')
+    def test_resolved_role_is_cached(self, role_cache_mock, iam_mock, lambda_mock, cwlogs_mock, kinesis_mock):
+        iam_mock.get_access_key_id.return_value = "AKIAEXAMPLE"
+        role_cache_mock.return_value.get.return_value = None
+        iam_mock.return_value.get_or_create_role.return_value = "arn:role/lambda-execute"
+        core.Engine(config_dir + "/valid.yaml").awslambda
+        role_cache_mock.return_value.put.assert_called_once_with(ANY, "arn:role/lambda-execute")
+        role_key = role_cache_mock.return_value.put.call_args[0][0]
+        nt.assert_true(role_key.startswith("AKIAEXAMPLE:eu-west-1:lambda-execute:"))
+        iam_mock.return_value.get_or_create_role.assert_called_once_with(
+            role_name="lambda-execute",
+            failure_destinations=["arn:aws:sqs:eu-west-1:xxxxxxxxxxxx:FileDownloadedFailures"])
+
+    @patch('xflow.core.Engine.setup_kinesis')
+    @patch('xflow.core.Engine.setup_cloud_watch_logs')
+    @patch('xflow.core.Lambda')
+    @patch('xflow.core.IAM')
+    @patch('xflow.core.RoleCache')
+    def test_role_is_not_cached_without_credentials(self, role_cache_mock, iam_mock, lambda_mock, cwlogs_mock, kinesis_mock):
+        iam_mock.get_access_key_id.return_value = None
+        iam_mock.return_value.get_or_create_role.return_value = "arn:role/lambda-execute"
+        core.Engine(config_dir + "/valid.yaml").awslambda
+        nt.assert_equals(0, role_cache_mock.return_value.get.call_count)
+        nt.assert_equals(0, role_cache_mock.return_value.put.call_count)
+
+    @patch('xflow.core.Engine.setup_kinesis')
+    @patch('xflow.core.Engine.setup_cloud_watch_logs')
+    @patch('xflow.core.Lambda')
+    @patch('xflow.core.IAM')
+    @patch('xflow.core.RoleCache')
+    def test_plan_does_not_change_the_role(self, role_cache_mock, iam_mock, lambda_mock, cwlogs_mock, kinesis_mock):
+        iam_mock.get_access_key_id.return_value = None
+        iam_mock.return_value.get_role_arn.return_value = "arn:role/lambda-execute"
+        lambda_mock.return_value.get_function_configuration.return_value = None
+        engine = core.Engine(config_dir + "/valid.yaml")
+        engine._get_code_digest = lambda l: 'digest'
+        engine.plan()
+        iam_mock.return_value.get_role_arn.assert_called_once_with("lambda-execute")
+        nt.assert_equals(0, iam_mock.return_value.get_or_create_role.call_count)
+        nt.assert_equals("arn:role/lambda-execute", lambda_mock.call_args[0][1])
+        # The service used to configure resolves the role as usual
+        engine.awslambda
+        nt.assert_equals(1, iam_mock.return_value.get_or_create_role.call_count)
+
+
 class TestEnginePublishing(object):
     ''' Tests publishing to a stream '''
 
@@ -155,6 +593,39 @@ class TestEnginePublishing(object):
         num_publishes = engine.kinesis.publish.call_count
         nt.assert_equals(1, num_publishes)
 
+    @patch('xflow.core.Engine.setup_lambda')
+    @patch('xflow.core.Engine.setup_kinesis')
+    @patch('xflow.core.Engine.setup_cloud_watch_logs')
+    def test_publish_uses_producer_when_batching(self, cwlogs_mock, kinesis_mock, lambda_mock):
+        ''' Test data is buffered by the producer when batching is enabled
+        and flushed when the engine is closed '''
+        config_path = config_dir + "/valid.yaml"
+        engine = Engine(config_path)
+        engine.producer = Mock(errors={})
+        engine.producer.close.return_value = 0
+        engine.publish("test_stream", "test_data")
+        nt.assert_equals(0, engine.close())
+        nt.assert_equals(0, engine.kinesis.publish.call_count)
+        nt.assert_equals(1, engine.producer.put.call_count)
+        nt.assert_equals(1, engine.producer.close.call_count)
+
+
+    @patch('xflow.core.Engine.setup_lambda')
+    @patch('xflow.core.Engine.setup_kinesis')
+    @patch('xflow.core.Engine.setup_cloud_watch_logs')
+    def test_publish_lines_is_successful(self, cwlogs_mock, kinesis_mock, lambda_mock):
+        ''' Test every valid line is published and counted in the summary '''
+        config_path = config_dir + "/valid.yaml"
+        engine = Engine(config_path)
+        engine.kinesis.publish_batch.side_effect = lambda stream, records: \
+            [{"SequenceNumber": "1", "ShardId": "s1"} for r in records]
+        lines = ['{"execution_id": "ex%s"}\n' % i for i in range(10)] + ['\n', 'not json\n']
+        summary = engine.publish_lines("test_stream", lines)
+        nt.assert_equals(10, summary['records'])
+        nt.assert_equals(10, summary['published'])
+        nt.assert_equals(0, summary['failed'])
+        nt.assert_equals(1, summary['invalid'])
+
 
 class TestEngineWorkflowTracking(object):
     ''' Tests workflow tracking '''
@@ -202,6 +673,18 @@ class TestEngineWorkflowTracking(object):
         actual = self.engine.track(self.workflow_id, self.execution_id)
         nt.assert_equals(expected, actual)
 
+    def test_bucketed_workflow_is_tracked_with_filtered_events(self):
+        self.workflow['tracking'] = {'layout': 'bucketed', 'buckets': 8}
+        self.engine.config = self.test_config
+        self.engine.cwlogs.filter_log_events.return_value = []
+        self.engine.track(self.workflow_id, self.execution_id)
+        log_group_name = self.engine._generate_log_group_name(self.workflow_id)
+        self.engine.cwlogs.filter_log_events.assert_called_once_with(
+            log_group_name,
+            tracker.generate_bucket_log_stream_name(log_group_name, self.execution_id, 8),
+            '{ $.execution_id = "transaction-id-123" }')
+        nt.assert_equals(0, self.engine.cwlogs.get_log_events.call_count)
+
     def test_workflow_successfully_tracks_on_successful_execution(self):
         # Mock so that all events defined are received (and therefore logged)
         mocked_logged_events = [
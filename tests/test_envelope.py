@@ -0,0 +1,57 @@
+import base64
+import nose.tools as nt
+
+from xflow import envelope
+
+
+class TestEnvelope(object):
+
+    def test_aggregates_and_deaggregates_payloads(self):
+        payloads = ['{"execution_id": "ex%s"}' % i for i in range(10)]
+        records = envelope.aggregate(payloads)
+        nt.assert_equals(1, len(records))
+        data, indexes = records[0]
+        nt.assert_true(envelope.is_aggregated(data))
+        nt.assert_equals(range(10), indexes)
+        nt.assert_equals(payloads, envelope.deaggregate(data))
+
+    def test_splits_aggregated_records_at_max_bytes(self):
+        payloads = ["x" * 40] * 10
+        records = envelope.aggregate(payloads, max_bytes=100)
+        nt.assert_equals(5, len(records))
+        for data, indexes in records:
+            nt.assert_true(len(data) <= 100)
+        unpacked = [p for data, _ in records for p in envelope.deaggregate(data)]
+        nt.assert_equals(payloads, unpacked)
+
+    def test_does_not_wrap_single_payloads(self):
+        records = envelope.aggregate(["mydata"])
+        nt.assert_equals([("mydata", [0])], records)
+
+    def test_plain_records_are_returned_as_is(self):
+        nt.assert_equals(['{"foo": "bar"}'], envelope.deaggregate('{"foo": "bar"}'))
+
+    def test_decodes_records_of_lambda_event(self):
+        payloads = ['{"n": 1}', '{"n": 2}']
+        aggregated = envelope.aggregate(payloads)[0][0]
+        event = {
+            "Records": [
+                {"kinesis": {"data": base64.b64encode(aggregated)}},
+                {"kinesis": {"data": base64.b64encode('{"n": 3}')}}
+            ]
+        }
+        nt.assert_equals(payloads + ['{"n": 3}'], list(envelope.decode_records(event)))
+
+    def test_compresses_and_decodes_records(self):
+        payload = '{"words_arr": [%s]}' % ", ".join(['"word"'] * 100)
+        compressed = envelope.compress(payload)
+        nt.assert_true(len(compressed) < len(payload))
+        nt.assert_equals([payload], envelope.decode(compressed))
+
+    def test_decodes_compressed_aggregated_records(self):
+        payloads = ['{"execution_id": "ex1"}'] * 10
+        compressed = envelope.compress(envelope.aggregate(payloads)[0][0])
+        nt.assert_equals(payloads, envelope.decode(compressed))
+
+    def test_does_not_compress_when_not_smaller(self):
+        nt.assert_equals("{}", envelope.compress("{}"))
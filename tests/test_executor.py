@@ -0,0 +1,53 @@
+import threading
+import nose.tools as nt
+
+from xflow.executor import TaskGraph, TaskFailed
+
+
+class TestTaskGraph(object):
+
+    def test_runs_tasks_after_their_dependencies(self):
+        order = []
+        graph = TaskGraph(workers=4)
+        graph.add('a', lambda results: order.append('a') or 1)
+        graph.add('b', lambda results: order.append('b') or 2)
+        graph.add('c', lambda results: order.append('c') or results['a'] + results['b'],
+                  dependencies=['a', 'b'])
+        results = graph.run()
+        nt.assert_equals({'a': 1, 'b': 2, 'c': 3}, results)
+        nt.assert_equals('c', order[-1])
+
+    def test_runs_independent_tasks_concurrently(self):
+        barrier = threading.Event()
+        graph = TaskGraph(workers=2)
+        # Each task only finishes once the other one has started
+        graph.add('a', lambda results: barrier.set())
+        graph.add('b', lambda results: barrier.wait(1))
+        results = graph.run()
+        nt.assert_true(results['b'])
+
+    @nt.raises(TaskFailed)
+    def test_raises_error_when_task_fails(self):
+        def fail(results):
+            raise ValueError('boom')
+        graph = TaskGraph(workers=2)
+        graph.add('a', fail)
+        graph.add('b', lambda results: 1, dependencies=['a'])
+        graph.run()
+
+    def test_does_not_run_dependents_of_failed_tasks(self):
+        ran = []
+        def fail(results):
+            raise ValueError('boom')
+        graph = TaskGraph(workers=2)
+        graph.add('a', fail)
+        graph.add('b', lambda results: ran.append('b'), dependencies=['a'])
+        nt.assert_raises(TaskFailed, graph.run)
+        nt.assert_equals([], ran)
+
+    @nt.raises(TaskFailed)
+    def test_raises_error_on_dependency_cycle(self):
+        graph = TaskGraph(workers=2)
+        graph.add('a', lambda results: 1, dependencies=['b'])
+        graph.add('b', lambda results: 1, dependencies=['a'])
+        graph.run()
@@ -0,0 +1,40 @@
+import os
+import shutil
+import tempfile
+import nose.tools as nt
+
+from xflow.manifest import Manifest, fingerprint, file_digest
+
+
+class TestManifest(object):
+
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'test.manifest.json')
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+
+    def test_fingerprint_does_not_depend_on_key_order(self):
+        a = fingerprint({'runtime': 'python2.7', 'timeout': 3})
+        b = fingerprint({'timeout': 3, 'runtime': 'python2.7'})
+        nt.assert_equals(a, b)
+        nt.assert_not_equals(a, fingerprint({'timeout': 4, 'runtime': 'python2.7'}))
+
+    def test_file_digest_changes_with_contents(self):
+        filename = os.path.join(self.dir, 'lambda.py')
+        with open(filename, 'w') as f:
+            f.write('def handler(event, context): pass')
+        digest = file_digest([filename])
+        nt.assert_equals(digest, file_digest([filename]))
+        with open(filename, 'w') as f:
+            f.write('def handler(event, context): return 1')
+        nt.assert_not_equals(digest, file_digest([filename]))
+
+    def test_manifest_is_saved_and_loaded(self):
+        manifest = Manifest(self.path)
+        nt.assert_equals(None, manifest.get('stream:Test'))
+        manifest.set('stream:Test', {'arn': 'arn:stream/Test'})
+        manifest.save()
+        nt.assert_equals({'arn': 'arn:stream/Test'}, Manifest(self.path).get('stream:Test'))
+        nt.assert_false(os.path.exists(self.path + '.tmp'))
@@ -0,0 +1,106 @@
+import time
+import nose.tools as nt
+from mock import Mock
+
+from xflow.aws import KinesisStreamDoesNotExist
+from xflow.producer import BufferedProducer, ProducerClosed, \
+                           PublishPipeline, QueueFull
+
+
+class TestBufferedProducer(object):
+
+    def setup(self):
+        self.kinesis = Mock()
+        self.kinesis.publish_batch.side_effect = lambda stream, records: \
+            [{"SequenceNumber": "1", "ShardId": "s1"} for r in records]
+        self.producer = BufferedProducer(self.kinesis, max_records=3, linger_time=60)
+
+    def teardown(self):
+        self.producer.close()
+
+    def test_flushes_when_max_records_is_reached(self):
+        for i in range(3):
+            self.producer.put("test-stream", "data%s" % i)
+        self.kinesis.publish_batch.assert_called_once_with("test-stream", ["data0", "data1", "data2"])
+
+    def test_flushes_when_max_bytes_is_reached(self):
+        producer = BufferedProducer(self.kinesis, max_bytes=10, linger_time=60)
+        producer.put("test-stream", "0123456789")
+        nt.assert_equals(1, self.kinesis.publish_batch.call_count)
+        producer.close()
+
+    def test_buffers_per_stream_and_flushes_on_close(self):
+        self.producer.put("stream1", "data1")
+        self.producer.put("stream2", "data2")
+        nt.assert_equals(0, self.kinesis.publish_batch.call_count)
+        self.producer.close()
+        nt.assert_equals(2, self.kinesis.publish_batch.call_count)
+
+    def test_flushes_after_linger_time(self):
+        producer = BufferedProducer(self.kinesis, linger_time=0.01)
+        producer.put("test-stream", "data")
+        producer.flusher.join(0.2)
+        nt.assert_equals(1, self.kinesis.publish_batch.call_count)
+        producer.close()
+
+    def test_drops_records_of_missing_stream(self):
+        self.kinesis.publish_batch.side_effect = KinesisStreamDoesNotExist()
+        self.producer.put("test-stream", "data")
+        self.producer.flush()
+        nt.assert_equals(1, self.kinesis.publish_batch.call_count)
+        nt.assert_equals(1, self.producer.close())
+        nt.assert_true(self.producer.errors["test-stream"].startswith("KinesisStreamDoesNotExist"))
+
+    def test_counts_failed_records_on_close(self):
+        self.kinesis.publish_batch.side_effect = lambda stream, records: \
+            [{"ErrorCode": "InternalFailure", "ErrorMessage": "failed"}] + \
+            [{"SequenceNumber": "1", "ShardId": "s1"} for r in records[1:]]
+        self.producer.put("test-stream", "data1")
+        self.producer.put("test-stream", "data2")
+        nt.assert_equals(1, self.producer.close())
+
+    @nt.raises(ValueError)
+    def test_rejects_zero_linger_time(self):
+        BufferedProducer(self.kinesis, linger_time=0)
+
+    @nt.raises(ProducerClosed)
+    def test_raises_error_when_closed(self):
+        self.producer.close()
+        self.producer.put("test-stream", "data")
+
+
+class TestPublishPipeline(object):
+
+    def setup(self):
+        self.kinesis = Mock()
+        self.kinesis.partition_key.side_effect = lambda data: data
+        self.kinesis.publish_batch.side_effect = lambda stream, records: \
+            [{"SequenceNumber": r, "ShardId": "s1"} for r in records]
+        self.pipeline = PublishPipeline(self.kinesis, workers=2, queue_size=10)
+
+    def teardown(self):
+        self.pipeline.close()
+
+    def test_publishes_submitted_records(self):
+        pending = [self.pipeline.submit("test-stream", "data%s" % i) for i in range(5)]
+        for p in pending:
+            nt.assert_true(p.wait(1))
+        nt.assert_equals(["data%s" % i for i in range(5)], [p.result["SequenceNumber"] for p in pending])
+
+    def test_publishes_queued_records_on_close(self):
+        pending = self.pipeline.submit("test-stream", "data")
+        self.pipeline.close()
+        nt.assert_true(pending.done.is_set())
+
+    def test_reports_missing_stream(self):
+        self.kinesis.publish_batch.side_effect = KinesisStreamDoesNotExist()
+        pending = self.pipeline.submit("test-stream", "data")
+        pending.wait(1)
+        nt.assert_true(isinstance(pending.error, KinesisStreamDoesNotExist))
+
+    @nt.raises(QueueFull)
+    def test_raises_error_when_queue_is_full(self):
+        self.kinesis.publish_batch.side_effect = lambda stream, records: \
+            time.sleep(0.2) or [{"SequenceNumber": "1", "ShardId": "s1"} for r in records]
+        for i in range(20):
+            self.pipeline.submit("test-stream", "data")
@@ -0,0 +1,45 @@
+import nose.tools as nt
+from mock import patch, Mock
+
+import botocore
+
+from xflow import readiness
+from xflow.readiness import ReadinessTimeout
+
+
+def client_error(code):
+    return botocore.exceptions.ClientError({"Error": {"Code": code, "Message": ""}}, "operation")
+
+
+class TestReadiness(object):
+
+    @patch('xflow.readiness.time.sleep')
+    def test_retries_until_call_succeeds(self, sleep_mock):
+        func = Mock(side_effect=[client_error('InvalidParameterValueException'), 'created'])
+        nt.assert_equals('created', readiness.retry(func, ['InvalidParameterValueException']))
+        nt.assert_equals(2, func.call_count)
+        nt.assert_equals(1, sleep_mock.call_count)
+
+    @nt.raises(botocore.exceptions.ClientError)
+    def test_does_not_retry_other_errors(self):
+        func = Mock(side_effect=client_error('AccessDeniedException'))
+        readiness.retry(func, ['InvalidParameterValueException'])
+
+    @nt.raises(botocore.exceptions.ClientError)
+    def test_raises_last_error_after_deadline(self):
+        func = Mock(side_effect=client_error('InvalidParameterValueException'))
+        readiness.retry(func, ['InvalidParameterValueException'], timeout=0.05, base=0.01)
+
+    @patch('xflow.readiness.time.sleep')
+    def test_waits_for_all_resources_together(self, sleep_mock):
+        statuses = {'s1': ['CREATING', 'ACTIVE'], 's2': ['ACTIVE'], 's3': ['CREATING', 'CREATING', 'ACTIVE']}
+        def check(name):
+            status = statuses[name].pop(0)
+            return 'arn:%s' % name if status == 'ACTIVE' else None
+        results = readiness.wait_for_all(['s1', 's2', 's3'], check)
+        nt.assert_equals({'s1': 'arn:s1', 's2': 'arn:s2', 's3': 'arn:s3'}, results)
+        nt.assert_equals(2, sleep_mock.call_count)
+
+    @nt.raises(ReadinessTimeout)
+    def test_raises_timeout_for_pending_resources(self):
+        readiness.wait_for_all(['s1'], lambda name: None, timeout=0.05, base=0.01)
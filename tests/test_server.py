@@ -0,0 +1,189 @@
+import json
+from StringIO import StringIO
+import nose.tools as nt
+from mock import Mock, ANY
+
+from xflow import server
+from xflow.aws import KinesisStreamDoesNotExist
+from xflow.producer import PendingPublish, QueueFull
+
+
+def call(app, method, path, body=''):
+    ''' Calls the WSGI app and returns the status and decoded json body '''
+    environ = {
+        'REQUEST_METHOD': method,
+        'PATH_INFO': path,
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.input': StringIO(body),
+        'wsgi.errors': StringIO(),
+    }
+    path, _, query = path.partition('?')
+    environ['PATH_INFO'] = path
+    environ['QUERY_STRING'] = query
+    status = []
+    def start_response(s, headers, exc_info=None):
+        status.append(int(s.split()[0]))
+    resp = ''.join(app(environ, start_response))
+    try:
+        resp = json.loads(resp)
+    except ValueError:
+        pass
+    return status[0], resp
+
+
+def ndjson(*objs):
+    return '\n'.join(json.dumps(o) for o in objs)
+
+
+class TestPublish(object):
+
+    def setup(self):
+        self.engine = Mock()
+        self.engine.pipeline = None
+        self.engine.producer = None
+        self.engine.get_event_schemas.return_value = {
+            "Stream2": {"type": "object", "required": ["message"]}
+        }
+        self.app = server.create_app(self.engine)
+        self.body = json.dumps({"stream": "Stream1", "event": {"execution_id": "ex1"}})
+
+    def test_publishes_event(self):
+        status, resp = call(self.app, 'POST', '/publish', self.body)
+        nt.assert_equals(200, status)
+        self.engine.publish.assert_called_once_with("Stream1", json.dumps({"execution_id": "ex1"}))
+
+    def test_accepts_buffered_event(self):
+        self.engine.producer = Mock()
+        status, resp = call(self.app, 'POST', '/publish', self.body)
+        nt.assert_equals(202, status)
+
+    def test_validates_event_against_stream_schema(self):
+        body = json.dumps({"stream": "Stream2", "event": {"execution_id": "ex1"}})
+        status, resp = call(self.app, 'POST', '/publish', body)
+        nt.assert_equals(400, status)
+        nt.assert_equals(0, self.engine.publish.call_count)
+
+    def test_returns_not_found_when_stream_does_not_exist(self):
+        self.engine.publish.side_effect = KinesisStreamDoesNotExist("stream_name=Stream1")
+        status, resp = call(self.app, 'POST', '/publish', self.body)
+        nt.assert_equals(404, status)
+
+
+class TestPublishAsync(object):
+
+    def setup(self):
+        self.engine = Mock()
+        self.engine.get_event_schemas.return_value = {}
+        self.engine.ack_timeout = 0.1
+        self.pending = PendingPublish("Stream1", "data")
+        self.engine.submit.return_value = self.pending
+        self.app = server.create_app(self.engine)
+        self.body = json.dumps({"stream": "Stream1", "event": {"execution_id": "ex1"}})
+
+    def test_accepts_event_without_waiting(self):
+        status, resp = call(self.app, 'POST', '/publish', self.body)
+        nt.assert_equals(202, status)
+        nt.assert_equals(0, self.engine.publish.call_count)
+
+    def test_waits_for_acknowledgement(self):
+        self.pending.set_result({"SequenceNumber": "1", "ShardId": "s1"})
+        status, resp = call(self.app, 'POST', '/publish?wait=true', self.body)
+        nt.assert_equals(200, status)
+        nt.assert_equals("1", resp['sequence_number'])
+
+    def test_times_out_waiting_for_acknowledgement(self):
+        status, resp = call(self.app, 'POST', '/publish?wait=true', self.body)
+        nt.assert_equals(504, status)
+
+    def test_returns_service_unavailable_when_queue_is_full(self):
+        self.engine.submit.side_effect = QueueFull()
+        status, resp = call(self.app, 'POST', '/publish', self.body)
+        nt.assert_equals(503, status)
+
+
+class TestPublishBatch(object):
+
+    def setup(self):
+        self.engine = Mock()
+        self.engine.get_event_schemas.return_value = {
+            "Stream3": {"type": "object", "required": ["message"]}
+        }
+        self.engine.publish_batch.side_effect = lambda stream, records: \
+            [{"SequenceNumber": "1", "ShardId": "s1"} for r in records]
+        self.app = server.create_app(self.engine)
+
+    def test_publishes_lines_grouped_by_stream(self):
+        body = ndjson({"stream": "Stream1", "event": {"execution_id": "ex1"}},
+                      {"stream": "Stream2", "event": {"execution_id": "ex1"}},
+                      {"stream": "Stream1", "event": {"execution_id": "ex2"}})
+        status, resp = call(self.app, 'POST', '/publish/batch', body)
+        nt.assert_equals(200, status)
+        nt.assert_equals(3, resp['published'])
+        nt.assert_equals([1, 2, 3], [r['line'] for r in resp['results']])
+        nt.assert_equals(2, self.engine.publish_batch.call_count)
+
+    def test_reports_invalid_lines(self):
+        body = ndjson({"stream": "Stream1", "event": {"execution_id": "ex1"}},
+                      {"stream": "Stream1", "event": {}}) + '\n{not json'
+        status, resp = call(self.app, 'POST', '/publish/batch', body)
+        nt.assert_equals(200, status)
+        nt.assert_equals(1, resp['published'])
+        nt.assert_equals(2, resp['failed'])
+        nt.assert_equals(['ok', 'error', 'error'], [r['status'] for r in resp['results']])
+
+    def test_reports_lines_not_matching_stream_schema(self):
+        body = ndjson({"stream": "Stream3", "event": {"execution_id": "ex1", "message": "m"}},
+                      {"stream": "Stream3", "event": {"execution_id": "ex1"}})
+        status, resp = call(self.app, 'POST', '/publish/batch', body)
+        nt.assert_equals(['ok', 'error'], [r['status'] for r in resp['results']])
+
+    def test_reports_failed_records(self):
+        self.engine.publish_batch.side_effect = [
+            [{"ErrorCode": "ProvisionedThroughputExceededException", "ErrorMessage": ""}]
+        ]
+        body = ndjson({"stream": "Stream1", "event": {"execution_id": "ex1"}})
+        status, resp = call(self.app, 'POST', '/publish/batch', body)
+        nt.assert_equals(1, resp['failed'])
+
+    def test_reports_missing_streams(self):
+        self.engine.publish_batch.side_effect = KinesisStreamDoesNotExist("stream_name=Stream1")
+        body = ndjson({"stream": "Stream1", "event": {"execution_id": "ex1"}})
+        status, resp = call(self.app, 'POST', '/publish/batch', body)
+        nt.assert_equals('error', resp['results'][0]['status'])
+
+
+class TestReadiness(object):
+
+    def setup(self):
+        self.engine = Mock()
+        self.engine.pipeline = None
+        self.engine.get_event_schemas.return_value = {}
+        self.app = server.create_app(self.engine)
+
+    def test_ready_when_configured(self):
+        self.engine.get_readiness.return_value = {'ready': True, 'status': 'configured'}
+        status, resp = call(self.app, 'GET', '/ready')
+        nt.assert_equals(200, status)
+
+    def test_not_ready_while_configuring(self):
+        self.engine.get_readiness.return_value = {'ready': False, 'status': 'configuring'}
+        status, resp = call(self.app, 'GET', '/ready')
+        nt.assert_equals(503, status)
+        nt.assert_equals('configuring', resp['status'])
+
+    def test_rejects_publish_to_stream_not_ready(self):
+        self.engine.is_stream_ready.return_value = False
+        body = json.dumps({"stream": "Stream1", "event": {"execution_id": "ex1"}})
+        status, resp = call(self.app, 'POST', '/publish', body)
+        nt.assert_equals(503, status)
+        nt.assert_equals(0, self.engine.publish.call_count)
+
+    def test_rejects_batch_lines_to_streams_not_ready(self):
+        self.engine.is_stream_ready.side_effect = lambda stream: stream == "Stream1"
+        self.engine.publish_batch.return_value = [{"ShardId": "s1", "SequenceNumber": "1"}]
+        body = ndjson({"stream": "Stream1", "event": {"execution_id": "ex1"}},
+                      {"stream": "Stream2", "event": {"execution_id": "ex2"}})
+        status, resp = call(self.app, 'POST', '/publish/batch', body)
+        nt.assert_equals(200, status)
+        nt.assert_equals(['ok', 'error'], [r['status'] for r in resp['results']])
+        self.engine.publish_batch.assert_called_once_with("Stream1", ANY)
@@ -0,0 +1,132 @@
+import json
+import base64
+import botocore
+import nose.tools as nt
+from mock import patch, Mock
+
+from xflow import tracker
+
+
+def kinesis_record(stream, payload, arrival):
+    return {
+        "eventSourceARN": "arn:aws:kinesis:eu-west-1:xxxxxxxxxxxx:stream/%s" % stream,
+        "kinesis": {
+            "data": base64.b64encode(json.dumps(payload)),
+            "approximateArrivalTimestamp": arrival
+        }
+    }
+
+
+class TestTracker(object):
+
+    def setup(self):
+        self.event = {"Records": [
+            kinesis_record("FileParsed", {"execution_id": "ex1", "n": 2}, 1500000002.0),
+            kinesis_record("FileUploaded", {"execution_id": "ex2", "n": 1}, 1500000001.0),
+            kinesis_record("FileUploaded", {"execution_id": "ex1", "n": 1}, 1500000001.0),
+            kinesis_record("FileUploaded", {"n": 0}, 1500000000.0)
+        ]}
+        # Start every test from a cold container
+        tracker._config = tracker._logs = tracker._log_streams = None
+
+    def teardown(self):
+        tracker._config = tracker._logs = tracker._log_streams = None
+
+    def test_groups_payloads_by_execution(self):
+        executions, num_payloads, error_count = tracker.group_by_execution(self.event, "wf")
+        nt.assert_equals(4, num_payloads)
+        nt.assert_equals(0, error_count)
+        nt.assert_equals(["ex1", "ex2"], sorted(executions))
+        nt.assert_equals([1500000002000, 1500000001000], [e['timestamp'] for e in executions["ex1"]])
+        nt.assert_equals("FileParsed", json.loads(executions["ex1"][0]['message'])['event_name'])
+
+    def test_splits_log_events_at_limits(self):
+        log_events = [{"timestamp": i, "message": "x" * 100} for i in range(5)]
+        with patch('xflow.tracker.LOG_EVENTS_MAX_BYTES', 300):
+            batches = list(tracker.batch_log_events(log_events))
+        nt.assert_equals([2, 2, 1], [len(b) for b in batches])
+
+    @patch('xflow.tracker.boto3.client')
+    @patch('xflow.tracker.get_config')
+    def test_logs_every_execution_with_one_write(self, get_config_mock, client_mock):
+        get_config_mock.return_value = {"workflow_id": "wf", "log_group_name": "/xFlow/track/wf"}
+        logs = client_mock.return_value
+        logs.describe_log_streams.return_value = {"logStreams": [{}]}
+        logs.put_log_events.return_value = {"nextSequenceToken": "token"}
+
+        tracker.log(self.event, None)
+
+        nt.assert_equals(2, logs.create_log_stream.call_count)
+        nt.assert_equals(2, logs.put_log_events.call_count)
+        nt.assert_equals(0, logs.describe_log_streams.call_count)
+        writes = {c[1]['logStreamName']: c[1]['logEvents'] for c in logs.put_log_events.call_args_list}
+        ex1_events = writes["/xFlow/track/wf/ex1"]
+        nt.assert_equals([1500000001000, 1500000002000], [e['timestamp'] for e in ex1_events])
+        nt.assert_equals(["FileUploaded", "FileParsed"],
+                         [json.loads(e['message'])['event_name'] for e in ex1_events])
+
+    @patch('xflow.tracker.boto3.client')
+    @patch('xflow.tracker.get_config')
+    def test_warm_invocations_reuse_streams_and_tokens(self, get_config_mock, client_mock):
+        get_config_mock.return_value = {"workflow_id": "wf", "log_group_name": "/xFlow/track/wf"}
+        logs = client_mock.return_value
+        logs.put_log_events.return_value = {"nextSequenceToken": "token1"}
+        tracker.log(self.event, None)
+        logs.reset_mock()
+        logs.put_log_events.return_value = {"nextSequenceToken": "token2"}
+
+        tracker.log(self.event, None)
+
+        nt.assert_equals(1, client_mock.call_count)
+        nt.assert_equals(0, logs.create_log_stream.call_count)
+        nt.assert_equals(0, logs.describe_log_streams.call_count)
+        for c in logs.put_log_events.call_args_list:
+            nt.assert_equals("token1", c[1]['sequenceToken'])
+
+    def test_token_is_refreshed_when_invalid(self):
+        logs = Mock()
+        error = {"Error": {"Code": "InvalidSequenceTokenException"}, "expectedSequenceToken": "expected"}
+        logs.put_log_events.side_effect = [botocore.exceptions.ClientError(error, "PutLogEvents"),
+                                           {"nextSequenceToken": "next"}]
+        log_streams = tracker.LogStreamCache()
+        log_streams.put("stream", "stale")
+        ok = tracker.try_log_to_stream(logs, log_streams, "group", "stream",
+                                       [{"timestamp": 1, "message": "{}"}])
+        nt.assert_true(ok)
+        nt.assert_equals("expected", logs.put_log_events.call_args[1]['sequenceToken'])
+        nt.assert_equals("next", log_streams.get("stream"))
+        nt.assert_equals(0, logs.describe_log_streams.call_count)
+
+    def test_least_recently_used_streams_are_evicted(self):
+        log_streams = tracker.LogStreamCache(max_size=2)
+        log_streams.put("a", "1")
+        log_streams.put("b", "2")
+        log_streams.get("a")
+        log_streams.put("c", "3")
+        nt.assert_true("a" in log_streams)
+        nt.assert_false("b" in log_streams)
+        nt.assert_true("c" in log_streams)
+
+    @patch('xflow.tracker.boto3.client')
+    @patch('xflow.tracker.get_config')
+    def test_bucketed_layout_writes_once_per_bucket(self, get_config_mock, client_mock):
+        get_config_mock.return_value = {"workflow_id": "wf", "log_group_name": "/xFlow/track/wf",
+                                        "layout": tracker.LAYOUT_BUCKETED, "buckets": 1}
+        logs = client_mock.return_value
+        logs.put_log_events.return_value = {"nextSequenceToken": "token"}
+
+        tracker.log(self.event, None)
+
+        logs.create_log_stream.assert_called_once_with(logGroupName="/xFlow/track/wf",
+                                                       logStreamName="/xFlow/track/wf/bucket-0")
+        nt.assert_equals(1, logs.put_log_events.call_count)
+        log_events = logs.put_log_events.call_args[1]['logEvents']
+        nt.assert_equals([1500000001000, 1500000001000, 1500000002000], [e['timestamp'] for e in log_events])
+        nt.assert_equals(["ex1", "ex1", "ex2"], sorted(json.loads(e['message'])['execution_id'] for e in log_events))
+
+    def test_executions_are_hashed_into_buckets(self):
+        config = {"workflow_id": "wf", "log_group_name": "/xFlow/track/wf",
+                  "layout": tracker.LAYOUT_BUCKETED, "buckets": 4}
+        names = set(tracker.get_log_stream_name(config, "ex%s" % i) for i in range(100))
+        nt.assert_equals(set("/xFlow/track/wf/bucket-%s" % b for b in range(4)), names)
+        nt.assert_equals(tracker.get_log_stream_name(config, u"ex1"), tracker.get_log_stream_name(config, "ex1"))
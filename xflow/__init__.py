@@ -6,6 +6,7 @@
 
 import sys
 import json
+import signal
 import argparse
 import logging
 from logging.config import dictConfig
@@ -29,20 +30,29 @@ def _get_args():
     ''' Following are the usage options:
 
     xflow <CONFIG> [-v | --validate]
-    xflow <CONFIG> [-c | --configure]
+    xflow <CONFIG> [-c | --configure] [--workers <N>] [--incremental]
+    xflow <CONFIG> [--plan]
     xflow <CONFIG> [-p | --publish <STREAM> <DATA>]
+    xflow <CONFIG> [-p | --publish <STREAM> -]
+    xflow <CONFIG> [--publish-file <STREAM> <FILE>]
     xflow <CONFIG> [-t | --track <WORKFLOW_ID> <EXECUTION_ID>]
     xflow <CONFIG> [--log-level <LEVEL>]
-    xflow <CONFIG> [-s | --server]
+    xflow <CONFIG> [-s | --server] [--configure-mode <blocking|background|skip>]
 
     '''
     parser = argparse.ArgumentParser(prog='xflow', usage='%(prog)s CONFIG [options]', description='xFlow | A serverless workflow architecture.')
     parser.add_argument('CONFIG', type=str, help='Absolute path to config file')
     parser.add_argument('-v', action='store_true', help='Validates the config file')
     parser.add_argument('-c', action='store_true', help='Configures lambdas, streams and the subscriptions')
-    parser.add_argument('-p', type=str, nargs=2, metavar=("<STREAM>","<DATA>"), required=False, help='Publishes data to a stream')
+    parser.add_argument('-p', type=str, nargs=2, metavar=("<STREAM>","<DATA>"), required=False, help='Publishes data to a stream, reads NDJSON from stdin if DATA is -')
+    parser.add_argument('--publish-file', type=str, nargs=2, metavar=("<STREAM>","<FILE>"), required=False, help='Publishes every line of a NDJSON file to a stream')
     parser.add_argument('-t', type=str, nargs=2, metavar=("<WORKFLOW_ID>","<EXECUTION_ID>"), required=False, help='Tracks a workflow')
     parser.add_argument('-s', action='store_true', help='Run as server')
+    parser.add_argument('--configure-mode', type=str, default='blocking', choices=['blocking', 'background', 'skip'],
+                        help='Whether the server configures before serving, while serving or not at all')
+    parser.add_argument('--workers', type=int, required=False, help='Number of resources configured in parallel')
+    parser.add_argument('--incremental', action='store_true', help='Only configures resources that changed since the last incremental configure')
+    parser.add_argument('--plan', action='store_true', help='Prints the changes an incremental configure would make')
     parser.add_argument('--log-level', type=str, default='INFO', help='Setting log level [DEBUG|INFO|WARNING|ERROR|CRITICAL]')
     return vars(parser.parse_args())
 
@@ -72,6 +82,13 @@ def setup_logging(log_level):
     return logging.getLogger(__name__)
 
 
+def _stop_server(signum, frame):
+    ''' Stops the server on SIGTERM like on Ctrl-C, so that buffered events
+    are flushed before the process exits.
+    '''
+    raise KeyboardInterrupt()
+
+
 def main():
     args = _get_args()
     level = args['log_level'].upper()
@@ -98,28 +115,63 @@ def main():
 
     # Run as server
     if args['s']:
-        logging.info('Configuring xFlow Engine')
-        engine.configure()
+        mode = args['configure_mode']
+        if mode == 'blocking':
+            logging.info('Configuring xFlow Engine')
+            engine.configure(workers=args['workers'], incremental=args['incremental'])
+        elif mode == 'background':
+            logging.info('Configuring xFlow Engine in background')
+            engine.configure_in_background(workers=args['workers'], incremental=args['incremental'])
         app = server.create_app(engine)
         logging.info('Running as server')
-        app.run(host='0.0.0.0', port=80, server='waitress', loglevel='warning')
+        signal.signal(signal.SIGTERM, _stop_server)
+        try:
+            app.run(host='0.0.0.0', port=80, server='waitress', loglevel='warning')
+        finally:
+            engine.close()
+
+    # Print the changes an incremental configure would make
+    if args['plan']:
+        print json.dumps(engine.plan(), indent=4)
 
     # Configure the lambdas, streams and subscriptions
     if args['c']:
         logging.info('Configuring xFlow Engine')
-        engine.configure()
+        engine.configure(workers=args['workers'], incremental=args['incremental'])
         logging.info('xFlow Engine configured')
 
+    # Publish NDJSON lines from stdin or a file to stream
+    if (args['p'] and args['p'][1] == '-') or args['publish_file']:
+        stream, filename = args['publish_file'] or (args['p'][0], '-')
+        log.info('\n\n\nPublishing lines to stream: %s\n\nFile: %s' % (stream, filename))
+        try:
+            if filename == '-':
+                summary = engine.publish_lines(stream, sys.stdin)
+            else:
+                with open(filename) as f:
+                    summary = engine.publish_lines(stream, f)
+            engine.close()
+            print json.dumps(summary, indent=4)
+        except IOError as ex:
+            log.error('Publishing failed, error=%s' % str(ex))
+            sys.exit(1)
+        if summary['failed'] or summary['invalid']:
+            sys.exit(1)
+
     # Publish json data to stream
-    if args['p']:
+    elif args['p']:
         stream = args['p'][0]
         data = args['p'][1]
         log.info('\n\n\nPublishing to stream: %s\n\nData: %s' % (stream, data))
         try:
             engine.publish(stream, data)
-            log.info('Published')
+            failed = engine.close()
         except core.KinesisStreamDoesNotExist:
             sys.exit(1)
+        if failed:
+            log.error('Publishing failed, failed=%s' % failed)
+            sys.exit(1)
+        log.info('Published')
 
     # Track a workflow
     if args['t']:
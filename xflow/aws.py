@@ -1,17 +1,42 @@
-import os
+import io
+import re
 import time
 import json
+import uuid
+import urllib
+import hashlib
 import logging
+import threading
+import collections
 import boto3
 import botocore
+from boto3.s3.transfer import TransferConfig
 from datetime import datetime
 
 import utils
+import envelope
+import readiness
+from envelope import KINESIS_MAX_RECORD_BYTES
 
 
 log = logging.getLogger(__name__)
 
 
+# Artifacts of at least this size are uploaded through the staging bucket
+LAMBDA_STAGING_THRESHOLD_BYTES = 10 * 1024 * 1024
+LAMBDA_STAGING_PREFIX = 'xflow/artifacts/'
+LAMBDA_STAGING_TRANSFER_CONFIG = TransferConfig(multipart_threshold=8 * 1024 * 1024,
+                                                multipart_chunksize=8 * 1024 * 1024,
+                                                max_concurrency=8)
+
+LAMBDA_DEFAULT_MEMORY_SIZE = 128
+# The alias of the version of a function that has provisioned concurrency
+LAMBDA_PROVISIONED_ALIAS = 'provisioned'
+# The error message of a mapping whose function's role can not send to its
+# failure destination
+FAILURE_DESTINATION_ACCESS_DENIED = re.compile(r'permissions? to call \w+ on (SQS|SNS)', re.IGNORECASE)
+
+
 class MissingSourceCodeFileError(Exception):
     pass
 
@@ -28,13 +53,70 @@ class KinesisStreamDoesNotExist(Exception):
     pass
 
 
+class FailureDestinationAccessDenied(Exception):
+    pass
+
+
+# Settings of the event source mapping of a subscription. By default every
+# record is delivered on its own, starting from the oldest record, and a
+# failing batch is retried until its records expire.
+EVENT_SOURCE_MAPPING_DEFAULTS = {
+    'BatchSize': 1,
+    'MaximumBatchingWindowInSeconds': 0,
+    'ParallelizationFactor': 1,
+    'StartingPosition': 'TRIM_HORIZON',
+    'BisectBatchOnFunctionError': False,
+    'MaximumRetryAttempts': -1,
+    'MaximumRecordAgeInSeconds': -1
+}
+EVENT_SOURCE_MAPPING_UPDATABLE = ['BatchSize',
+                                  'MaximumBatchingWindowInSeconds',
+                                  'ParallelizationFactor',
+                                  'BisectBatchOnFunctionError',
+                                  'MaximumRetryAttempts',
+                                  'MaximumRecordAgeInSeconds',
+                                  'DestinationConfig']
+
+# Service limits of a single PutRecords call
+KINESIS_MAX_BATCH_RECORDS = 500
+KINESIS_MAX_BATCH_BYTES = 5 * 1024 * 1024
+
+KINESIS_MAX_PARTITION_KEY_LENGTH = 256
+
+# Write limits of a single shard
+KINESIS_SHARD_MAX_RECORDS_PER_SECOND = 1000
+KINESIS_SHARD_MAX_BYTES_PER_SECOND = 1024 * 1024
+
+# Errors after which a write is retried
+KINESIS_RETRYABLE_ERRORS = ['ProvisionedThroughputExceededException',
+                            'ThrottlingException',
+                            'KMSThrottlingException',
+                            'InternalFailure',
+                            'ServiceUnavailable']
+
+# Partition key strategies
+PARTITION_KEY_EXECUTION_ID = 'execution_id'
+PARTITION_KEY_FIELD = 'field'
+PARTITION_KEY_RANDOM = 'random'
+
+
 class Lambda(object):
 
     def __init__(self, region, role_arn,
                  aws_access_key_id=None, aws_secret_access_key=None,
                  subnet_ids=[], security_group_ids=[],
-                 timeout_time=5):
+                 timeout_time=5, artifact_cache=None, download_cache=None,
+                 staging_bucket=None, staging_threshold=LAMBDA_STAGING_THRESHOLD_BYTES,
+                 ready_timeout=readiness.DEFAULT_TIMEOUT, role_cache=None, role_cache_key=None):
         self.role_arn = role_arn
+        # The role cache the role ARN was taken from, if it was
+        self.role_cache = role_cache
+        self.role_cache_key = role_cache_key
+        self.ready_timeout = ready_timeout
+        self.staging_bucket = staging_bucket
+        self.staging_threshold = staging_threshold
+        self.artifact_cache = artifact_cache
+        self.download_cache = download_cache
         self.timeout_time = timeout_time
         self.subnet_ids = subnet_ids
         self.security_group_ids = security_group_ids
@@ -45,52 +127,196 @@ class Lambda(object):
                                       aws_access_key_id=aws_access_key_id,
                                       aws_secret_access_key=aws_secret_access_key)
 
-    def download_from_s3(self, bucket, key, destination):
-        with open(destination, 'wb') as f:
+    def download_from_s3(self, bucket, key):
+        ''' Returns the contents of an S3 object. With a download cache the
+        object is only downloaded if its ETag changed.
+        '''
+        if not self.download_cache:
+            f = io.BytesIO()
             self.s3.download_fileobj(bucket, key, f)
-        return os.path.realpath(f.name)
+            return f.getvalue()
+
+        cached = self.download_cache.get(bucket, key)
+        options = {'IfNoneMatch': cached[0]} if cached else {}
+        try:
+            response = self.s3.get_object(Bucket=bucket, Key=key, **options)
+        except botocore.exceptions.ClientError as ex:
+            if cached and ex.response['Error']['Code'] in ('304', 'NotModified'):
+                log.debug('S3 object not modified, bucket=%s, key=%s' % (bucket, key))
+                return cached[1]
+            raise ex
+        contents = response['Body'].read()
+        self.download_cache.put(bucket, key, response['ETag'], contents)
+        log.debug('S3 object downloaded, bucket=%s, key=%s, bytes=%s' % (bucket, key, len(contents)))
+        return contents
+
+    def stage_artifact(self, zip_blob):
+        ''' Uploads an archive to the staging bucket, unless an archive with
+        the same digest was uploaded before, and returns its key.
+        '''
+        key = LAMBDA_STAGING_PREFIX + hashlib.sha256(zip_blob).hexdigest() + '.zip'
+        try:
+            self.s3.head_object(Bucket=self.staging_bucket, Key=key)
+            log.debug('Artifact already staged, bucket=%s, key=%s' % (self.staging_bucket, key))
+            return key
+        except botocore.exceptions.ClientError as ex:
+            if ex.response['Error']['Code'] not in ('404', 'NoSuchKey', 'NotFound'):
+                raise ex
+        self.s3.upload_fileobj(io.BytesIO(zip_blob), self.staging_bucket, key,
+                               Config=LAMBDA_STAGING_TRANSFER_CONFIG)
+        log.info('Artifact staged, bucket=%s, key=%s, bytes=%s' % (self.staging_bucket, key, len(zip_blob)))
+        return key
+
+    def get_code(self, zip_blob):
+        ''' Returns the code of a function or layer. Large archives are
+        referenced from the staging bucket instead of being sent inline.
+        '''
+        if self.staging_bucket and len(zip_blob) >= self.staging_threshold:
+            return {'S3Bucket': self.staging_bucket, 'S3Key': self.stage_artifact(zip_blob)}
+        return {'ZipFile': zip_blob}
+
+    def package(self, files):
+        ''' Returns the zip archive of (name, contents) files, from the
+        artifact cache when there is one.
+        '''
+        if self.artifact_cache:
+            return self.artifact_cache.package(files)
+        return utils.zip_files(files)
+
+    def get_function_configuration(self, name):
+        ''' Returns the configuration of a function or None if it does not exist '''
+        try:
+            return self.awslambda.get_function_configuration(FunctionName=name)
+        except botocore.exceptions.ClientError as ex:
+            if ex.response['Error']['Code'] == 'ResourceNotFoundException':
+                return None
+            raise ex
+
+    def get_s3_etag(self, bucket, key):
+        return self.s3.head_object(Bucket=bucket, Key=key)['ETag']
+
+    def get_layer_version_arn(self, layer_name):
+        ''' Returns the ARN of the latest version of a layer or None if it
+        was never published.
+        '''
+        versions = self.awslambda.list_layer_versions(LayerName=layer_name)['LayerVersions']
+        if not versions:
+            return None
+        latest = max(versions, key=lambda v: v['Version'])
+        return latest['LayerVersionArn']
+
+    def publish_layer_version(self, layer_name, zip_blob, runtimes, description=None):
+        layer = self.awslambda.publish_layer_version(LayerName=layer_name,
+                                                     Description=description or layer_name,
+                                                     Content=self.get_code(zip_blob),
+                                                     CompatibleRuntimes=runtimes)
+        log.info('Layer published, layer=%s, version=%s' % (layer_name, layer['Version']))
+        return layer['LayerVersionArn']
+
+    def get_function_settings(self, runtime, handler, description=None, layers=None,
+                              memory_size=None, timeout=None,
+                              reserved_concurrency=None, provisioned_concurrency=None):
+        ''' Returns the settings a function is configured with '''
+        return {
+            'layers': layers or [],
+            'role': self.role_arn,
+            'runtime': runtime,
+            'handler': handler,
+            'description': description,
+            'memory_size': memory_size or LAMBDA_DEFAULT_MEMORY_SIZE,
+            'timeout': timeout or self.timeout_time,
+            'reserved_concurrency': reserved_concurrency,
+            'provisioned_concurrency': provisioned_concurrency,
+            'subnet_ids': self.subnet_ids,
+            'security_group_ids': self.security_group_ids
+        }
 
     def create_or_update_function(self, name, runtime, handler,
                                   description=None, zip_filename=None,
-                                  s3_filename=None, local_filename=None, otherfiles=None):
-        if zip_filename:
+                                  s3_filename=None, local_filename=None, otherfiles=None,
+                                  files=None, layers=None, memory_size=None, timeout=None,
+                                  reserved_concurrency=None, provisioned_concurrency=None):
+        function = self.deploy_function(name, runtime, handler,
+                                        description=description,
+                                        zip_filename=zip_filename,
+                                        s3_filename=s3_filename,
+                                        local_filename=local_filename,
+                                        otherfiles=otherfiles,
+                                        files=files,
+                                        layers=layers,
+                                        memory_size=memory_size,
+                                        timeout=timeout)
+        function_arn = self.set_concurrency(name, function,
+                                            reserved_concurrency=reserved_concurrency,
+                                            provisioned_concurrency=provisioned_concurrency)
+        return function_arn
+
+    def deploy_function(self, name, runtime, handler,
+                        description=None, zip_filename=None,
+                        s3_filename=None, local_filename=None, otherfiles=None,
+                        files=None, layers=None, memory_size=None, timeout=None,
+                        update_configuration=True, update_code=True):
+        ''' Creates or updates a function and returns its description.
+        Sources other than zip files are packaged in memory together with
+        `otherfiles` and the (name, contents) in `files`. `layers` are the
+        ARNs of the layer versions the function uses. An existing
+        function's configuration and code are only updated when
+        `update_configuration` and `update_code` are set.
+        '''
+        memory_size = memory_size or LAMBDA_DEFAULT_MEMORY_SIZE
+        timeout = timeout or self.timeout_time
+        extra_files = utils.read_files(otherfiles or []) + (files or [])
+        if not update_code:
+            code = None
+        elif zip_filename:
             zip_blob = utils.get_zip_contents(zip_filename)
-            code = {'ZipFile': zip_blob}
+            code = self.get_code(zip_blob)
             log.debug('source=zip, file=%s' % zip_filename)
         elif local_filename:
-            zip_filename = utils.zip_file(local_filename, otherfiles=otherfiles)
-            zip_blob = utils.get_zip_contents(zip_filename)
-            code = {'ZipFile': zip_blob}
+            zip_blob = self.package(utils.read_files([local_filename]) + extra_files)
+            code = self.get_code(zip_blob)
             log.debug('source=local, file=%s' % local_filename)
         elif s3_filename:
             bucket, key = utils.get_host(s3_filename), utils.get_path(s3_filename)
             if key.endswith('.zip'):
                 code = {'S3Bucket': bucket, 'S3Key': key}
             else:
-                filename = utils.get_resource(s3_filename)
-                local_filename = self.download_from_s3(bucket, key, filename)
-                zip_filename = utils.zip_file(local_filename, otherfiles=otherfiles)
-                zip_blob = utils.get_zip_contents(zip_filename)
-                code = {'ZipFile': zip_blob}
+                contents = self.download_from_s3(bucket, key)
+                zip_blob = self.package([(utils.get_resource(s3_filename), contents)] + extra_files)
+                code = self.get_code(zip_blob)
             log.debug('source=s3, file=%s' % s3_filename)
+        elif files:
+            zip_blob = self.package(extra_files)
+            code = self.get_code(zip_blob)
+            log.debug('source=memory, files=%s' % ','.join(name for name, _ in files))
         else:
             log.error('Missing source')
-            raise MissingSourceCodeFileError("Must provide either zip_filename, s3_filename or local_filename")
+            raise MissingSourceCodeFileError("Must provide either zip_filename, s3_filename, local_filename or files")
 
         try:
             _handler = '%s.%s' % (name, handler)
-            self.awslambda\
-                .update_function_configuration(FunctionName=name,
-                                               Role=self.role_arn,
-                                               Handler=_handler,
-                                               Description=description or name,
-                                               Timeout=self.timeout_time,
-                                               Runtime=runtime,
-                                               VpcConfig={
-                                                'SubnetIds': self.subnet_ids,
-                                                'SecurityGroupIds': self.security_group_ids
-                                               })
-            if zip_filename or local_filename:
+            if update_configuration:
+                function = self.awslambda\
+                    .update_function_configuration(FunctionName=name,
+                                                   Role=self.role_arn,
+                                                   Handler=_handler,
+                                                   Description=description or name,
+                                                   Timeout=timeout,
+                                                   MemorySize=memory_size,
+                                                   Runtime=runtime,
+                                                   Layers=layers or [],
+                                                   VpcConfig={
+                                                    'SubnetIds': self.subnet_ids,
+                                                    'SecurityGroupIds': self.security_group_ids
+                                                   })
+                # The code can only be updated once the configuration update
+                # has finished
+                if code:
+                    self.wait_until_updated(name)
+            if not code:
+                if not update_configuration:
+                    function = self.awslambda.get_function_configuration(FunctionName=name)
+            elif 'ZipFile' in code:
                 function = self.awslambda \
                                .update_function_code(FunctionName=name,
                                                      ZipFile=code['ZipFile'],
@@ -111,64 +337,186 @@ class Lambda(object):
                 # An error occurred (InvalidParameterValueException) when calling
                 # the CreateFunction operation: The role defined for the function
                 # cannot be assumed by Lambda.
-                lambda_created = False
-                last_ex = None
-                for i in range(1, 10):
-                    try:
-                        function = self.awslambda \
-                                       .create_function(FunctionName=name,
-                                                        Runtime=runtime,
-                                                        Role=self.role_arn,
-                                                        Handler=_handler,
-                                                        Description=description or name,
-                                                        Timeout=self.timeout_time,
-                                                        Publish=True,
-                                                        Code=code,
-                                                        VpcConfig={
-                                                         'SubnetIds': self.subnet_ids,
-                                                         'SecurityGroupIds': self.security_group_ids
-                                                        })
-                        log.info("Lambda created, lambda=%s" % name)
-                        lambda_created = True
-                        break
-                    except botocore.exceptions.ClientError as exx:
-                        if exx.response['Error']['Code'] == 'InvalidParameterValueException':
-                            log.info('Retrying to create lambda, lambda=%s ...' % name)
-                            time.sleep(3)
-                            last_ex = exx
-                        else:
-                            raise exx
-                if not lambda_created:
-                    raise last_ex
+                create_function = lambda: self.awslambda \
+                                              .create_function(FunctionName=name,
+                                                               Runtime=runtime,
+                                                               Role=self.role_arn,
+                                                               Handler=_handler,
+                                                               Description=description or name,
+                                                               Timeout=timeout,
+                                                               MemorySize=memory_size,
+                                                               Publish=True,
+                                                               Code=code,
+                                                               Layers=layers or [],
+                                                               VpcConfig={
+                                                                'SubnetIds': self.subnet_ids,
+                                                                'SecurityGroupIds': self.security_group_ids
+                                                               })
+                # A cached role was created long ago, so it is not retried
+                retryable_errors = [] if self.role_cache else ['InvalidParameterValueException']
+                try:
+                    function = readiness.retry(create_function, retryable_errors,
+                                               timeout=self.ready_timeout,
+                                               description='lambda:%s' % name)
+                except botocore.exceptions.ClientError as ex:
+                    self._evict_role(ex)
+                    raise ex
+                log.info("Lambda created, lambda=%s" % name)
             else:
+                self._evict_role(ex)
                 raise ex
 
-        function_arn = function['FunctionArn']
-        return function_arn
+        return function
+
+    def _evict_role(self, ex):
+        ''' Removes a cached role ARN that Lambda rejected, so that the next
+        run resolves the role with IAM again.
+        '''
+        if self.role_cache and ex.response['Error']['Code'] == 'InvalidParameterValueException' \
+                and 'role' in (ex.response['Error'].get('Message') or '').lower():
+            self.role_cache.remove(self.role_cache_key)
+            log.warning('Evicted cached role, role=%s, error=%s' % (self.role_arn, str(ex)))
+
+    def wait_until_updated(self, name):
+        ''' Waits until the last update of a function has finished '''
+        readiness.wait(self.awslambda.get_waiter('function_updated'),
+                       timeout=self.ready_timeout,
+                       description='lambda:%s' % name,
+                       FunctionName=name)
+
+    def wait_until_active(self, name):
+        ''' Waits until a function left the pending state it is created in,
+        which can take over a minute for functions in a VPC.
+        '''
+        readiness.wait(self.awslambda.get_waiter('function_active'),
+                       timeout=self.ready_timeout,
+                       description='lambda:%s' % name,
+                       FunctionName=name)
 
-    def subscribe_to_stream(self, function_arn, stream_arn):
+    def set_concurrency(self, name, function, reserved_concurrency=None, provisioned_concurrency=None,
+                        clear_reserved=False, clear_provisioned=False):
+        ''' Reserves concurrency for a function and keeps instances of its
+        latest version initialized when it has `provisioned_concurrency`.
+        Concurrency that is not given is left as is, unless `clear_reserved`
+        or `clear_provisioned` are set to remove what was set before.
+        Provisioned concurrency only applies to invocations of the alias that
+        points to that version, so the ARN to invoke is returned: the ARN of
+        the alias or else the function's.
+        '''
+        if reserved_concurrency is not None:
+            self.awslambda.put_function_concurrency(FunctionName=name,
+                                                    ReservedConcurrentExecutions=reserved_concurrency)
+        elif clear_reserved:
+            self.awslambda.delete_function_concurrency(FunctionName=name)
+        if not provisioned_concurrency:
+            if clear_provisioned:
+                try:
+                    self.awslambda.delete_provisioned_concurrency_config(FunctionName=name,
+                                                                         Qualifier=LAMBDA_PROVISIONED_ALIAS)
+                except botocore.exceptions.ClientError as ex:
+                    if ex.response['Error']['Code'] != 'ResourceNotFoundException':
+                        raise ex
+            return function['FunctionArn']
+
+        # A version can only be published once a created function is active
+        # and the last update has finished
+        self.wait_until_active(name)
+        self.wait_until_updated(name)
+        version = self.awslambda.publish_version(FunctionName=name)['Version']
+        try:
+            alias = self.awslambda.update_alias(FunctionName=name,
+                                                Name=LAMBDA_PROVISIONED_ALIAS,
+                                                FunctionVersion=version)
+        except botocore.exceptions.ClientError as ex:
+            if ex.response['Error']['Code'] != 'ResourceNotFoundException':
+                raise ex
+            alias = self.awslambda.create_alias(FunctionName=name,
+                                                Name=LAMBDA_PROVISIONED_ALIAS,
+                                                FunctionVersion=version)
+        self.awslambda.put_provisioned_concurrency_config(FunctionName=name,
+                                                          Qualifier=LAMBDA_PROVISIONED_ALIAS,
+                                                          ProvisionedConcurrentExecutions=provisioned_concurrency)
+        log.info('Lambda concurrency provisioned, lambda=%s, version=%s, concurrency=%s' \
+                    % (name, version, provisioned_concurrency))
+        return alias['AliasArn']
+
+    def get_event_source_mapping(self, function_arn, stream_arn):
+        response = self.awslambda.list_event_source_mappings(EventSourceArn=stream_arn,
+                                                             FunctionName=function_arn)
+        mappings = response.get('EventSourceMappings') or []
+        return mappings[0] if mappings else None
+
+    def update_event_source_mapping(self, function_arn, stream_arn, settings):
+        ''' Updates the mapping of a function to a stream where it differs
+        from `settings`. The starting position of an existing mapping can not
+        be changed.
+        '''
+        mapping = self.get_event_source_mapping(function_arn, stream_arn)
+        if not mapping:
+            return
+        changes = {k: v for k, v in settings.items()
+                   if k in EVENT_SOURCE_MAPPING_UPDATABLE and mapping.get(k) != v}
+        # A destination that is no longer configured is removed
+        destination = (mapping.get('DestinationConfig') or {}).get('OnFailure') or {}
+        if 'DestinationConfig' not in settings and destination.get('Destination'):
+            changes['DestinationConfig'] = {'OnFailure': {}}
+        if not changes:
+            log.info('Subscription unchanged, function=%s, stream=%s' % (function_arn, stream_arn))
+            return
+        # A mapping that is still being created or updated is in use and
+        # can not be updated until it settles.
+        update_mapping = lambda: self.awslambda.update_event_source_mapping(UUID=mapping['UUID'], **changes)
+        readiness.retry(update_mapping, ['ResourceInUseException'],
+                        timeout=self.ready_timeout,
+                        description='subscription:%s' % function_arn)
+        log.info('Subscription updated, function=%s, stream=%s, changes=%s' % (function_arn, stream_arn, changes))
+
+    def remove_stale_subscriptions(self, function_arn, stream_arn):
+        ''' Deletes the mappings from a stream to other versions or aliases of
+        a function, e.g. after it moved to or from its provisioned alias.
+        '''
+        unqualified_arn = utils.get_unqualified_arn(function_arn)
+        response = self.awslambda.list_event_source_mappings(EventSourceArn=stream_arn)
+        for mapping in response.get('EventSourceMappings') or []:
+            if mapping['FunctionArn'] != function_arn and \
+               utils.get_unqualified_arn(mapping['FunctionArn']) == unqualified_arn:
+                self.awslambda.delete_event_source_mapping(UUID=mapping['UUID'])
+                log.info('Subscription removed, function=%s, stream=%s' % (mapping['FunctionArn'], stream_arn))
+
+    def subscribe_to_stream(self, function_arn, stream_arn, settings=None):
+        ''' Creates the event source mapping of a function to a stream, or
+        updates it in place when it exists with other settings.
+        '''
+        settings = dict(EVENT_SOURCE_MAPPING_DEFAULTS, **(settings or {}))
         # Once the role policies are attached, it takes time until AWS fully
         # propagates it to its regions. During this time we might get an
         # InvalidParameterValueException so we need to retry.
-        for i in range(1, 10):
+        def create_mapping():
             try:
-                self.awslambda \
-                    .create_event_source_mapping(EventSourceArn=stream_arn,
-                                                 FunctionName=function_arn,
-                                                 BatchSize=1,
-                                                 StartingPosition='TRIM_HORIZON')
-                log.info('Subscription created, function=%s, stream=%s' % (function_arn, stream_arn))
-                break
+                return self.awslambda.create_event_source_mapping(EventSourceArn=stream_arn,
+                                                                  FunctionName=function_arn,
+                                                                  **settings)
             except botocore.exceptions.ClientError as ex:
-                if ex.response['Error']['Code'] == 'InvalidParameterValueException':
-                    log.info('Retrying subscription, function=%s, stream=%s ...' % (function_arn, stream_arn))
-                    time.sleep(3)
-                elif ex.response['Error']['Code'] == 'ResourceConflictException':
-                    log.info('Subscription exists, function=%s, stream=%s' % (function_arn, stream_arn))
-                    break
-                else:
-                    log.error('Subscription failed, function=%s, stream=%s, error=%s' % (function_arn, stream_arn, str(ex)))
-                    raise ex
+                # Lambda reports a role that can not send to the failure
+                # destination with the same error, but that does not pass
+                if ex.response['Error']['Code'] == 'InvalidParameterValueException' and \
+                        FAILURE_DESTINATION_ACCESS_DENIED.search(ex.response['Error'].get('Message') or ''):
+                    raise FailureDestinationAccessDenied('function=%s, stream=%s, destination=%s, error=%s' \
+                        % (function_arn, stream_arn, (settings.get('DestinationConfig') or {}).get('OnFailure', {}).get('Destination'), str(ex)))
+                raise ex
+        try:
+            readiness.retry(create_mapping, ['InvalidParameterValueException'],
+                            timeout=self.ready_timeout,
+                            description='subscription:%s' % function_arn)
+            log.info('Subscription created, function=%s, stream=%s' % (function_arn, stream_arn))
+            self.remove_stale_subscriptions(function_arn, stream_arn)
+        except botocore.exceptions.ClientError as ex:
+            if ex.response['Error']['Code'] == 'ResourceConflictException':
+                log.info('Subscription exists, function=%s, stream=%s' % (function_arn, stream_arn))
+                self.update_event_source_mapping(function_arn, stream_arn, settings)
+            else:
+                log.error('Subscription failed, function=%s, stream=%s, error=%s' % (function_arn, stream_arn, str(ex)))
+                raise ex
 
 
 class IAM(object):
@@ -188,6 +536,11 @@ class IAM(object):
             },
         ]
     }
+    POLICY_LAMBDA_FAILURE_DESTINATIONS_NAME = "XFlowFailureDestinations"
+    FAILURE_DESTINATION_ACTIONS = {
+        'sqs': 'sqs:SendMessage',
+        'sns': 'sns:Publish'
+    }
     POLICY_ASSUME_LAMBDA_ROLE = {
         'Version': '2012-10-17',
         'Statement': {
@@ -206,6 +559,40 @@ class IAM(object):
                                 aws_access_key_id=aws_access_key_id,
                                 aws_secret_access_key=aws_secret_access_key)
 
+    @staticmethod
+    def get_access_key_id(aws_access_key_id=None, aws_secret_access_key=None):
+        ''' Returns the access key id of the credentials boto resolves, from
+        the arguments, the environment, a profile or the instance, or None if
+        there are no credentials. It identifies the credentials, and so the
+        account, without calling AWS.
+        '''
+        session = boto3.session.Session(aws_access_key_id=aws_access_key_id,
+                                        aws_secret_access_key=aws_secret_access_key)
+        credentials = session.get_credentials()
+        return credentials.access_key if credentials else None
+
+    def get_attached_role_policies(self, role_name):
+        ''' Returns the ARNs of the managed policies attached to a role '''
+        policy_arns = set()
+        paginator = self.iam.get_paginator('list_attached_role_policies')
+        for page in paginator.paginate(RoleName=role_name):
+            policy_arns.update(p['PolicyArn'] for p in page['AttachedPolicies'])
+        return policy_arns
+
+    def get_role_policy(self, role_name, policy_name):
+        ''' Returns the document of an inline policy of a role or None '''
+        try:
+            policy = self.iam.get_role_policy(RoleName=role_name, PolicyName=policy_name)
+        except botocore.exceptions.ClientError as ex:
+            if ex.response['Error']['Code'] == 'NoSuchEntity':
+                return None
+            raise ex
+        document = policy['PolicyDocument']
+        # The document is returned url encoded by older API versions
+        if isinstance(document, basestring):
+            document = json.loads(urllib.unquote(document))
+        return document
+
     def attach_role_policy(self, role_name, policy_arn):
         self.iam.attach_role_policy(RoleName=role_name, PolicyArn=policy_arn)
         log.info('Attached policy, policy=%s, role=%s' % (policy_arn, role_name))
@@ -216,65 +603,488 @@ class IAM(object):
                                  PolicyDocument=policy_document)
         log.info("Added inline Policy, role=%s, policy=%s" % (role_name, policy_name))
 
-    def get_or_create_role(self, role_name='lambda-execute'):
+    @staticmethod
+    def get_failure_destinations_policy(destinations):
+        ''' Returns the policy that allows sending to the SQS queues and SNS
+        topics of `destinations`.
+        '''
+        resources = collections.defaultdict(set)
+        for destination in destinations:
+            service = destination.split(':')[2]
+            resources[IAM.FAILURE_DESTINATION_ACTIONS[service]].add(destination)
+        return {
+            'Version': '2012-10-17',
+            'Statement': [
+                {
+                  "Effect": "Allow",
+                  "Action": [action],
+                  "Resource": sorted(resources[action])
+                } for action in sorted(resources)
+            ]
+        }
+
+    def get_role_arn(self, role_name):
+        ''' Returns the ARN of the role or None if it does not exist '''
+        try:
+            return self.iam.get_role(RoleName=role_name)['Role']['Arn']
+        except botocore.exceptions.ClientError as ex:
+            if ex.response['Error']['Code'] == 'NoSuchEntity':
+                return None
+            raise ex
+
+    def get_or_create_role(self, role_name='lambda-execute', failure_destinations=None):
+        ''' Returns the ARN of the role, creating it if it does not exist.
+        Policies are only attached or put when the role is missing them. The
+        role is allowed to send to the `failure_destinations` of mappings.
+        '''
+        attached_policies = set()
+        inline_policy = None
+        destinations_policy = None
         try:
             role = self.iam.get_role(RoleName=role_name)
             log.info('Role exists, role=%s' % role_name)
+            attached_policies = self.get_attached_role_policies(role_name)
+            inline_policy = self.get_role_policy(role_name, IAM.POLICY_LAMBDA_KINESIS_PUBLISH_NAME)
+            destinations_policy = self.get_role_policy(role_name, IAM.POLICY_LAMBDA_FAILURE_DESTINATIONS_NAME)
         except botocore.exceptions.ClientError as ex:
             if ex.response['Error']['Code'] == 'NoSuchEntity':
                 role = self.iam.create_role(RoleName=role_name, AssumeRolePolicyDocument=json.dumps(IAM.POLICY_ASSUME_LAMBDA_ROLE))
+                readiness.wait(self.iam.get_waiter('role_exists'), description='role:%s' % role_name,
+                               RoleName=role_name)
                 log.info('Role created, role=%s' % role_name)
             else:
                 log.error('Creating role failed, role=%s, error=%s' % (role_name, str(ex)))
                 raise ex
 
 
-        self.attach_role_policy(role_name, IAM.POLICY_LAMBDA_KINESIS_EXECUTION_ROLE)
-        self.attach_role_policy(role_name, IAM.POLICY_LAMBDA_CWLOGS_READONLY_ROLE)
-        self.put_role_policy(role_name, IAM.POLICY_LAMBDA_KINESIS_PUBLISH_NAME, json.dumps(IAM.POLICY_LAMBDA_KINESIS_PUBLISH))
+        for policy_arn in [IAM.POLICY_LAMBDA_KINESIS_EXECUTION_ROLE, IAM.POLICY_LAMBDA_CWLOGS_READONLY_ROLE]:
+            if policy_arn not in attached_policies:
+                self.attach_role_policy(role_name, policy_arn)
+        if inline_policy != IAM.POLICY_LAMBDA_KINESIS_PUBLISH:
+            self.put_role_policy(role_name, IAM.POLICY_LAMBDA_KINESIS_PUBLISH_NAME, json.dumps(IAM.POLICY_LAMBDA_KINESIS_PUBLISH))
+        if failure_destinations:
+            policy = IAM.get_failure_destinations_policy(failure_destinations)
+            if destinations_policy != policy:
+                self.put_role_policy(role_name, IAM.POLICY_LAMBDA_FAILURE_DESTINATIONS_NAME, json.dumps(policy))
+        elif destinations_policy:
+            self.iam.delete_role_policy(RoleName=role_name, PolicyName=IAM.POLICY_LAMBDA_FAILURE_DESTINATIONS_NAME)
+            log.info("Removed inline Policy, role=%s, policy=%s" % (role_name, IAM.POLICY_LAMBDA_FAILURE_DESTINATIONS_NAME))
         role_arn = role['Role']['Arn']
         return role_arn
 
 
+class TokenBucket(object):
+    ''' A thread safe token bucket that refills at `rate` tokens per second
+    up to `capacity` tokens.
+    '''
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.tokens = self.capacity
+        self.updated_at = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self, amount=1):
+        ''' Takes `amount` tokens, blocking until they are available.
+        Returns the number of seconds waited.
+        '''
+        amount = min(amount, self.capacity)
+        waited = 0
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return waited
+                delay = (amount - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+class ShardMap(object):
+    ''' Maps partition keys to the open shards of a stream. The shards of
+    a stream are listed again every `refresh_time` seconds to follow
+    resharding.
+    '''
+
+    def __init__(self, kinesis, refresh_time=60):
+        self.kinesis = kinesis
+        self.refresh_time = refresh_time
+        self.shards = {}
+        self.lock = threading.Lock()
+
+    def get_shards(self, stream_name):
+        ''' Returns a list of (starting_hash_key, ending_hash_key, shard_id) '''
+        with self.lock:
+            shards, refreshed_at = self.shards.get(stream_name, (None, 0))
+            if shards is not None and time.time() - refreshed_at < self.refresh_time:
+                return shards
+
+        shards = []
+        for shard in self.kinesis.list_open_shards(stream_name):
+            hash_range = shard['HashKeyRange']
+            shards.append((int(hash_range['StartingHashKey']),
+                           int(hash_range['EndingHashKey']),
+                           shard['ShardId']))
+        with self.lock:
+            self.shards[stream_name] = (shards, time.time())
+        return shards
+
+    def get_shard_id(self, stream_name, partition_key):
+        ''' Returns the id of the shard a partition key is written to, or
+        None if the shards of the stream are unknown.
+        '''
+        hash_key = int(hashlib.md5(partition_key).hexdigest(), 16)
+        for start, end, shard_id in self.get_shards(stream_name):
+            if start <= hash_key <= end:
+                return shard_id
+        return None
+
+
+class ShardRateLimiter(object):
+    ''' Limits the records and bytes written to every shard of a stream to
+    the Kinesis write limits of 1000 records and 1 MB per second, so that
+    bursts are smoothed out on the client instead of being throttled.
+    '''
+
+    def __init__(self, shard_map):
+        self.shard_map = shard_map
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def _get_buckets(self, shard_id):
+        with self.lock:
+            if shard_id not in self.buckets:
+                self.buckets[shard_id] = (TokenBucket(KINESIS_SHARD_MAX_RECORDS_PER_SECOND),
+                                          TokenBucket(KINESIS_SHARD_MAX_BYTES_PER_SECOND))
+            return self.buckets[shard_id]
+
+    def acquire(self, stream_name, records):
+        ''' Waits until every shard targeted by `records`, a list of
+        (data, partition_key) tuples, has capacity for them.
+        Returns the number of seconds waited.
+        '''
+        usage = collections.defaultdict(lambda: [0, 0])
+        for data, partition_key in records:
+            shard_id = self.shard_map.get_shard_id(stream_name, partition_key)
+            if shard_id:
+                usage[shard_id][0] += 1
+                usage[shard_id][1] += len(data) + len(partition_key)
+        waited = 0
+        for shard_id, (count, size) in usage.items():
+            records_bucket, bytes_bucket = self._get_buckets(shard_id)
+            waited += records_bucket.acquire(count)
+            waited += bytes_bucket.acquire(size)
+        return waited
+
+
 class Kinesis(object):
 
     def __init__(self, region,
-                 aws_access_key_id=None, aws_secret_access_key=None):
+                 aws_access_key_id=None, aws_secret_access_key=None,
+                 partition_key=PARTITION_KEY_EXECUTION_ID,
+                 partition_key_field=None,
+                 rate_limit=False, aggregate=False, compression=None,
+                 max_retries=5):
+        self.partition_key_strategy = partition_key
+        self.partition_key_field = partition_key_field
+        self.max_retries = max_retries
+        self.aggregate = aggregate
+        self.compression = compression or {}
+        self.shard_map = ShardMap(self)
+        self.rate_limiter = ShardRateLimiter(self.shard_map) if rate_limit else None
+        self.stats = collections.Counter()
+        self.stats_lock = threading.Lock()
         self.kinesis = boto3.client('kinesis', region,
                                     aws_access_key_id=aws_access_key_id,
                                     aws_secret_access_key=aws_secret_access_key)
 
-    def get_or_create_stream(self, name):
+    def _count(self, name, value=1):
+        with self.stats_lock:
+            self.stats[name] += value
+
+    def get_stats(self):
+        ''' Returns the counters of published records, throttles, retries
+        and seconds spent waiting on the shard rate limits.
+        '''
+        with self.stats_lock:
+            return dict(self.stats)
+
+    def list_open_shards(self, stream_name):
+        shards = []
+        res = self.kinesis.list_shards(StreamName=stream_name)
+        while True:
+            shards.extend(s for s in res['Shards']
+                          if 'EndingSequenceNumber' not in s['SequenceNumberRange'])
+            if not res.get('NextToken'):
+                break
+            res = self.kinesis.list_shards(NextToken=res['NextToken'])
+        return shards
+
+    def _rate_limit(self, stream_name, records):
+        if not self.rate_limiter:
+            return
+        try:
+            waited = self.rate_limiter.acquire(stream_name, records)
+        except botocore.exceptions.ClientError as ex:
+            log.warning('Unable to rate limit, stream_name=%s, error=%s' % (stream_name, str(ex)))
+            return
+        if waited:
+            self._count('rate_limited_seconds', waited)
+
+    def partition_key(self, data):
+        ''' Returns the partition key of a record.
+
+        With the `execution_id` strategy (the default) the key is a hash of
+        the event's `execution_id` so that all events of an execution land on
+        the same shard and stay ordered. The `field` strategy does the same
+        for the configured `partition_key_field` and the `random` strategy
+        spreads records evenly over all shards. Records without the field
+        are keyed by a hash of their data.
+        '''
+        if self.partition_key_strategy == PARTITION_KEY_RANDOM:
+            return uuid.uuid4().hex
+
+        field = self.partition_key_field \
+                if self.partition_key_strategy == PARTITION_KEY_FIELD \
+                else 'execution_id'
+        try:
+            value = json.loads(data).get(field)
+        except (ValueError, AttributeError):
+            value = None
+        if value is None:
+            value = data
+        elif not isinstance(value, basestring):
+            value = json.dumps(value)
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        return hashlib.md5(value).hexdigest()
+
+    def _get_resharding_steps(self, open_shard_count, shard_count):
+        ''' Returns the shard counts to step through to reshard from
+        `open_shard_count` to `shard_count`. Uniform scaling can at most
+        double or halve the open shards in a single update.
+        '''
+        steps = []
+        count = open_shard_count
+        while count != shard_count:
+            if shard_count > count:
+                count = min(shard_count, count * 2)
+            else:
+                count = max(shard_count, (count + 1) // 2)
+            steps.append(count)
+        return steps
+
+    def _update_shard_count(self, name, shard_count):
+        ''' Reshards the stream to `shard_count` open shards, stepping
+        through intermediate counts and waiting until the stream is active
+        again after each update, so that the stream has the requested shards
+        when this returns.
+        '''
+        summary = self.kinesis.describe_stream_summary(StreamName=name)
+        open_shard_count = summary['StreamDescriptionSummary']['OpenShardCount']
+        for target_shard_count in self._get_resharding_steps(open_shard_count, shard_count):
+            self.kinesis.update_shard_count(StreamName=name,
+                                            TargetShardCount=target_shard_count,
+                                            ScalingType='UNIFORM_SCALING')
+            log.info('Stream resharding, stream=%s, shards=%s, target_shards=%s' % (name, open_shard_count, target_shard_count))
+            readiness.wait(self.kinesis.get_waiter('stream_exists'), description='stream:%s' % name,
+                           StreamName=name)
+            open_shard_count = target_shard_count
+
+    def stream_exists(self, name):
+        try:
+            self.kinesis.describe_stream_summary(StreamName=name)
+            return True
+        except botocore.exceptions.ClientError as ex:
+            if ex.response['Error']['Code'] == 'ResourceNotFoundException':
+                return False
+            raise ex
+
+    def get_or_create_stream(self, name, shard_count=None, wait=True):
+        ''' Returns the ARN of the stream, creating it with `shard_count`
+        shards (1 by default) if it does not exist. An existing stream is
+        resharded when `shard_count` is given and differs from its number of
+        open shards, which always waits until resharding completed. Unless
+        `wait` is unset, waits until a created stream is active.
+        '''
         try:
             stream = self.kinesis.describe_stream(StreamName=name)
             log.info('Stream exists, stream=%s' % name)
+            if shard_count:
+                if stream['StreamDescription']['StreamStatus'] != 'ACTIVE':
+                    readiness.wait(self.kinesis.get_waiter('stream_exists'), description='stream:%s' % name,
+                                   StreamName=name)
+                self._update_shard_count(name, shard_count)
         except botocore.exceptions.ClientError as ex:
             if ex.response['Error']['Code'] == 'ResourceNotFoundException':
-                self.kinesis.create_stream(StreamName=name, ShardCount=1)
-                # Wait until the stream is active
-                while True:
-                    stream = self.kinesis.describe_stream(StreamName=name)
-                    if stream['StreamDescription']['StreamStatus'] == 'CREATING':
-                        time.sleep(3)
-                    else:
-                        log.info('Stream created, stream=%s' % name)
-                        break
+                self.kinesis.create_stream(StreamName=name, ShardCount=shard_count or 1)
+                stream = self.kinesis.describe_stream(StreamName=name)
+                log.info('Stream created, stream=%s' % name)
+                if wait:
+                    self.wait_for_streams([name])
             else:
                 raise ex
 
         stream_arn = stream['StreamDescription']['StreamARN']
         return stream_arn
 
+    def _get_active_stream_arn(self, name):
+        summary = self.kinesis.describe_stream_summary(StreamName=name)['StreamDescriptionSummary']
+        if summary['StreamStatus'] == 'CREATING':
+            return None
+        return summary['StreamARN']
+
+    def wait_for_streams(self, names, timeout=readiness.DEFAULT_TIMEOUT):
+        ''' Waits until all streams are active and returns their ARNs by name.
+        All streams are polled together, so waiting for many streams takes
+        as long as waiting for the slowest.
+        '''
+        stream_arns = readiness.wait_for_all(names, self._get_active_stream_arn,
+                                             timeout=timeout, description='streams')
+        log.info('Streams active, streams=%s' % len(stream_arns))
+        return stream_arns
+
+    def _retry_or_raise(self, stream_name, ex, attempt):
+        ''' Sleeps before retrying a throttled call or raises `ex` '''
+        code = ex.response['Error']['Code']
+        if code == 'ResourceNotFoundException':
+            log.error("Stream does not exist, stream_name=%s" % stream_name)
+            raise KinesisStreamDoesNotExist("stream_name=%s" % stream_name)
+        if code not in KINESIS_RETRYABLE_ERRORS or attempt >= self.max_retries:
+            log.error("Unexpected publishing error, stream_name=%s, error=%s" % (stream_name, str(ex)))
+            raise ex
+        if code == 'ProvisionedThroughputExceededException':
+            self._count('throttles')
+        self._count('retries')
+        time.sleep(utils.backoff_delay(attempt))
+
+    def encode(self, stream_name, data):
+        ''' Compresses a record if compression is enabled for the stream '''
+        compression = self.compression.get(stream_name)
+        if compression:
+            return envelope.compress(data, compression)
+        return data
+
     def publish(self, stream_name, data):
-        try:
-            self.kinesis.put_record(StreamName=stream_name, Data=data, PartitionKey=data)
-        except botocore.exceptions.ClientError as ex:
-            if ex.response['Error']['Code'] == 'ResourceNotFoundException':
-                log.error("Stream does not exist, stream_name=%s" % stream_name)
-                raise KinesisStreamDoesNotExist("stream_name=%s" % stream_name)
-            else:
-                log.error("Unexpred publishing error, stream_name=%s, error=%s" % (stream_name, str(ex)))
+        partition_key = self.partition_key(data)
+        data = self.encode(stream_name, data)
+        attempt = 0
+        while True:
+            self._rate_limit(stream_name, [(data, partition_key)])
+            try:
+                self.kinesis.put_record(StreamName=stream_name, Data=data,
+                                        PartitionKey=partition_key)
+                self._count('records')
+                return
+            except botocore.exceptions.ClientError as ex:
+                self._retry_or_raise(stream_name, ex, attempt)
+                attempt += 1
+
+    def _split_batches(self, records):
+        ''' Splits the indexes of `records` into chunks that each fit in a
+        single PutRecords call.
+        '''
+        batch, batch_size = [], 0
+        for i, (data, partition_key) in enumerate(records):
+            size = len(data) + len(partition_key)
+            if batch and (len(batch) >= KINESIS_MAX_BATCH_RECORDS or
+                          batch_size + size > KINESIS_MAX_BATCH_BYTES):
+                yield batch
+                batch, batch_size = [], 0
+            batch.append(i)
+            batch_size += size
+        if batch:
+            yield batch
+
+    def publish_batch(self, stream_name, records):
+        ''' Publishes a list of records with PutRecords.
+
+        When a call partially fails only the failed entries are retried,
+        with exponential backoff and jitter. Returns a list with one
+        PutRecords result entry per record, in the same order as `records`.
+        Entries that still failed after all retries contain the `ErrorCode`
+        and `ErrorMessage`.
+
+        With `aggregate` set, the records bound to the same shard are packed
+        into as few Kinesis records as possible (see `envelope.aggregate`).
+        Every record then gets the result entry of the Kinesis record it was
+        packed in.
+        '''
+        records = [(data, self.partition_key(data)) for data in records]
+        if not self.aggregate or len(records) < 2:
+            records = [(self.encode(stream_name, data), key) for data, key in records]
+            return self._put_records(stream_name, records)
+
+        # Records of a shard can be packed together as they would have been
+        # written to the same shard anyway, which keeps them ordered.
+        groups = collections.OrderedDict()
+        for i, (data, partition_key) in enumerate(records):
+            try:
+                shard_id = self.shard_map.get_shard_id(stream_name, partition_key)
+            except botocore.exceptions.ClientError as ex:
+                if ex.response['Error']['Code'] == 'ResourceNotFoundException':
+                    log.error("Stream does not exist, stream_name=%s" % stream_name)
+                    raise KinesisStreamDoesNotExist("stream_name=%s" % stream_name)
                 raise ex
+            groups.setdefault(shard_id or partition_key, []).append(i)
+
+        aggregated, packed_indexes = [], []
+        max_bytes = KINESIS_MAX_RECORD_BYTES - KINESIS_MAX_PARTITION_KEY_LENGTH
+        for indexes in groups.values():
+            payloads = [records[i][0] for i in indexes]
+            for data, packed in envelope.aggregate(payloads, max_bytes=max_bytes):
+                packed = [indexes[j] for j in packed]
+                aggregated.append((self.encode(stream_name, data), records[packed[0]][1]))
+                packed_indexes.append(packed)
+
+        results = [None] * len(records)
+        for result, packed in zip(self._put_records(stream_name, aggregated), packed_indexes):
+            for i in packed:
+                results[i] = result
+        self._count('aggregated', len(records))
+        return results
+
+    def _put_records(self, stream_name, records):
+        ''' Publishes a list of (data, partition_key) tuples '''
+        results = [None] * len(records)
+        for batch in self._split_batches(records):
+            pending = batch
+            attempt = 0
+            while pending:
+                self._rate_limit(stream_name, [records[i] for i in pending])
+                entries = [{'Data': records[i][0], 'PartitionKey': records[i][1]} for i in pending]
+                try:
+                    res = self.kinesis.put_records(StreamName=stream_name, Records=entries)
+                except botocore.exceptions.ClientError as ex:
+                    self._retry_or_raise(stream_name, ex, attempt)
+                    attempt += 1
+                    continue
+
+                failed = []
+                for i, entry in zip(pending, res['Records']):
+                    results[i] = entry
+                    if entry.get('ErrorCode'):
+                        failed.append(i)
+                self._count('records', len(pending) - len(failed))
+
+                throttled = len([i for i in failed if results[i]['ErrorCode'] == 'ProvisionedThroughputExceededException'])
+                self._count('throttles', throttled)
+                if failed and attempt < self.max_retries:
+                    log.info('Retrying failed records, stream_name=%s, failed=%s, attempt=%s' % (stream_name, len(failed), attempt + 1))
+                    self._count('retries')
+                    time.sleep(utils.backoff_delay(attempt))
+                    attempt += 1
+                    pending = failed
+                else:
+                    if failed:
+                        log.error('Unable to publish records, stream_name=%s, failed=%s' % (stream_name, len(failed)))
+                        self._count('failed', len(failed))
+                    pending = []
+        return results
 
 
 class CloudWatchLogs(object):
@@ -296,6 +1106,10 @@ class CloudWatchLogs(object):
             else:
                 log.info('LogGroup exists, log_group=%s' % name)
 
+    def log_group_exists(self, name):
+        response = self.cwlogs.describe_log_groups(logGroupNamePrefix=name)
+        return any(g['logGroupName'] == name for g in response.get('logGroups') or [])
+
     def get_log_events(self, log_group_name, log_stream_name):
         all_events = []
         next_token = None
@@ -347,3 +1161,31 @@ class CloudWatchLogs(object):
                 next_token = res['nextForwardToken']
 
         return all_events
+
+    def filter_log_events(self, log_group_name, log_stream_name, filter_pattern):
+        ''' Returns the events of a log stream that match a filter pattern,
+        e.g. the events of one execution in a bucket stream.
+        '''
+        all_events = []
+        paginator = self.cwlogs.get_paginator('filter_log_events')
+        try:
+            for page in paginator.paginate(logGroupName=log_group_name,
+                                           logStreamNames=[log_stream_name],
+                                           filterPattern=filter_pattern):
+                for e in page['events']:
+                    ts = datetime.fromtimestamp(e['timestamp'] / 1000)
+                    all_events.append({
+                        "timestamp": utils.format_datetime(ts),
+                        "data": json.loads(e['message'])
+                    })
+        except botocore.exceptions.ClientError as ex:
+            if ex.response['Error']['Code'] == 'ResourceNotFoundException':
+                if "stream" in str(ex):
+                    log.error("Log stream does not exist, log_group_name=%s, log_stream_name=%s" % (log_group_name, log_stream_name))
+                    raise CloudWatchStreamDoesNotExist("log_group_name=%s, log_stream_name=%s" % (log_group_name, log_stream_name))
+                log.error("Log group does not exist, log_group_name=%s" % log_group_name)
+                raise CloudWatchLogDoesNotExist("log_group_name=%s" % log_group_name)
+            log.error("Unable to filter log events, log_group=%s, log_stream=%s" % (log_group_name, log_stream_name))
+            raise ex
+
+        return sorted(all_events, key=lambda e: e['timestamp'])
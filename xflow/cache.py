@@ -0,0 +1,229 @@
+import os
+import json
+import time
+import errno
+import hashlib
+import logging
+import tempfile
+
+import utils
+
+
+log = logging.getLogger(__name__)
+
+# Bumped whenever the archive layout changes so that stale artifacts are
+# not reused
+ARTIFACT_FORMAT_VERSION = 'zip1'
+DEFAULT_ARTIFACT_CACHE_DIR = os.path.join('~', '.xflow', 'artifacts')
+DEFAULT_ARTIFACT_CACHE_MAX_BYTES = 512 * 1024 * 1024
+DEFAULT_DOWNLOAD_CACHE_DIR = os.path.join('~', '.xflow', 'downloads')
+DEFAULT_DOWNLOAD_CACHE_MAX_BYTES = 256 * 1024 * 1024
+DEFAULT_ROLE_CACHE_PATH = os.path.join('~', '.xflow', 'roles.json')
+DEFAULT_ROLE_CACHE_TTL = 3600
+
+
+def files_digest(files):
+    ''' Returns a digest of (name, contents) files, independent of their order '''
+    digest = hashlib.sha256(ARTIFACT_FORMAT_VERSION)
+    for name, contents in sorted(files):
+        digest.update('%s:%s:%s:' % (name, len(name), len(contents)))
+        digest.update(contents)
+    return digest.hexdigest()
+
+
+def _makedirs(directory):
+    try:
+        os.makedirs(directory)
+    except OSError as ex:
+        if ex.errno != errno.EEXIST:
+            raise ex
+
+
+def _write_atomic(path, data):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.rename(tmp_path, path)
+
+
+class ArtifactCache(object):
+    ''' A local content-addressed store of packaged lambda archives.
+
+    Archives are keyed by the digest of the files they contain, so
+    packaging the same files again returns the stored bytes. Entries are
+    written to a temporary file and renamed, so concurrent writers never
+    expose a partial archive. The least recently used archives are evicted
+    once the cache holds more than `max_bytes` bytes.
+    '''
+
+    def __init__(self, directory=DEFAULT_ARTIFACT_CACHE_DIR,
+                 max_bytes=DEFAULT_ARTIFACT_CACHE_MAX_BYTES):
+        self.directory = os.path.expanduser(directory)
+        self.max_bytes = max_bytes
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.zip')
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except IOError as ex:
+            if ex.errno == errno.ENOENT:
+                return None
+            raise ex
+        # The modification time orders archives by their last use
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return data
+
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        path = self._path(key)
+        _makedirs(os.path.dirname(path))
+        _write_atomic(path, data)
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        for root, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if not filename.endswith('.zip'):
+                    continue
+                path = os.path.join(root, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+            log.debug('Evicted artifact, path=%s' % path)
+
+    def package(self, files):
+        ''' Returns the zip archive of (name, contents) files '''
+        key = files_digest(files)
+        data = self.get(key)
+        if data is not None:
+            log.debug('Artifact cache hit, artifact=%s' % key)
+            return data
+        data = utils.zip_files(files)
+        try:
+            self.put(key, data)
+        except (IOError, OSError) as ex:
+            log.warning('Unable to cache artifact, artifact=%s, error=%s' % (key, str(ex)))
+        return data
+
+
+class DownloadCache(object):
+    ''' A local cache of downloaded S3 objects, validated by their ETag.
+
+    Every object is stored with the ETag it was downloaded with, so that it
+    is only downloaded again when it changed. The least recently used
+    objects are evicted once the cache holds more than `max_bytes` bytes.
+    '''
+
+    def __init__(self, directory=DEFAULT_DOWNLOAD_CACHE_DIR,
+                 max_bytes=DEFAULT_DOWNLOAD_CACHE_MAX_BYTES):
+        self.directory = os.path.expanduser(directory)
+        self.max_bytes = max_bytes
+
+    def _path(self, bucket, key):
+        name = hashlib.sha256('%s/%s' % (bucket, key)).hexdigest()
+        return os.path.join(self.directory, name)
+
+    def get(self, bucket, key):
+        ''' Returns the (etag, contents) of a cached object or None '''
+        path = self._path(bucket, key)
+        try:
+            with open(path + '.json') as f:
+                etag = json.load(f)['etag']
+            with open(path, 'rb') as f:
+                contents = f.read()
+        except (IOError, ValueError, KeyError):
+            return None
+        # The modification time orders objects by their last use
+        os.utime(path, None)
+        return etag, contents
+
+    def put(self, bucket, key, etag, contents):
+        if len(contents) > self.max_bytes:
+            return
+        path = self._path(bucket, key)
+        _makedirs(self.directory)
+        _write_atomic(path, contents)
+        _write_atomic(path + '.json', json.dumps({'bucket': bucket, 'key': key, 'etag': etag}))
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith('.json') or not os.path.isfile(path + '.json'):
+                continue
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            for p in [path + '.json', path]:
+                try:
+                    os.remove(p)
+                except OSError:
+                    pass
+            total -= size
+            log.debug('Evicted download, path=%s' % path)
+
+
+class RoleCache(object):
+    ''' Role ARNs resolved by earlier runs, so that IAM is not called again
+    until they are `ttl` seconds old.
+    '''
+
+    def __init__(self, path=DEFAULT_ROLE_CACHE_PATH, ttl=DEFAULT_ROLE_CACHE_TTL):
+        self.path = os.path.expanduser(path)
+        self.ttl = ttl
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def get(self, key):
+        entry = self._load().get(key)
+        if entry and entry['expires_at'] > time.time():
+            return entry['arn']
+        return None
+
+    def put(self, key, arn):
+        now = time.time()
+        entries = {k: e for k, e in self._load().items() if e['expires_at'] > now}
+        entries[key] = {'arn': arn, 'expires_at': now + self.ttl}
+        try:
+            _makedirs(os.path.dirname(self.path))
+            _write_atomic(self.path, json.dumps(entries))
+        except (IOError, OSError) as ex:
+            log.warning('Unable to cache role, role=%s, error=%s' % (key, str(ex)))
+
+    def remove(self, key):
+        entries = self._load()
+        if entries.pop(key, None) is None:
+            return
+        try:
+            _write_atomic(self.path, json.dumps(entries))
+        except (IOError, OSError) as ex:
+            log.warning('Unable to evict role, role=%s, error=%s' % (key, str(ex)))
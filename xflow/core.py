@@ -1,7 +1,11 @@
 import os
+import time
 import json
 import logging
+import functools
+import threading
 import pykwalify
+import jsonschema
 import collections
 from pkg_resources import Requirement, resource_filename
 
@@ -9,6 +13,14 @@ from pykwalify.core import Core
 
 import utils
 import tracker
+import envelope
+from producer import BufferedProducer, PublishPipeline, QueueFull
+from executor import TaskGraph
+from manifest import Manifest, fingerprint, file_digest
+from cache import ArtifactCache, DownloadCache, RoleCache, DEFAULT_ARTIFACT_CACHE_DIR, \
+                  DEFAULT_ARTIFACT_CACHE_MAX_BYTES, DEFAULT_DOWNLOAD_CACHE_DIR, DEFAULT_DOWNLOAD_CACHE_MAX_BYTES, \
+                  DEFAULT_ROLE_CACHE_TTL
+from layers import requirements_digest, layer_name, build_layer, supports_requirements
 from aws import Lambda, Kinesis, IAM, CloudWatchLogs, \
                 CloudWatchLogDoesNotExist, CloudWatchStreamDoesNotExist, \
                 KinesisStreamDoesNotExist
@@ -20,6 +32,34 @@ LAMBDA_EXECUTE_ROLE_NAME = 'lambda-execute'
 STATE_RECEIVED = "received"
 STATE_RECEIVED_UNEXPECTED = "received_but_unexpected"
 STATE_UNKNOWN = "uknown_state"
+ACTION_CREATE = "create"
+ACTION_UPDATE = "update"
+ACTION_UPDATE_CODE = "update_code"
+ACTION_UPDATE_CONFIG = "update_config"
+ACTION_NOOP = "noop"
+CONFIGURE_PENDING = "pending"
+CONFIGURE_RUNNING = "configuring"
+CONFIGURE_DONE = "configured"
+CONFIGURE_FAILED = "failed"
+
+# The `mapping` keys of subscriptions and workflows and the event source
+# mapping parameters they set
+MAPPING_SETTINGS = {
+    'batch_size': 'BatchSize',
+    'batching_window': 'MaximumBatchingWindowInSeconds',
+    'parallelization_factor': 'ParallelizationFactor',
+    'starting_position': 'StartingPosition',
+    'bisect_on_error': 'BisectBatchOnFunctionError',
+    'retry_attempts': 'MaximumRetryAttempts',
+    'max_record_age': 'MaximumRecordAgeInSeconds'
+}
+# The settings of a `lambdas` entry that tune its function
+FUNCTION_OPTIONS = ['memory_size', 'timeout', 'reserved_concurrency', 'provisioned_concurrency']
+# The function options recorded in the manifest so that they can be removed
+CONCURRENCY_OPTIONS = ['reserved_concurrency', 'provisioned_concurrency']
+# Records can not expire sooner than a minute, -1 keeps them until the
+# stream drops them
+MAPPING_MIN_RECORD_AGE = 60
 
 
 class ConfigValidationError(Exception):
@@ -30,11 +70,28 @@ class WorkflowDoesNotExist(Exception):
     pass
 
 
+class service(object):
+    ''' An `Engine` service that is set up by its factory on first use '''
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, engine, owner):
+        if engine is None:
+            return self
+        return engine.get_service(self.name)
+
+    def __set__(self, engine, value):
+        with engine.services_lock:
+            engine.services[self.name] = value
+
+
 class Engine(object):
     def __init__(self, config_path):
 
         contents = utils.read_file(config_path)
         self.config = utils.parse_yaml(contents)
+        self.config_path = config_path
 
         aws_config = self.config.get('aws', {})
         region = os.environ.get('REGION') or aws_config.get('region')
@@ -44,41 +101,156 @@ class Engine(object):
         security_group_ids = aws_config.get('security_group_ids') or []
         role_name = os.environ.get('LAMBDA_EXECUTION_ROLE_NAME') or aws_config.get('lambda_execution_role_name')
 
-        general_config = self.config.get('general', {})
+        general_config = self.config.get('general') or {}
+        self.configure_workers = general_config.get('configure_workers') or 1
         timeout_time = int(os.environ.get('LAMBDA_TIMEOUT_TIME') or general_config.get('lambda_timeout_time') or 10)
+        partition_key_config = general_config.get('partition_key') or {}
+        artifact_cache_dir = os.environ.get('XFLOW_ARTIFACT_CACHE_DIR') or \
+                             general_config.get('artifact_cache_dir') or DEFAULT_ARTIFACT_CACHE_DIR
+        download_cache = DownloadCache(general_config.get('download_cache_dir') or DEFAULT_DOWNLOAD_CACHE_DIR,
+                                       max_bytes=general_config.get('download_cache_max_bytes') or \
+                                                 DEFAULT_DOWNLOAD_CACHE_MAX_BYTES)
+
+        # Layers of lambda requirements are built once per set of requirements
+        self.artifact_cache = ArtifactCache(artifact_cache_dir,
+                                            max_bytes=general_config.get('artifact_cache_max_bytes') or \
+                                                      DEFAULT_ARTIFACT_CACHE_MAX_BYTES)
+        self.layer_arns = {}
+        self.layers_lock = threading.Lock()
+
+        # Until configure runs, the resources are assumed to be set up by an
+        # earlier configure. While it runs only the streams it set up are
+        # ready to be published to.
+        self.configure_status = CONFIGURE_PENDING
+        self.configure_error = None
+        self.ready_streams = set()
+
+        # The deployed state is only tracked by incremental configures
+        self.manifest = None
+        self.manifest_path = general_config.get('manifest_file') or \
+                             os.path.splitext(config_path)[0] + '.manifest.json'
 
         log.debug('region=%s, role_name=%s' % (region, role_name))
         log.debug('timeout_time=%s' % timeout_time)
-        self.awslambda = self.setup_lambda(region,
+
+        # Services are set up on first use, so that a command only creates
+        # the clients it needs
+        self.services = {}
+        self.services_lock = threading.RLock()
+        self.service_factories = {
+            'awslambda': functools.partial(self.setup_lambda,
+                                           region,
                                            role_name,
                                            timeout_time,
                                            aws_access_key_id,
                                            aws_secret_access_key,
                                            subnet_ids=subnet_ids,
-                                           security_group_ids=security_group_ids)
-        self.kinesis = self.setup_kinesis(region, aws_access_key_id, aws_secret_access_key)
-        self.cwlogs = self.setup_cloud_watch_logs(region, aws_access_key_id, aws_secret_access_key)
+                                           security_group_ids=security_group_ids,
+                                           artifact_cache=self.artifact_cache,
+                                           download_cache=download_cache,
+                                           staging_config=general_config.get('staging') or {},
+                                           role_cache_ttl=general_config.get('role_cache_ttl', DEFAULT_ROLE_CACHE_TTL),
+                                           failure_destinations=self._get_failure_destinations()),
+            'kinesis': functools.partial(self.setup_kinesis,
+                                         region, aws_access_key_id, aws_secret_access_key,
+                                         partition_key_config=partition_key_config,
+                                         rate_limit=general_config.get('rate_limit', False),
+                                         aggregate=general_config.get('aggregate_records', False),
+                                         compression=self._get_stream_compression()),
+            'cwlogs': functools.partial(self.setup_cloud_watch_logs,
+                                        region, aws_access_key_id, aws_secret_access_key),
+            'producer': lambda: None,
+            'pipeline': lambda: None
+        }
+
+        # Buffered publishing is enabled by the `publish_batching` setting
+        if 'publish_batching' in general_config:
+            batching_config = general_config.get('publish_batching') or {}
+            self.service_factories['producer'] = functools.partial(self.setup_producer, batching_config)
+
+        # Asynchronous publishing is enabled by the `async_publishing` setting
+        self.ack_timeout = 10
+        if 'async_publishing' in general_config:
+            async_config = general_config.get('async_publishing') or {}
+            if async_config.get('ack_timeout') is not None:
+                self.ack_timeout = async_config['ack_timeout']
+            self.service_factories['pipeline'] = functools.partial(self.setup_pipeline, async_config)
+
+    awslambda = service('awslambda')
+    kinesis = service('kinesis')
+    cwlogs = service('cwlogs')
+    producer = service('producer')
+    pipeline = service('pipeline')
+
+    def get_service(self, name):
+        ''' Returns a service, setting it up on first use '''
+        with self.services_lock:
+            if name not in self.services:
+                self.services[name] = self.service_factories[name]()
+            return self.services[name]
 
     def setup_lambda(self, region, role_name, timeout_time,
                      aws_access_key_id, aws_secret_access_key,
-                     subnet_ids=[], security_group_ids=[]):
-        iam = IAM(region,
-                  aws_access_key_id=aws_access_key_id,
-                  aws_secret_access_key=aws_secret_access_key)
-        role_arn = iam.get_or_create_role(role_name=role_name)
+                     subnet_ids=[], security_group_ids=[], artifact_cache=None,
+                     download_cache=None, staging_config={}, role_cache_ttl=0,
+                     failure_destinations=None, read_only=False):
+        ''' Returns the Lambda service. Unless `read_only` is set, the
+        execution role is created or its policies updated where needed.
+        '''
+        options = {}
+        if staging_config.get('bucket'):
+            options['staging_bucket'] = staging_config['bucket']
+        if staging_config.get('threshold_bytes') is not None:
+            options['staging_threshold'] = staging_config['threshold_bytes']
+        # The role is resolved by IAM at most once per `role_cache_ttl` for
+        # the same credentials, which also tells accounts and profiles apart,
+        # and the same failure destinations, which its policies allow
+        role_cache = RoleCache(ttl=role_cache_ttl)
+        role_key = None
+        if role_cache_ttl:
+            access_key_id = IAM.get_access_key_id(aws_access_key_id, aws_secret_access_key)
+            if access_key_id:
+                role_key = '%s:%s:%s' % (access_key_id, region, role_name)
+                if failure_destinations:
+                    role_key = '%s:%s' % (role_key, fingerprint(failure_destinations))
+        role_arn = role_cache.get(role_key) if role_key else None
+        # A cached role that Lambda rejects is evicted from the cache
+        if role_arn:
+            options.update(role_cache=role_cache, role_cache_key=role_key)
+        else:
+            iam = IAM(region,
+                      aws_access_key_id=aws_access_key_id,
+                      aws_secret_access_key=aws_secret_access_key)
+            if read_only:
+                role_arn = iam.get_role_arn(role_name)
+            else:
+                role_arn = iam.get_or_create_role(role_name=role_name, failure_destinations=failure_destinations)
+            if role_key and role_arn:
+                role_cache.put(role_key, role_arn)
         awslambda = Lambda(region, role_arn,
                       subnet_ids=subnet_ids,
                       security_group_ids=security_group_ids,
                       timeout_time=timeout_time,
+                      artifact_cache=artifact_cache,
+                      download_cache=download_cache,
                       aws_access_key_id=aws_access_key_id,
-                      aws_secret_access_key=aws_secret_access_key)
+                      aws_secret_access_key=aws_secret_access_key,
+                      **options)
         log.info('AWS Lambda initialized')
         return awslambda
 
-    def setup_kinesis(self, region, aws_access_key_id, aws_secret_access_key):
+    def setup_kinesis(self, region, aws_access_key_id, aws_secret_access_key,
+                      partition_key_config={}, rate_limit=False, aggregate=False,
+                      compression=None):
+        options = {'rate_limit': rate_limit, 'aggregate': aggregate, 'compression': compression}
+        if partition_key_config.get('strategy'):
+            options['partition_key'] = partition_key_config['strategy']
+        if partition_key_config.get('field'):
+            options['partition_key_field'] = partition_key_config['field']
         awskinesis = Kinesis(region,
                        aws_access_key_id=aws_access_key_id,
-                       aws_secret_access_key=aws_secret_access_key)
+                       aws_secret_access_key=aws_secret_access_key,
+                       **options)
         log.info('AWS Kinesis initialized')
         return awskinesis
 
@@ -90,95 +262,400 @@ class Engine(object):
         log.info('AWS CloudWatchLogs initialized')
         return cwlogs
 
+    def setup_producer(self, batching_config):
+        options = {}
+        for key in ['max_records', 'max_bytes', 'linger_time']:
+            if batching_config.get(key) is not None:
+                options[key] = batching_config[key]
+        producer = BufferedProducer(self.kinesis, **options)
+        log.info('Buffered producer initialized')
+        return producer
+
+    def setup_pipeline(self, async_config):
+        options = {}
+        if async_config.get('workers'):
+            options['workers'] = async_config['workers']
+        if async_config.get('queue_size'):
+            options['queue_size'] = async_config['queue_size']
+        pipeline = PublishPipeline(self.kinesis, **options)
+        log.info('Publish pipeline initialized')
+        return pipeline
+
+    def _get_code_digest(self, l):
+        ''' Returns a digest of the code of a `lambdas` entry, as xflow
+        would package it.
+        '''
+        source = l['source']
+        if utils.is_s3_file(source):
+            bucket, key = utils.get_host(source), utils.get_path(source)
+            return fingerprint({'source': source, 'etag': self.awslambda.get_s3_etag(bucket, key)})
+        if utils.is_local_zip_file(source):
+            return file_digest([source])
+        return file_digest([source, envelope.source_file()])
+
+    def _plan_function(self, resource, name, code_digest, settings):
+        ''' Returns the action that brings a deployed function up to date.
+        The function is updated entirely when its code was changed outside of
+        xflow since the manifest was written.
+        '''
+        current = self.awslambda.get_function_configuration(name)
+        if not current:
+            return ACTION_CREATE
+        state = self.manifest.get(resource) or {}
+        if state.get('code_sha256') != current['CodeSha256']:
+            return ACTION_UPDATE
+        code_changed = state.get('code_digest') != code_digest
+        settings_changed = state.get('settings') != fingerprint(settings)
+        if code_changed and settings_changed:
+            return ACTION_UPDATE
+        if code_changed:
+            return ACTION_UPDATE_CODE
+        if settings_changed:
+            return ACTION_UPDATE_CONFIG
+        return ACTION_NOOP
+
+    def setup_layer(self, requirements_file, runtime):
+        ''' Returns the ARN of the layer with the requirements of a lambda.
+        The layer is built and published only if no lambda published it yet.
+        '''
+        digest = requirements_digest(requirements_file, runtime)
+        with self.layers_lock:
+            if digest in self.layer_arns:
+                return self.layer_arns[digest]
+            name = layer_name(digest)
+            layer_arn = self.awslambda.get_layer_version_arn(name)
+            if not layer_arn:
+                zip_blob = self.artifact_cache.get(digest)
+                if zip_blob is None:
+                    zip_blob = build_layer(requirements_file, runtime)
+                    self.artifact_cache.put(digest, zip_blob)
+                layer_arn = self.awslambda \
+                                .publish_layer_version(name, zip_blob, [runtime],
+                                                       description='xflow dependencies, digest=%s' % digest)
+            self.layer_arns[digest] = layer_arn
+            return layer_arn
+
+    def _get_layers(self, l, publish=True):
+        ''' Returns the layer ARNs of a `lambdas` entry. Without `publish`
+        the layer of its requirements is only looked up.
+        '''
+        layer_arns = list(l.get('layers') or [])
+        if l.get('requirements'):
+            if publish:
+                layer_arns.append(self.setup_layer(l['requirements'], l['runtime']))
+            else:
+                digest = requirements_digest(l['requirements'], l['runtime'])
+                layer_arns.append(self.awslambda.get_layer_version_arn(layer_name(digest)))
+        return layer_arns
+
+    def _get_function_options(self, l):
+        ''' Returns the memory, timeout and concurrency settings of a
+        `lambdas` entry.
+        '''
+        return {k: l[k] for k in FUNCTION_OPTIONS if l.get(k) is not None}
+
+    def _deploy_function(self, resource, name, runtime, handler, description,
+                         code_digest, layers=None, options=None, **sources):
+        ''' Creates or updates a function and returns its ARN. On an
+        incremental configure only what changed since the manifest was
+        written is updated.
+        '''
+        options = options or {}
+        if not self.manifest:
+            sources.update(options)
+            return self.awslambda \
+                       .create_or_update_function(name, runtime, handler,
+                                                  description=description,
+                                                  layers=layers, **sources)
+
+        settings = self.awslambda.get_function_settings(runtime, handler, description, layers, **options)
+        action = self._plan_function(resource, name, code_digest, settings)
+        if action == ACTION_NOOP:
+            log.info('Lambda unchanged, lambda=%s' % name)
+            return self.manifest.get(resource)['arn']
+
+        function = self.awslambda \
+                       .deploy_function(name, runtime, handler, description=description,
+                                        update_code=action != ACTION_UPDATE_CONFIG,
+                                        update_configuration=action != ACTION_UPDATE_CODE,
+                                        layers=layers,
+                                        memory_size=options.get('memory_size'),
+                                        timeout=options.get('timeout'),
+                                        **sources)
+        # Only concurrency that xflow set before is removed when it is no
+        # longer configured
+        concurrency = (self.manifest.get(resource) or {}).get('concurrency') or {}
+        function_arn = self.awslambda \
+                           .set_concurrency(name, function,
+                                            reserved_concurrency=options.get('reserved_concurrency'),
+                                            provisioned_concurrency=options.get('provisioned_concurrency'),
+                                            clear_reserved='reserved_concurrency' in concurrency,
+                                            clear_provisioned='provisioned_concurrency' in concurrency)
+        self.manifest.set(resource, {
+            'arn': function_arn,
+            'code_digest': code_digest,
+            'code_sha256': function['CodeSha256'],
+            'settings': fingerprint(settings),
+            'concurrency': {k: options[k] for k in CONCURRENCY_OPTIONS if k in options}
+        })
+        return function_arn
+
+    def setup_function(self, l):
+        ''' Creates or updates the lambda function of a `lambdas` entry
+        and returns its ARN.
+        '''
+        s3_filename = zip_filename = local_filename = None
+        name, runtime, source, handler, description = l['name'], l['runtime'], l['source'], l['handler'], l['description']
+
+        if utils.is_s3_file(source):
+            s3_filename = source
+        if utils.is_local_file(source):
+            local_filename = source
+        if utils.is_local_zip_file(source):
+            zip_filename = source
+
+        code_digest = self._get_code_digest(l) if self.manifest else None
+
+        # Lambdas packaged by xflow get the envelope module to decode
+        # aggregated records
+        return self._deploy_function('lambda:%s' % name, name, runtime, handler,
+                                     description, code_digest,
+                                     layers=self._get_layers(l),
+                                     options=self._get_function_options(l),
+                                     zip_filename=zip_filename, s3_filename=s3_filename,
+                                     local_filename=local_filename,
+                                     otherfiles=[envelope.source_file()])
+
+    def _plan_stream(self, s):
+        ''' Returns the action that brings a stream up to date. A stream
+        that was deleted outside of xflow since the manifest was written is
+        created again.
+        '''
+        state = self.manifest.get('stream:%s' % s['event'])
+        if not state or not self.kinesis.stream_exists(s['event']):
+            return ACTION_CREATE
+        if state['settings'] != fingerprint({'shards': s.get('shards')}):
+            return ACTION_UPDATE
+        return ACTION_NOOP
+
+    def setup_stream(self, s, wait=True):
+        ''' Creates the stream of a `subscriptions` entry and returns its ARN.
+        Without `wait` a created stream may not be active yet.
+        '''
+        resource = 'stream:%s' % s['event']
+        if self.manifest and self._plan_stream(s) == ACTION_NOOP:
+            log.info('Stream unchanged, stream=%s' % s['event'])
+            self.ready_streams.add(s['event'])
+            return self.manifest.get(resource)['arn']
+        stream_arn = self.kinesis.get_or_create_stream(s['event'], shard_count=s.get('shards'), wait=wait)
+        if wait:
+            self.ready_streams.add(s['event'])
+        if self.manifest:
+            self.manifest.set(resource, {
+                'arn': stream_arn,
+                'settings': fingerprint({'shards': s.get('shards')})
+            })
+        return stream_arn
+
+    def _get_mapping_settings(self, entry):
+        ''' Returns the event source mapping parameters of the `mapping` of
+        a subscription or workflow entry.
+        '''
+        mapping = entry.get('mapping') or {}
+        settings = {MAPPING_SETTINGS[k]: v for k, v in mapping.items() if k in MAPPING_SETTINGS}
+        if mapping.get('on_failure'):
+            settings['DestinationConfig'] = {'OnFailure': {'Destination': mapping['on_failure']}}
+        return settings
+
+    def _plan_subscription(self, resource, function_arn, stream_arn, settings=None):
+        ''' Returns the action that brings a subscription up to date. A
+        mapping that was deleted outside of xflow since the manifest was
+        written is created again.
+        '''
+        state = self.manifest.get(resource)
+        if not state or (state['function_arn'], state['stream_arn']) != (function_arn, stream_arn):
+            return ACTION_CREATE
+        if state['settings'] != (settings or {}):
+            return ACTION_UPDATE
+        if not self.awslambda.get_event_source_mapping(function_arn, stream_arn):
+            return ACTION_CREATE
+        return ACTION_NOOP
+
+    def _get_failure_destinations(self):
+        ''' Returns the `on_failure` destinations of all subscriptions and
+        workflows, which the execution role has to be allowed to send to.
+        '''
+        entries = (self.config.get('subscriptions') or []) + (self.config.get('workflows') or [])
+        return sorted(set((e.get('mapping') or {}).get('on_failure') for e in entries) - set([None]))
+
+    def _subscribe(self, resource, function_arn, stream_arn, settings=None):
+        ''' Subscribes a function to a stream unless the manifest records
+        the same subscription.
+        '''
+        if self.manifest and self._plan_subscription(resource, function_arn, stream_arn, settings) == ACTION_NOOP:
+            log.debug('Subscription unchanged, subscription=%s' % resource)
+            return
+        self.awslambda.subscribe_to_stream(function_arn, stream_arn, settings)
+        if self.manifest:
+            self.manifest.set(resource, {'function_arn': function_arn, 'stream_arn': stream_arn,
+                                         'settings': settings or {}})
+
+    def subscribe_function(self, event_name, lambda_name, lambda_arn, stream_arn, settings=None):
+        self._subscribe('subscription:%s:%s' % (event_name, lambda_name), lambda_arn, stream_arn, settings)
+
     def setup_lambdas(self):
         log.info('Setting up lambdas')
         lambda_mappings = {}
         lambdas = self.config.get('lambdas', [])
         for l in lambdas:
-            s3_filename = zip_filename = local_filename = None
-            name, runtime, source, handler, description = l['name'], l['runtime'], l['source'], l['handler'], l['description']
-
-            if utils.is_s3_file(source):
-                s3_filename = source
-            if utils.is_local_file(source):
-                local_filename = source
-            if utils.is_local_zip_file(source):
-                zip_filename = source
-
-            lambda_arn = self.awslambda \
-                             .create_or_update_function(name, runtime, handler, description=description,
-                                                        zip_filename=zip_filename, s3_filename=s3_filename,
-                                                        local_filename=local_filename)
-            lambda_mappings[name] = lambda_arn
+            lambda_mappings[l['name']] = self.setup_function(l)
 
         log.info('Setup all lambdas')
         return lambda_mappings
 
     def setup_streams_and_subscriptions(self, lambda_mappings):
-        log.info('Setting up streams and subscriptions')
+        stream_mappings = self.setup_streams()
+        self.setup_subscriptions(lambda_mappings, stream_mappings)
+        return stream_mappings
+
+    def setup_streams(self):
+        ''' Creates the streams of all subscriptions and returns their ARNs.
+        Every stream is ready to publish to once this returns.
+        '''
+        log.info('Setting up streams')
         stream_mappings = {}
-        subscriptions = self.config.get('subscriptions')
+        subscriptions = self.config.get('subscriptions') or []
+
+        # All streams are created first and then waited for at once,
+        # unchanged streams are ready straight away
         for s in subscriptions:
+            stream_mappings[s['event']] = self.setup_stream(s, wait=False)
+        pending_streams = [s['event'] for s in subscriptions if s['event'] not in self.ready_streams]
+        if pending_streams:
+            self.kinesis.wait_for_streams(pending_streams)
+        self.ready_streams.update(stream_mappings)
+        log.info("Setup all streams")
+        return stream_mappings
+
+    def setup_subscriptions(self, lambda_mappings, stream_mappings):
+        log.info('Setting up subscriptions')
+        for s in self.config.get('subscriptions') or []:
             event_name = s['event']
             lambda_subscribers = s.get('subscribers') or []
-            stream_arn = self.kinesis.get_or_create_stream(event_name)
-            stream_mappings[event_name] = stream_arn
+            stream_arn = stream_mappings[event_name]
+            settings = self._get_mapping_settings(s)
             for lambda_name in lambda_subscribers:
                 lambda_arn = lambda_mappings[lambda_name]
-                self.awslambda.subscribe_to_stream(lambda_arn, stream_arn)
-        log.info("Setup all streams and subscriptions")
-        return stream_mappings
+                self.subscribe_function(event_name, lambda_name, lambda_arn, stream_arn, settings)
+        log.info("Setup all subscriptions")
 
     def _generate_log_group_name(self, workflow_id):
         log_group_name = '/xFlow/track/%s' % workflow_id
         return log_group_name
 
+    def _get_stream_compression(self):
+        ''' Returns the compression of every stream that has one configured '''
+        subscriptions = self.config.get('subscriptions') or []
+        return {s['event']: s['compression'] for s in subscriptions if s.get('compression')}
+
+    def get_event_schemas(self):
+        ''' Returns the JSON schema of every event that has one configured '''
+        subscriptions = self.config.get('subscriptions') or []
+        return {s['event']: s['schema'] for s in subscriptions if s.get('schema')}
+
     def _get_subscribers(self, event_name):
         all_subscriptions = self.config.get('subscriptions') or []
         event_subscription = [s for s in all_subscriptions if s['event'] == event_name]
         subscribers = event_subscription[0]['subscribers'] if event_subscription else []
         return subscribers
 
-    def setup_tracker(self, workflow_id, stream_arns):
+    def setup_tracker(self, workflow_id, stream_arns, settings=None):
         ''' The tracker is a lambda function that will subscribe itself to
         every stream in the workflow. Its function is to receive events from
         the stream and log them to CloudWatchLogs for tracking.
         '''
-        config_filename = "tracker.cfg"
-        tracker_filename = "tracker_%s.py" % workflow_id
-        log_group_name = self._generate_log_group_name(workflow_id)
-
-        tracker_name = tracker_filename.split(".py")[0]
-        handler = "log"
-        runtime = "python2.7"
-        description = "A tracker that logs events from streams defined in workflow %s" % workflow_id
-
-        def generate_tracker_config(workflow_id):
-            config = json.dumps({
-                "workflow_id": workflow_id,
-                "log_group_name": log_group_name,
-            })
-            utils.write_file(config_filename, config)
-
-        # Create lambda and package config information with it
-        generate_tracker_config(workflow_id)
-        tracker.generate_code(tracker_filename)
-        tracker_arn = self.awslambda \
-                         .create_or_update_function(tracker_name,
-                                                    runtime,
-                                                    handler,
-                                                    description=description,
-                                                    local_filename=tracker_filename,
-                                                    otherfiles=[config_filename])
-        log.info("Created workflow tracker, tracker=%s, workflow_id=%s" % (tracker_name, workflow_id))
+        tracker_arn = self.setup_tracker_function(workflow_id)
 
         # Subscribe lambda to streams in the workflow
         for stream_arn in stream_arns:
-            self.awslambda.subscribe_to_stream(tracker_arn, stream_arn)
-            log.info("Subscribed tracker to stream, tracker=%s, stream=%s" % (tracker_name, utils.get_name_from_arn(stream_arn)))
+            self.subscribe_tracker(workflow_id, tracker_arn, stream_arn, settings)
 
         # Create log group for lambda to log stream events
+        self.setup_tracker_log_group(workflow_id)
+
+    def _get_tracking(self, workflow_id):
+        ''' Returns the `tracking` settings of a workflow '''
+        workflows = self.config.get('workflows') or []
+        workflow = [w for w in workflows if w['id'] == workflow_id]
+        return (workflow[0].get('tracking') if workflow else None) or {}
+
+    def _generate_tracker_config(self, workflow_id):
+        tracking = self._get_tracking(workflow_id)
+        config = {
+            "workflow_id": workflow_id,
+            "log_group_name": self._generate_log_group_name(workflow_id),
+            "layout": tracking.get('layout', tracker.LAYOUT_EXECUTION)
+        }
+        if config['layout'] == tracker.LAYOUT_BUCKETED:
+            config['buckets'] = tracking.get('buckets', tracker.DEFAULT_LOG_BUCKETS)
+        return config
+
+    def _get_tracker_digest(self, workflow_id):
+        code_digest = file_digest([tracker.source_file(), envelope.source_file()])
+        return fingerprint({'code': code_digest, 'config': self._generate_tracker_config(workflow_id)})
+
+    def _get_tracker_settings(self, workflow_id):
+        return ("tracker_%s" % workflow_id, "python2.7", "log",
+                "A tracker that logs events from streams defined in workflow %s" % workflow_id)
+
+    def setup_tracker_function(self, workflow_id):
+        ''' Creates or updates the tracker lambda of a workflow and returns
+        its ARN.
+        '''
+        tracker_name, runtime, handler, description = self._get_tracker_settings(workflow_id)
+
+        # Create lambda and package config information with it. The files
+        # are packaged in memory, so trackers can be created concurrently.
+        files = [
+            ("%s.py" % tracker_name, utils.read_file(tracker.source_file())),
+            ("tracker.cfg", json.dumps(self._generate_tracker_config(workflow_id)))
+        ]
+        code_digest = self._get_tracker_digest(workflow_id) if self.manifest else None
+        tracker_arn = self._deploy_function('tracker:%s' % workflow_id,
+                                            tracker_name,
+                                            runtime,
+                                            handler,
+                                            description,
+                                            code_digest,
+                                            files=files,
+                                            otherfiles=[envelope.source_file()])
+        log.info("Created workflow tracker, tracker=%s, workflow_id=%s" % (tracker_name, workflow_id))
+        return tracker_arn
+
+    def subscribe_tracker(self, workflow_id, tracker_arn, stream_arn, settings=None):
+        event_name = stream_arn.rsplit('/', 1)[-1]
+        self._subscribe('tracker_subscription:%s:%s' % (workflow_id, event_name), tracker_arn, stream_arn, settings)
+        log.info("Subscribed tracker to stream, tracker=tracker_%s, stream=%s" % (workflow_id, utils.get_name_from_arn(stream_arn)))
+
+    def _plan_log_group(self, workflow_id):
+        ''' Returns the action that sets up the log group of a workflow. A
+        log group that was deleted outside of xflow since the manifest was
+        written is created again.
+        '''
+        if not self.manifest.get('log_group:%s' % workflow_id) or \
+                not self.cwlogs.log_group_exists(self._generate_log_group_name(workflow_id)):
+            return ACTION_CREATE
+        return ACTION_NOOP
+
+    def setup_tracker_log_group(self, workflow_id):
+        resource = 'log_group:%s' % workflow_id
+        log_group_name = self._generate_log_group_name(workflow_id)
+        if self.manifest and self._plan_log_group(workflow_id) == ACTION_NOOP:
+            log.info("Workflow log group unchanged, workflow_id=%s" % workflow_id)
+            return
         self.cwlogs.create_log_group(log_group_name)
+        if self.manifest:
+            self.manifest.set(resource, {'name': log_group_name})
         log.info("Created workflow log group, workflow_id=%s, log_group=%s" % (workflow_id, log_group_name))
 
 
@@ -199,7 +676,7 @@ class Engine(object):
             log.info("Setting up workflow, workflow_id=%s" % workflow_id)
             stream_names = w['flow']
             stream_arns = [stream_mappings[name] for name in stream_names]
-            self.setup_tracker(workflow_id, stream_arns)
+            self.setup_tracker(workflow_id, stream_arns, self._get_mapping_settings(w))
             log.info("Created workflow, workflow_id=%s" % workflow_id)
 
     @staticmethod
@@ -218,10 +695,36 @@ class Engine(object):
         subscriptions = config.get('subscriptions') or []
         lambdas = config.get('lambdas') or []
         lambda_names = [l['name'] for l in lambdas]
+        for l in lambdas:
+            if l.get('requirements') and not supports_requirements(l['runtime']):
+                raise ConfigValidationError("Requirements are not supported for runtime %s of lambda %s" \
+                                            % (l['runtime'], l['name']))
+            if l.get('provisioned_concurrency') and l.get('reserved_concurrency') is not None \
+               and l['provisioned_concurrency'] > l['reserved_concurrency']:
+                raise ConfigValidationError("Provisioned concurrency exceeds reserved concurrency of lambda %s" \
+                                            % l['name'])
+        general_config = config.get('general') or {}
+        partition_key_config = general_config.get('partition_key') or {}
+        if partition_key_config.get('strategy') == 'field' and not partition_key_config.get('field'):
+            raise ConfigValidationError("Partition key field not defined for strategy 'field'")
+
+        def validate_mapping(entry, name):
+            max_record_age = (entry.get('mapping') or {}).get('max_record_age')
+            if max_record_age is not None and 0 <= max_record_age < MAPPING_MIN_RECORD_AGE:
+                raise ConfigValidationError("Maximum record age of %s must be -1 or at least %s seconds" \
+                                            % (name, MAPPING_MIN_RECORD_AGE))
+
         subscription_events = []
         for ss in subscriptions:
             event_name = ss['event']
             subscription_events.append(event_name)
+            validate_mapping(ss, event_name)
+            if ss.get('schema'):
+                try:
+                    validator = jsonschema.validators.validator_for(ss['schema'])
+                    validator.check_schema(ss['schema'])
+                except jsonschema.SchemaError as ex:
+                    raise ConfigValidationError("Invalid schema for event %s. %s" % (event_name, ex.message))
             subscribers = ss.get('subscribers') or []
             for s in subscribers:
                 if s not in lambda_names:
@@ -230,21 +733,258 @@ class Engine(object):
         workflows = config.get('workflows') or []
         for w in workflows:
             workflow_id = w['id']
+            validate_mapping(w, workflow_id)
             events = w.get('flow') or []
             for e in events:
                 if e not in subscription_events:
                     raise ConfigValidationError("Event %s not defined in workflow %s" % (e, workflow_id))
 
-    def configure(self):
-        ''' Creates the lambda functions, streams and lambda to stream mappings '''
-        lambda_mappings = self.setup_lambdas()
-        stream_mappings = self.setup_streams_and_subscriptions(lambda_mappings)
-        self.setup_workflows(stream_mappings)
+    def configure(self, workers=None, incremental=False):
+        ''' Creates the lambda functions, streams and lambda to stream mappings.
+        With more than one worker independent resources are set up in parallel.
+
+        An incremental configure records the deployed resources in the
+        manifest and skips the ones that did not change since. The manifest
+        is saved even if configuring fails, so a retry resumes from the
+        resources that were set up.
+        '''
+        workers = workers or self.configure_workers
+        if incremental:
+            self.manifest = Manifest(self.manifest_path)
+        self.configure_status = CONFIGURE_RUNNING
+        try:
+            if workers > 1:
+                self.configure_parallel(workers)
+            else:
+                # Streams come first so that publishing to them can start
+                # while the lambdas are deployed
+                stream_mappings = self.setup_streams()
+                lambda_mappings = self.setup_lambdas()
+                self.setup_subscriptions(lambda_mappings, stream_mappings)
+                self.setup_workflows(stream_mappings)
+            self.configure_status = CONFIGURE_DONE
+        except Exception as ex:
+            self.configure_status = CONFIGURE_FAILED
+            self.configure_error = str(ex)
+            raise
+        finally:
+            if self.manifest:
+                self.manifest.save()
+                self.manifest = None
+
+    def configure_in_background(self, workers=None, incremental=False):
+        ''' Runs configure in a background thread and returns the thread.
+        Until it finishes only the streams it set up are ready.
+        '''
+        def run():
+            try:
+                self.configure(workers=workers, incremental=incremental)
+                log.info('Configured in background')
+            except Exception as ex:
+                log.error('Configure failed, error=%s' % str(ex))
+
+        self.configure_status = CONFIGURE_RUNNING
+        thread = threading.Thread(target=run, name='xflow-configure')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def is_ready(self):
+        return self.configure_status in (CONFIGURE_PENDING, CONFIGURE_DONE)
+
+    def is_stream_ready(self, stream_name):
+        return self.is_ready() or stream_name in self.ready_streams
+
+    def get_readiness(self):
+        return {
+            'ready': self.is_ready(),
+            'status': self.configure_status,
+            'error': self.configure_error,
+            'ready_streams': sorted(self.ready_streams)
+        }
+
+    def plan(self):
+        ''' Returns the changes an incremental configure would make, as a
+        list of resources with the action taken on them.
+        '''
+        # Planning only reads the execution role, it is neither created
+        # nor are its policies changed
+        with self.services_lock:
+            read_only_lambda = 'awslambda' not in self.services
+            if read_only_lambda:
+                self.services['awslambda'] = self.service_factories['awslambda'](read_only=True)
+        self.manifest = Manifest(self.manifest_path)
+        changes = []
+
+        def add(resource, action):
+            changes.append({'resource': resource, 'action': action})
+
+        def plan_subscription(resource, function_resource, stream_resource, settings):
+            function_state = self.manifest.get(function_resource) or {}
+            stream_state = self.manifest.get(stream_resource) or {}
+            add(resource, self._plan_subscription(resource, function_state.get('arn'),
+                                                  stream_state.get('arn'), settings))
+
+        try:
+            for l in self.config.get('lambdas') or []:
+                settings = self.awslambda.get_function_settings(l['runtime'], l['handler'], l['description'],
+                                                                self._get_layers(l, publish=False),
+                                                                **self._get_function_options(l))
+                add('lambda:%s' % l['name'],
+                    self._plan_function('lambda:%s' % l['name'], l['name'], self._get_code_digest(l), settings))
+
+            for s in self.config.get('subscriptions') or []:
+                event_name = s['event']
+                add('stream:%s' % event_name, self._plan_stream(s))
+                for lambda_name in s.get('subscribers') or []:
+                    plan_subscription('subscription:%s:%s' % (event_name, lambda_name),
+                                      'lambda:%s' % lambda_name, 'stream:%s' % event_name,
+                                      self._get_mapping_settings(s))
+
+            for w in self.config.get('workflows') or []:
+                workflow_id = w['id']
+                tracker_name, runtime, handler, description = self._get_tracker_settings(workflow_id)
+                settings = self.awslambda.get_function_settings(runtime, handler, description)
+                add('tracker:%s' % workflow_id,
+                    self._plan_function('tracker:%s' % workflow_id, tracker_name,
+                                        self._get_tracker_digest(workflow_id), settings))
+                add('log_group:%s' % workflow_id, self._plan_log_group(workflow_id))
+                for event_name in w['flow']:
+                    plan_subscription('tracker_subscription:%s:%s' % (workflow_id, event_name),
+                                      'tracker:%s' % workflow_id, 'stream:%s' % event_name,
+                                      self._get_mapping_settings(w))
+        finally:
+            self.manifest = None
+            if read_only_lambda:
+                with self.services_lock:
+                    del self.services['awslambda']
+        return changes
+
+    def configure_parallel(self, workers):
+        ''' Sets up all resources with a `TaskGraph`. Lambdas, streams and
+        log groups are created concurrently and every subscription starts as
+        soon as its lambda and stream exist.
+        '''
+        log.info('Configuring in parallel, workers=%s' % workers)
+        graph = TaskGraph(workers=workers)
+
+        def task(func, *args):
+            return lambda results: func(*args)
+
+        for l in self.config.get('lambdas') or []:
+            graph.add('lambda:%s' % l['name'], task(self.setup_function, l))
+
+        for s in self.config.get('subscriptions') or []:
+            event_name = s['event']
+            graph.add('stream:%s' % event_name, task(self.setup_stream, s))
+            settings = self._get_mapping_settings(s)
+            for lambda_name in s.get('subscribers') or []:
+                lambda_task, stream_task = 'lambda:%s' % lambda_name, 'stream:%s' % event_name
+                graph.add('subscription:%s:%s' % (event_name, lambda_name),
+                          lambda results, e=event_name, n=lambda_name, l=lambda_task, s=stream_task, m=settings: \
+                              self.subscribe_function(e, n, results[l], results[s], m),
+                          dependencies=[lambda_task, stream_task])
+
+        for w in self.config.get('workflows') or []:
+            workflow_id = w['id']
+            tracker_task = 'tracker:%s' % workflow_id
+            graph.add(tracker_task, task(self.setup_tracker_function, workflow_id))
+            graph.add('log_group:%s' % workflow_id, task(self.setup_tracker_log_group, workflow_id))
+            settings = self._get_mapping_settings(w)
+            for event_name in w['flow']:
+                stream_task = 'stream:%s' % event_name
+                graph.add('tracker_subscription:%s:%s' % (workflow_id, event_name),
+                          lambda results, w=workflow_id, t=tracker_task, s=stream_task, m=settings: \
+                              self.subscribe_tracker(w, results[t], results[s], m),
+                          dependencies=[tracker_task, stream_task])
+
+        graph.run()
+        log.info('Configured all lambdas, streams, subscriptions and workflows')
 
     def publish(self, stream_name, data):
-        self.kinesis.publish(stream_name, data)
+        if self.producer:
+            self.producer.put(stream_name, data)
+        else:
+            self.kinesis.publish(stream_name, data)
         log.debug('publishing, stream=%s, data=%s' % (stream_name, data))
 
+    def publish_batch(self, stream_name, records):
+        ''' Publishes a list of records synchronously with PutRecords.
+        Returns the PutRecords result entry of every record.
+        '''
+        results = self.kinesis.publish_batch(stream_name, records)
+        log.debug('publishing batch, stream=%s, records=%s' % (stream_name, len(records)))
+        return results
+
+    def submit(self, stream_name, data, block=False):
+        ''' Queues data to be published asynchronously by the pipeline.
+        Returns a `PendingPublish` that can be waited on for acknowledgement.
+        '''
+        pending = self.pipeline.submit(stream_name, data, block=block)
+        log.debug('queued, stream=%s, data=%s' % (stream_name, data))
+        return pending
+
+    def publish_lines(self, stream_name, lines):
+        ''' Publishes every non-empty line as a record using pipelined
+        batched writes. Lines that are not valid json are skipped.
+        Returns a summary of the throughput.
+        '''
+        pipeline = self.pipeline or self.setup_pipeline({})
+        counts = collections.Counter()
+        lock = threading.Lock()
+
+        def on_done(pending):
+            with lock:
+                counts['failed' if pending.error else 'published'] += 1
+
+        start = time.time()
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            if not utils.is_valid_json(line):
+                counts['invalid'] += 1
+                continue
+            pipeline.submit(stream_name, line, block=True, callback=on_done)
+            counts['records'] += 1
+
+        # Wait until every queued record is published
+        if pipeline is self.pipeline:
+            while counts['published'] + counts['failed'] < counts['records']:
+                time.sleep(0.05)
+        else:
+            pipeline.close()
+        elapsed = time.time() - start
+
+        summary = {
+            'stream': stream_name,
+            'records': counts['records'],
+            'published': counts['published'],
+            'failed': counts['failed'],
+            'invalid': counts['invalid'],
+            'elapsed_seconds': round(elapsed, 3),
+            'records_per_second': round(counts['published'] / elapsed, 1) if elapsed else 0,
+            'kinesis': self.kinesis.get_stats()
+        }
+        log.info('Published lines, stream=%s, published=%s, failed=%s, invalid=%s' \
+                 % (stream_name, summary['published'], summary['failed'], summary['invalid']))
+        return summary
+
+    def close(self):
+        ''' Flushes the events buffered by the producer and the pipeline.
+        Returns the number of events of the producer that could not be
+        published, those of the pipeline are reported per event.
+        '''
+        pipeline, producer = self.services.get('pipeline'), self.services.get('producer')
+        if pipeline:
+            pipeline.close()
+        if producer:
+            failed = producer.close()
+            for stream_name, error in producer.errors.items():
+                log.error('Publishing failed, stream=%s, error=%s' % (stream_name, error))
+            return failed
+        return 0
+
     def _generate_execution_path(self, workflow_state):
         ''' Generates the execution path in an instance of a workflow.
 
@@ -275,11 +1015,17 @@ class Engine(object):
 
     def _get_log_events(self, workflow_id, execution_id):
         ''' Gets the log events for a particular execution in a workflow '''
-        log_group_name = self._generate_log_group_name(workflow_id)
-        log_stream_name = tracker.generate_log_stream_name(log_group_name, execution_id)
+        tracker_config = self._generate_tracker_config(workflow_id)
+        log_group_name = tracker.get_log_group_name(tracker_config)
+        log_stream_name = tracker.get_log_stream_name(tracker_config, execution_id)
         logged_events = []
         try:
-            logged_events = self.cwlogs.get_log_events(log_group_name, log_stream_name)
+            if tracker.get_layout(tracker_config) == tracker.LAYOUT_BUCKETED:
+                # Bucket streams hold the events of many executions
+                logged_events = self.cwlogs.filter_log_events(log_group_name, log_stream_name,
+                                                              '{ $.execution_id = %s }' % json.dumps(execution_id))
+            else:
+                logged_events = self.cwlogs.get_log_events(log_group_name, log_stream_name)
         except CloudWatchStreamDoesNotExist as ex:
             log.error("""No executions found, workflow_id=%s,
                       execution_id=%s""" % (workflow_id, execution_id))
@@ -0,0 +1,116 @@
+''' Envelope of the records xFlow writes to Kinesis.
+
+Many small events can be aggregated into a single Kinesis record. Such a
+record starts with `AGGREGATED_PREFIX` followed by every event prefixed with
+its length as a 4 byte big-endian integer. A record can also be compressed,
+it then starts with the prefix of its compression (see
+`COMPRESSION_PREFIXES`) followed by the compressed record. Any other record
+is a single event.
+
+This module only depends on the standard library so that it can be packaged
+with lambda functions. Subscribers use `decode_records` to get the events of
+a Kinesis invocation regardless of how they were published:
+
+    import envelope
+
+    def handler(event, context):
+        for payload in envelope.decode_records(event):
+            data = json.loads(payload)
+'''
+import os
+import zlib
+import base64
+import struct
+
+
+AGGREGATED_PREFIX = 'xfa1:'
+COMPRESSION_ZLIB = 'zlib'
+COMPRESSION_PREFIXES = {
+    COMPRESSION_ZLIB: 'xfz1:'
+}
+KINESIS_MAX_RECORD_BYTES = 1024 * 1024
+
+_LENGTH = struct.Struct('>I')
+
+
+def is_aggregated(data):
+    return data.startswith(AGGREGATED_PREFIX)
+
+
+def aggregate(payloads, max_bytes=KINESIS_MAX_RECORD_BYTES):
+    ''' Packs payloads into as few aggregated records of at most `max_bytes`
+    bytes as possible, keeping their order. Returns a list of
+    (record, indexes) tuples where `indexes` are the positions of the
+    payloads packed in the record. A payload that does not fit with any
+    other is returned as is.
+    '''
+    records = []
+    parts, indexes, size = [], [], len(AGGREGATED_PREFIX)
+
+    def pack():
+        if len(indexes) == 1:
+            records.append((payloads[indexes[0]], indexes))
+        else:
+            records.append((AGGREGATED_PREFIX + ''.join(parts), indexes))
+
+    for i, payload in enumerate(payloads):
+        part_size = _LENGTH.size + len(payload)
+        if parts and size + part_size > max_bytes:
+            pack()
+            parts, indexes, size = [], [], len(AGGREGATED_PREFIX)
+        parts.append(_LENGTH.pack(len(payload)) + payload)
+        indexes.append(i)
+        size += part_size
+    if parts:
+        pack()
+    return records
+
+
+def deaggregate(data):
+    ''' Returns the list of payloads in a record '''
+    if not is_aggregated(data):
+        return [data]
+    payloads = []
+    offset = len(AGGREGATED_PREFIX)
+    while offset < len(data):
+        length, = _LENGTH.unpack_from(data, offset)
+        offset += _LENGTH.size
+        payloads.append(data[offset:offset + length])
+        offset += length
+    return payloads
+
+
+def compress(data, compression=COMPRESSION_ZLIB):
+    ''' Compresses a record. The record is returned as is if compressing
+    does not make it smaller.
+    '''
+    compressed = COMPRESSION_PREFIXES[compression] + zlib.compress(data)
+    return compressed if len(compressed) < len(data) else data
+
+
+def decompress(data):
+    if data.startswith(COMPRESSION_PREFIXES[COMPRESSION_ZLIB]):
+        return zlib.decompress(data[len(COMPRESSION_PREFIXES[COMPRESSION_ZLIB]):])
+    return data
+
+
+def decode(data):
+    ''' Returns the list of payloads in a, possibly compressed, record '''
+    return deaggregate(decompress(data))
+
+
+def decode_record(record):
+    ''' Returns the payloads of a record in a Kinesis lambda event '''
+    return decode(base64.b64decode(record['kinesis']['data']))
+
+
+def decode_records(event):
+    ''' Yields the payloads of all records in a Kinesis lambda event '''
+    for record in event['Records']:
+        for payload in decode_record(record):
+            yield payload
+
+
+def source_file():
+    ''' Returns the path of this module so it can be packaged with lambdas '''
+    return os.path.splitext(os.path.abspath(__file__))[0] + '.py'
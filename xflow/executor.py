@@ -0,0 +1,104 @@
+import Queue
+import logging
+import threading
+import collections
+
+
+log = logging.getLogger(__name__)
+
+
+class TaskFailed(Exception):
+    pass
+
+
+class TaskGraph(object):
+    ''' Runs tasks on a pool of worker threads. A task is started as soon as
+    all the tasks it depends on are done, independent tasks run
+    concurrently.
+
+    A task is a function that gets the results of all finished tasks, keyed
+    by task name. When a task fails no more tasks are started, the running
+    ones are waited for and `run` raises `TaskFailed`.
+    '''
+
+    _STOP = object()
+
+    def __init__(self, workers=4):
+        self.workers = max(1, workers)
+        self.tasks = collections.OrderedDict()
+
+    def add(self, name, func, dependencies=()):
+        self.tasks[name] = (func, list(dependencies))
+
+    def _validate(self):
+        for name, (_, dependencies) in self.tasks.items():
+            for d in dependencies:
+                if d not in self.tasks:
+                    raise TaskFailed('Unknown dependency %s of task %s' % (d, name))
+
+    def _run_worker(self, work, done, results):
+        while True:
+            name = work.get()
+            if name is TaskGraph._STOP:
+                break
+            func = self.tasks[name][0]
+            try:
+                done.put((name, func(results), None))
+            except Exception as ex:
+                log.error('Task failed, task=%s, error=%s' % (name, str(ex)))
+                done.put((name, None, ex))
+
+    def run(self):
+        ''' Runs all tasks and returns their results keyed by task name '''
+        self._validate()
+        results = {}
+        remaining = {name: len(deps) for name, (_, deps) in self.tasks.items()}
+        dependents = collections.defaultdict(list)
+        for name, (_, dependencies) in self.tasks.items():
+            for d in dependencies:
+                dependents[d].append(name)
+
+        work, done = Queue.Queue(), Queue.Queue()
+        threads = []
+        for i in range(min(self.workers, len(self.tasks))):
+            t = threading.Thread(target=self._run_worker, args=(work, done, results), name='xflow-task-%s' % i)
+            t.daemon = True
+            t.start()
+            threads.append(t)
+
+        running = 0
+        for name, count in remaining.items():
+            if count == 0:
+                work.put(name)
+                running += 1
+
+        failures = []
+        finished = 0
+        while running:
+            name, result, error = done.get()
+            running -= 1
+            finished += 1
+            if error:
+                failures.append((name, error))
+                continue
+            results[name] = result
+            if failures:
+                continue
+            for dependent in dependents[name]:
+                remaining[dependent] -= 1
+                if remaining[dependent] == 0:
+                    work.put(dependent)
+                    running += 1
+
+        for t in threads:
+            work.put(TaskGraph._STOP)
+        for t in threads:
+            t.join()
+
+        if failures:
+            name, error = failures[0]
+            raise TaskFailed('task=%s, error=%s' % (name, str(error)))
+        if finished < len(self.tasks):
+            raise TaskFailed('Dependency cycle between tasks %s' \
+                             % ', '.join(n for n, c in remaining.items() if c))
+        return results
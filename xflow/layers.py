@@ -0,0 +1,82 @@
+''' Dependency layers of lambdas.
+
+A lambda's `requirements` file is installed once into a Lambda layer that
+is shared by every lambda with the same requirements, so deploying a lambda
+only uploads its own code. Layers are named after the digest of their
+requirements and runtime, which makes a published layer reusable as is.
+'''
+import os
+import sys
+import shutil
+import hashlib
+import logging
+import tempfile
+import subprocess
+
+import utils
+
+
+log = logging.getLogger(__name__)
+
+# Directory of a layer that a runtime adds to its import path
+RUNTIME_LAYER_DIRS = {
+    'python2.7': 'python'
+}
+
+# Pip options to install wheels for the platform of a runtime rather than
+# for the host, since packages with native extensions built on the host do
+# not load on Lambda.
+RUNTIME_PIP_OPTIONS = {
+    'python2.7': ['--platform', 'manylinux1_x86_64', '--only-binary=:all:',
+                  '--python-version', '2.7', '--implementation', 'cp', '--abi', 'cp27mu']
+}
+
+
+class LayerBuildError(Exception):
+    pass
+
+
+def supports_requirements(runtime):
+    return runtime in RUNTIME_LAYER_DIRS
+
+
+def requirements_digest(requirements_file, runtime):
+    digest = hashlib.sha256(runtime)
+    digest.update(' '.join(RUNTIME_PIP_OPTIONS[runtime]))
+    with open(requirements_file, 'rb') as f:
+        digest.update(f.read())
+    return digest.hexdigest()
+
+
+def layer_name(digest):
+    return 'xflow-deps-%s' % digest[:16]
+
+
+def build_layer(requirements_file, runtime):
+    ''' Installs requirements with pip and returns the zip archive of the
+    layer. Only binary wheels for the platform of the runtime are installed,
+    so requirements that are only available as source distributions cannot
+    be built into a layer.
+    '''
+    build_dir = tempfile.mkdtemp(prefix='xflow-layer-')
+    target = os.path.join(build_dir, RUNTIME_LAYER_DIRS[runtime])
+    try:
+        log.info('Installing layer requirements, requirements=%s' % requirements_file)
+        try:
+            subprocess.check_call([sys.executable, '-m', 'pip', 'install', '--quiet',
+                                   '--requirement', requirements_file, '--target', target] +
+                                  RUNTIME_PIP_OPTIONS[runtime])
+        except (OSError, subprocess.CalledProcessError) as ex:
+            raise LayerBuildError('Unable to install %s. %s' % (requirements_file, str(ex)))
+
+        files = []
+        for root, _, filenames in os.walk(build_dir):
+            for filename in filenames:
+                if filename.endswith('.pyc'):
+                    continue
+                path = os.path.join(root, filename)
+                with open(path, 'rb') as f:
+                    files.append((os.path.relpath(path, build_dir), f.read()))
+        return utils.zip_files(files)
+    finally:
+        shutil.rmtree(build_dir, ignore_errors=True)
@@ -0,0 +1,60 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+
+
+log = logging.getLogger(__name__)
+
+
+def fingerprint(obj):
+    ''' Returns a digest of a json serializable object '''
+    return hashlib.sha256(json.dumps(obj, sort_keys=True)).hexdigest()
+
+
+def file_digest(filenames):
+    ''' Returns a digest of the names and contents of files '''
+    digest = hashlib.sha256()
+    for filename in filenames:
+        digest.update(os.path.basename(filename))
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), ''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Manifest(object):
+    ''' The deployed state of the resources of a config.
+
+    Every resource, e.g. `lambda:<name>` or `stream:<event>`, is recorded
+    with the digests of its code and settings at the time it was deployed
+    and the identifiers AWS returned for it, so that unchanged resources can
+    be skipped on the next configure.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.resources = {}
+        if os.path.isfile(path):
+            with open(path) as f:
+                self.resources = json.load(f).get('resources', {})
+            log.debug('Manifest loaded, manifest=%s, resources=%s' % (path, len(self.resources)))
+
+    def get(self, resource):
+        with self.lock:
+            return self.resources.get(resource)
+
+    def set(self, resource, state):
+        with self.lock:
+            self.resources[resource] = state
+
+    def save(self):
+        with self.lock:
+            contents = json.dumps({'resources': self.resources}, indent=2, sort_keys=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(contents)
+        os.rename(tmp_path, self.path)
+        log.info('Manifest saved, manifest=%s' % self.path)
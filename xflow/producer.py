@@ -0,0 +1,262 @@
+import time
+import Queue
+import logging
+import threading
+import collections
+
+from aws import KinesisStreamDoesNotExist, \
+                KINESIS_MAX_BATCH_RECORDS, KINESIS_MAX_BATCH_BYTES
+
+
+log = logging.getLogger(__name__)
+
+
+class ProducerClosed(Exception):
+    pass
+
+
+class BufferedProducer(object):
+    ''' Buffers events per stream and publishes them with PutRecords.
+
+    A stream's buffer is flushed as soon as it holds `max_records` records or
+    `max_bytes` bytes, or once its oldest record has waited `linger_time`
+    seconds. Records of a stream are always flushed in the order they were
+    put. Call `close` on shutdown so that buffered records are not lost.
+
+    Records are written in the background, so `put` does not fail when they
+    can not be published. The records that failed are counted in `failed`
+    with the last error of their stream in `errors`.
+    '''
+
+    def __init__(self, kinesis, max_records=KINESIS_MAX_BATCH_RECORDS,
+                 max_bytes=KINESIS_MAX_BATCH_BYTES, linger_time=0.5):
+        if linger_time <= 0:
+            raise ValueError('linger_time must be positive, linger_time=%s' % linger_time)
+        self.kinesis = kinesis
+        self.max_records = min(max_records, KINESIS_MAX_BATCH_RECORDS)
+        self.max_bytes = min(max_bytes, KINESIS_MAX_BATCH_BYTES)
+        self.linger_time = linger_time
+        self.buffers = {}
+        self.buffer_sizes = {}
+        self.buffer_times = {}
+        self.lock = threading.Lock()
+        self.stream_locks = {}
+        self.failed = 0
+        self.errors = {}
+        self.closed = threading.Event()
+        self.flusher = threading.Thread(target=self._run_flusher, name='xflow-producer')
+        self.flusher.daemon = True
+        self.flusher.start()
+
+    def _get_stream_lock(self, stream_name):
+        with self.lock:
+            return self.stream_locks.setdefault(stream_name, threading.Lock())
+
+    def _take(self, stream_name):
+        ''' Removes and returns the buffered records of a stream.
+        Must be called with `self.lock` held.
+        '''
+        records = self.buffers.pop(stream_name, [])
+        self.buffer_sizes.pop(stream_name, None)
+        self.buffer_times.pop(stream_name, None)
+        return records
+
+    def _flush_stream(self, stream_name):
+        # The stream lock is taken before the buffer is emptied so that
+        # batches of the same stream are sent in the order they were taken.
+        with self._get_stream_lock(stream_name):
+            with self.lock:
+                records = self._take(stream_name)
+            if records:
+                self._send(stream_name, records)
+
+    def _add_failures(self, stream_name, count, error):
+        with self.lock:
+            self.failed += count
+            self.errors[stream_name] = error
+
+    def _send(self, stream_name, records):
+        try:
+            results = self.kinesis.publish_batch(stream_name, records)
+        except KinesisStreamDoesNotExist as ex:
+            log.error('Dropped records, stream does not exist, stream_name=%s, records=%s' % (stream_name, len(records)))
+            self._add_failures(stream_name, len(records), 'KinesisStreamDoesNotExist: %s' % str(ex))
+            return
+        except Exception as ex:
+            log.error('Dropped records, stream_name=%s, records=%s, error=%s' % (stream_name, len(records), str(ex)))
+            self._add_failures(stream_name, len(records), '%s: %s' % (type(ex).__name__, str(ex)))
+            return
+        failed = [r for r in results if r.get('ErrorCode')]
+        if failed:
+            self._add_failures(stream_name, len(failed),
+                               '%s: %s' % (failed[-1]['ErrorCode'], failed[-1].get('ErrorMessage')))
+        log.debug('Flushed records, stream_name=%s, records=%s, failed=%s' % (stream_name, len(records), len(failed)))
+
+    def _run_flusher(self):
+        while not self.closed.wait(self.linger_time / 2.0):
+            now = time.time()
+            with self.lock:
+                expired = [s for s, t in self.buffer_times.items() if now - t >= self.linger_time]
+            for stream_name in expired:
+                self._flush_stream(stream_name)
+
+    def put(self, stream_name, data):
+        if self.closed.is_set():
+            raise ProducerClosed('stream_name=%s' % stream_name)
+        with self.lock:
+            if stream_name not in self.buffers:
+                self.buffers[stream_name] = []
+                self.buffer_sizes[stream_name] = 0
+                self.buffer_times[stream_name] = time.time()
+            self.buffers[stream_name].append(data)
+            self.buffer_sizes[stream_name] += len(data)
+            full = len(self.buffers[stream_name]) >= self.max_records or \
+                   self.buffer_sizes[stream_name] >= self.max_bytes
+        if full:
+            self._flush_stream(stream_name)
+
+    def flush(self):
+        with self.lock:
+            stream_names = self.buffers.keys()
+        for stream_name in stream_names:
+            self._flush_stream(stream_name)
+
+    def close(self):
+        ''' Stops the background flusher, flushes all buffered records and
+        returns the number of records that could not be published.
+        '''
+        if not self.closed.is_set():
+            self.closed.set()
+            self.flusher.join()
+            self.flush()
+            log.info('Producer closed, failed=%s' % self.failed)
+        return self.failed
+
+
+class QueueFull(Exception):
+    pass
+
+
+class PendingPublish(object):
+    ''' A record submitted to the `PublishPipeline`. Once the record has
+    been written `result` holds its PutRecords result entry, or `error`
+    holds the reason it could not be published.
+    '''
+
+    def __init__(self, stream_name, data, callback=None):
+        self.stream_name = stream_name
+        self.data = data
+        self.callback = callback
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    def _set_done(self):
+        self.done.set()
+        if self.callback:
+            self.callback(self)
+
+    def set_result(self, result):
+        self.result = result
+        if result.get('ErrorCode'):
+            self.error = '%s: %s' % (result['ErrorCode'], result.get('ErrorMessage'))
+        self._set_done()
+
+    def set_error(self, error):
+        self.error = error
+        self._set_done()
+
+    def wait(self, timeout=None):
+        ''' Waits until the record is acknowledged by Kinesis.
+        Returns False if it timed out.
+        '''
+        return self.done.wait(timeout)
+
+
+class PublishPipeline(object):
+    ''' Publishes records asynchronously from bounded in-process queues.
+
+    Every worker owns a queue and drains up to `max_records` records at a
+    time, publishing them with PutRecords. Records are routed to workers by
+    their partition key so that records of the same execution are written
+    in the order they were submitted. Submitting to a full queue raises
+    `QueueFull` unless `block` is set.
+    '''
+
+    _STOP = object()
+
+    def __init__(self, kinesis, workers=4, queue_size=10000,
+                 max_records=KINESIS_MAX_BATCH_RECORDS):
+        self.kinesis = kinesis
+        self.max_records = min(max_records, KINESIS_MAX_BATCH_RECORDS)
+        self.closed = False
+        self.queues = [Queue.Queue(maxsize=max(1, queue_size / workers)) for _ in range(workers)]
+        self.workers = []
+        for i, q in enumerate(self.queues):
+            worker = threading.Thread(target=self._run_worker, args=(q,), name='xflow-publisher-%s' % i)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def qsize(self):
+        return sum(q.qsize() for q in self.queues)
+
+    def submit(self, stream_name, data, block=False, timeout=None, callback=None):
+        ''' Queues a record. `callback` is called with the `PendingPublish`
+        from a worker thread once the record is published or failed.
+        '''
+        if self.closed:
+            raise ProducerClosed('stream_name=%s' % stream_name)
+        pending = PendingPublish(stream_name, data, callback=callback)
+        key = self.kinesis.partition_key(data)
+        q = self.queues[hash((stream_name, key)) % len(self.queues)]
+        try:
+            q.put(pending, block, timeout)
+        except Queue.Full:
+            raise QueueFull('stream_name=%s' % stream_name)
+        return pending
+
+    def _run_worker(self, q):
+        stop = False
+        while not stop:
+            batch = [q.get()]
+            while len(batch) < self.max_records:
+                try:
+                    batch.append(q.get_nowait())
+                except Queue.Empty:
+                    break
+            if PublishPipeline._STOP in batch:
+                stop = True
+                batch = [p for p in batch if p is not PublishPipeline._STOP]
+
+            streams = collections.OrderedDict()
+            for pending in batch:
+                streams.setdefault(pending.stream_name, []).append(pending)
+            for stream_name, records in streams.items():
+                self._send(stream_name, records)
+
+    def _send(self, stream_name, records):
+        try:
+            results = self.kinesis.publish_batch(stream_name, [p.data for p in records])
+        except KinesisStreamDoesNotExist as ex:
+            for pending in records:
+                pending.set_error(ex)
+            return
+        except Exception as ex:
+            log.error('Unable to publish records, stream_name=%s, records=%s, error=%s' % (stream_name, len(records), str(ex)))
+            for pending in records:
+                pending.set_error(ex)
+            return
+        for pending, result in zip(records, results):
+            pending.set_result(result)
+
+    def close(self):
+        ''' Stops accepting records and waits until the queued ones are published '''
+        if self.closed:
+            return
+        self.closed = True
+        for q in self.queues:
+            q.put(PublishPipeline._STOP)
+        for worker in self.workers:
+            worker.join()
+        log.info('Publish pipeline closed')
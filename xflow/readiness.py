@@ -0,0 +1,90 @@
+''' Waiting for AWS resources to become usable.
+
+Resources that were just created, like streams, functions and roles, take
+a while until they can be used. Instead of sleeping for fixed intervals,
+calls are retried with exponential backoff and jitter, or polled with boto
+waiters, until an overall deadline.
+'''
+import time
+import logging
+import botocore
+
+import utils
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = 120
+
+
+class ReadinessTimeout(Exception):
+    pass
+
+
+class Deadline(object):
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT):
+        self.expires_at = time.time() + timeout
+
+    def remaining(self):
+        return max(0, self.expires_at - time.time())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def sleep(self, delay):
+        time.sleep(min(delay, self.remaining()))
+
+
+def retry(func, retryable_errors, timeout=DEFAULT_TIMEOUT, base=0.5, cap=5, description=None):
+    ''' Calls `func` until it does not fail with one of the
+    `retryable_errors` AWS error codes and returns its result. The last
+    error is raised once the deadline is reached.
+    '''
+    deadline = Deadline(timeout)
+    attempt = 0
+    while True:
+        try:
+            return func()
+        except botocore.exceptions.ClientError as ex:
+            if ex.response['Error']['Code'] not in retryable_errors or deadline.expired():
+                raise ex
+            log.info('Retrying, resource=%s, error=%s ...' % (description, ex.response['Error']['Code']))
+            deadline.sleep(utils.backoff_delay(attempt, base=base, cap=cap))
+            attempt += 1
+
+
+def wait(waiter, timeout=DEFAULT_TIMEOUT, delay=2, description=None, **kwargs):
+    ''' Waits with a boto waiter, polling every `delay` seconds until the
+    deadline.
+    '''
+    attempts = max(1, int(timeout / delay))
+    try:
+        waiter.wait(WaiterConfig={'Delay': delay, 'MaxAttempts': attempts}, **kwargs)
+    except botocore.exceptions.WaiterError as ex:
+        raise ReadinessTimeout('resource=%s, error=%s' % (description, str(ex)))
+
+
+def wait_for_all(resources, check, timeout=DEFAULT_TIMEOUT, base=0.5, cap=5, description='resources'):
+    ''' Polls all `resources` at once until `check` returns a result other
+    than None for each of them, backing off with jitter between rounds.
+    Returns the results by resource. Raises `ReadinessTimeout` with the
+    pending resources once the deadline is reached.
+    '''
+    deadline = Deadline(timeout)
+    pending = list(resources)
+    results = {}
+    attempt = 0
+    while True:
+        for resource in list(pending):
+            result = check(resource)
+            if result is not None:
+                results[resource] = result
+                pending.remove(resource)
+        if not pending:
+            return results
+        if deadline.expired():
+            raise ReadinessTimeout('%s not ready: %s' % (description, ', '.join(pending)))
+        log.debug('Waiting for %s, pending=%s' % (description, len(pending)))
+        deadline.sleep(utils.backoff_delay(attempt, base=base, cap=cap))
+        attempt += 1
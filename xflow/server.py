@@ -3,11 +3,12 @@ import logging
 import functools, traceback
 
 import jsonschema
-from jsonschema import validate
+from jsonschema.validators import validator_for
 import bottle, sys; bottle._stderr = sys.stdout.write
 from bottle import error, request, Bottle, response, install
 
 import core
+from aws import KINESIS_MAX_BATCH_RECORDS
 
 
 class ApiException(Exception):
@@ -22,12 +23,31 @@ class NotFoundException(ApiException):
     code = 404
 
 
+class ServiceUnavailable(ApiException):
+    code = 503
+    retry_after = 1
+
+
+class GatewayTimeout(ApiException):
+    code = 504
+
+
+class StreamNotReady(ServiceUnavailable):
+    retry_after = 5
+
+
 class JsonSchemaValidator(object):
+    ''' Compiles the schema once so that validating does not rebuild the
+    validator on every call.
+    '''
     def __init__(self, schema):
         self.schema = schema
+        cls = validator_for(schema)
+        cls.check_schema(schema)
+        self.validator = cls(schema)
 
     def validate(self, obj):
-        validate(obj, schema=self.schema)
+        self.validator.validate(obj)
 
 
 
@@ -58,8 +78,84 @@ publish_schema = JsonSchemaValidator({
 })
 
 
+def create_event_validators(engine):
+    ''' Compiles a validator for every event that has a schema configured '''
+    return {event_name: JsonSchemaValidator(schema)
+            for event_name, schema in engine.get_event_schemas().items()}
+
+
+def validate_publish(data, event_validators):
+    ''' Validates a `{"stream": ..., "event": ...}` object and its event
+    against the schema of the stream, if there is one.
+    '''
+    publish_schema.validate(data)
+    event_validator = event_validators.get(data['stream'])
+    if event_validator:
+        event_validator.validate(data['event'])
+
+
+def publish_ndjson(engine, lines, event_validators={}):
+    ''' Publishes newline delimited `{"stream": ..., "event": ...}` objects.
+
+    Every line is validated on its own and valid events are grouped per
+    stream and published with batched writes. Returns one result per
+    non-empty line, in the order of the lines.
+    '''
+    results = {}
+    pending = {}
+
+    def flush(stream):
+        batch = pending.pop(stream, [])
+        if not batch:
+            return
+        if not engine.is_stream_ready(stream):
+            for line_no, _ in batch:
+                results[line_no] = {'line': line_no, 'status': 'error',
+                                    'error': 'StreamNotReady: stream=%s' % stream}
+            return
+        try:
+            entries = engine.publish_batch(stream, [data for _, data in batch])
+        except core.KinesisStreamDoesNotExist as ex:
+            for line_no, _ in batch:
+                results[line_no] = {'line': line_no, 'status': 'error',
+                                    'error': 'KinesisStreamDoesNotExist: %s' % str(ex)}
+            return
+        for (line_no, _), entry in zip(batch, entries):
+            if entry.get('ErrorCode'):
+                results[line_no] = {'line': line_no, 'status': 'error',
+                                    'error': '%s: %s' % (entry['ErrorCode'], entry.get('ErrorMessage'))}
+            else:
+                results[line_no] = {'line': line_no, 'status': 'ok',
+                                    'shard_id': entry.get('ShardId'),
+                                    'sequence_number': entry.get('SequenceNumber')}
+
+    for line_no, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            data = json.loads(line)
+            validate_publish(data, event_validators)
+        except (ValueError, jsonschema.ValidationError) as err:
+            message = err.message if isinstance(err, jsonschema.ValidationError) else str(err)
+            results[line_no] = {'line': line_no, 'status': 'error',
+                                'error': '%s: %s' % (type(err).__name__, message)}
+            continue
+
+        stream = data['stream']
+        pending.setdefault(stream, []).append((line_no, json.dumps(data['event'])))
+        if len(pending[stream]) >= KINESIS_MAX_BATCH_RECORDS:
+            flush(stream)
+
+    for stream in pending.keys():
+        flush(stream)
+
+    return [results[line_no] for line_no in sorted(results)]
+
+
 def create_app(engine):
     app = Bottle()
+    event_validators = create_event_validators(engine)
 
     @app.error()
     @app.error(404)
@@ -69,6 +165,8 @@ def create_app(engine):
         else:
             response.status = error.status_code
         response.set_header('Content-type', 'application/json')
+        if getattr(error.exception, 'retry_after', None):
+            response.set_header('Retry-After', str(error.exception.retry_after))
         resp = {
             'type': type(error.exception).__name__,
             'message': repr(error.exception) if error.exception else '',
@@ -83,22 +181,85 @@ def create_app(engine):
     def ping():
         return {'name': 'xFlow', 'version': '0.1' }
 
+    @app.route('/ready', method=['GET'])
+    def ready():
+        ''' Returns 200 once the resources are configured, 503 while they
+        are being configured or when configuring failed.
+        '''
+        readiness = engine.get_readiness()
+        if not readiness['ready']:
+            response.status = 503
+            response.set_header('Retry-After', str(StreamNotReady.retry_after))
+        return readiness
+
+    @app.route('/stats', method=['GET'])
+    def stats():
+        ''' Returns the Kinesis write counters, e.g. throttles and retries '''
+        stats = {'kinesis': engine.kinesis.get_stats()}
+        if engine.pipeline:
+            stats['queued'] = engine.pipeline.qsize()
+        return stats
+
     @app.route('/publish', method=['POST'])
     def publish():
         data = json.loads(request.body.read())
         try:
-            publish_schema.validate(data)
+            validate_publish(data, event_validators)
         except jsonschema.ValidationError as err:
             raise BadRequest(err)
 
         stream = data['stream']
         event = json.dumps(data['event'])
+        if not engine.is_stream_ready(stream):
+            raise StreamNotReady('Stream is not configured yet, stream=%s' % stream)
+        if engine.pipeline:
+            return publish_async(stream, event)
         try:
             engine.publish(stream, event)
         except core.KinesisStreamDoesNotExist as ex:
             raise NotFoundException(str(ex))
+        if engine.producer:
+            # Buffered events are written later, failures are only logged
+            response.status = 202
         return {}
 
+    def publish_async(stream, event):
+        ''' Queues the event and returns 202 straight away, or waits until
+        Kinesis acknowledged it when the request has `?wait=true`.
+        '''
+        try:
+            pending = engine.submit(stream, event)
+        except core.QueueFull as ex:
+            raise ServiceUnavailable('Publish queue is full, %s' % str(ex))
+
+        if request.query.get('wait') not in ('1', 'true'):
+            response.status = 202
+            return {}
+
+        if not pending.wait(engine.ack_timeout):
+            raise GatewayTimeout('Publish not acknowledged, stream=%s' % stream)
+        if isinstance(pending.error, core.KinesisStreamDoesNotExist):
+            raise NotFoundException(str(pending.error))
+        if pending.error:
+            raise ServiceUnavailable('Publish failed, stream=%s, error=%s' % (stream, pending.error))
+        return {
+            'shard_id': pending.result.get('ShardId'),
+            'sequence_number': pending.result.get('SequenceNumber')
+        }
+
+    @app.route('/publish/batch', method=['POST'])
+    def publish_batch():
+        ''' Publishes a NDJSON body with one `{"stream": ..., "event": ...}`
+        object per line and reports the result of every line.
+        '''
+        results = publish_ndjson(engine, request.body, event_validators)
+        failed = len([r for r in results if r['status'] != 'ok'])
+        return {
+            'published': len(results) - failed,
+            'failed': failed,
+            'results': results
+        }
+
     @app.route('/track/workflows/<workflow_id>/executions/<execution_id>', method=['GET'])
     def track(workflow_id, execution_id):
         try:
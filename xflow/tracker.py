@@ -2,14 +2,62 @@ import os
 import inspect
 import time
 import json
+import hashlib
+import collections
 import boto3
 import botocore
-import base64
 from datetime import datetime
 
+import envelope
+
 
 TRACKER_CONFIG = "tracker.cfg"
 
+# Limits of a single PutLogEvents call
+LOG_EVENTS_MAX_COUNT = 10000
+LOG_EVENTS_MAX_BYTES = 1048576
+LOG_EVENT_OVERHEAD_BYTES = 26
+
+LOG_STREAM_CACHE_SIZE = 10000
+
+# Layouts of the log streams of a workflow: a stream per execution, or a
+# fixed number of streams that executions are hashed into
+LAYOUT_EXECUTION = "execution"
+LAYOUT_BUCKETED = "bucketed"
+DEFAULT_LOG_BUCKETS = 64
+
+# State that is kept across the invocations of a warm container
+_config = None
+_logs = None
+_log_streams = None
+
+
+class LogStreamCache(object):
+    ''' The log streams known to exist with the sequence token of their next
+    write, evicting the least recently used ones beyond `max_size`.
+    '''
+
+    def __init__(self, max_size=LOG_STREAM_CACHE_SIZE):
+        self.max_size = max_size
+        self.tokens = collections.OrderedDict()
+
+    def __contains__(self, log_stream):
+        return log_stream in self.tokens
+
+    def get(self, log_stream):
+        token = self.tokens.pop(log_stream, None)
+        self.tokens[log_stream] = token
+        return token
+
+    def put(self, log_stream, token):
+        self.tokens.pop(log_stream, None)
+        self.tokens[log_stream] = token
+        while len(self.tokens) > self.max_size:
+            self.tokens.popitem(last=False)
+
+    def remove(self, log_stream):
+        self.tokens.pop(log_stream, None)
+
 
 def get_config():
     ''' Config file that contains the `workflow_id` and the `log_group_name`.
@@ -18,11 +66,28 @@ def get_config():
         "workflow_id": <WORKFLOW_ID>,
         "log_group_name": <LOG_GROUP_NAME>
     }
+    It is read once per container.
     '''
-    with open(TRACKER_CONFIG) as f:
-        contents = f.read()
-    config = json.loads(contents)
-    return config
+    global _config
+    if _config is None:
+        with open(TRACKER_CONFIG) as f:
+            contents = f.read()
+        _config = json.loads(contents)
+    return _config
+
+
+def get_logs_client():
+    global _logs
+    if _logs is None:
+        _logs = boto3.client('logs')
+    return _logs
+
+
+def get_log_streams():
+    global _log_streams
+    if _log_streams is None:
+        _log_streams = LogStreamCache()
+    return _log_streams
 
 
 def get_workflow_id(config):
@@ -33,10 +98,35 @@ def get_log_group_name(config):
     return config['log_group_name']
 
 
+def get_layout(config):
+    return config.get('layout', LAYOUT_EXECUTION)
+
+
+def get_log_buckets(config):
+    return config.get('buckets', DEFAULT_LOG_BUCKETS)
+
+
 def generate_log_stream_name(log_group_name, execution_id):
     return "%s/%s" % (log_group_name, execution_id)
 
 
+def generate_bucket_log_stream_name(log_group_name, execution_id, buckets):
+    ''' Returns the name of the bucket stream an execution is logged to '''
+    digest = hashlib.md5(unicode(execution_id).encode('utf-8')).hexdigest()
+    return "%s/bucket-%s" % (log_group_name, int(digest, 16) % buckets)
+
+
+def get_log_stream_name(config, execution_id):
+    ''' Returns the name of the stream the events of an execution are
+    logged to in the layout of the config. Events in bucket streams are
+    told apart by their `execution_id`.
+    '''
+    log_group_name = get_log_group_name(config)
+    if get_layout(config) == LAYOUT_BUCKETED:
+        return generate_bucket_log_stream_name(log_group_name, execution_id, get_log_buckets(config))
+    return generate_log_stream_name(log_group_name, execution_id)
+
+
 def logkv(message, **kwargs):
     kwargs["message"] = message
     now = datetime.now().strftime("%Y-%m-%dT%H.%M.%SZ")
@@ -65,49 +155,123 @@ def describe_stream(logs, log_group, log_stream):
     return stream['logStreams'][0]
 
 
-def log_to_stream(logs, log_group, log_stream, token, payload):
-    if token:
-        logs.put_log_events(logGroupName=log_group,
-                            logStreamName=log_stream,
-                            logEvents=[{
-                                "timestamp": int(round(time.time() * 1000)),
-                                "message": payload
-                            }],
-                            sequenceToken=token)
-    else:
-        logs.put_log_events(logGroupName=log_group,
-                            logStreamName=log_stream,
-                            logEvents=[{
-                                "timestamp": int(round(time.time() * 1000)),
-                                "message": payload
-                            }])
-    logkv("Logged to stream", log_group=log_group, log_stream=log_stream, payload=payload)
-
-
-def try_log_to_stream(logs, log_group, log_stream, payload):
+def get_record_timestamp(record):
+    ''' Returns the time in milliseconds at which a record arrived in its
+    stream, or the current time if the record does not have it.
+    '''
+    arrival = (record.get('kinesis') or {}).get('approximateArrivalTimestamp')
+    if arrival is None:
+        return int(round(time.time() * 1000))
+    return int(round(arrival * 1000))
+
+
+def group_by_execution(event, workflow_id):
+    ''' Decodes the records of a Kinesis batch and groups their payloads
+    into log events by `execution_id`. Returns the log events of every
+    execution, the number of payloads and the number of payloads that could
+    not be read.
+    '''
+    executions = {}
+    num_payloads = 0
+    error_count = 0
+    for record in event['Records']:
+        event_name = record['eventSourceARN'].split("/")[1]
+        timestamp = get_record_timestamp(record)
+
+        # A record can be compressed and hold many aggregated payloads
+        for payload in envelope.decode_record(record):
+            logkv("Decoded payload", payload=payload)
+            num_payloads += 1
+
+            # Handle all sorts of error by logging them
+            # So that the tracker keeps moving forward for events in the stream
+            try:
+                # Extract execution_id. If there is no execution_id, skip it
+                payload = json.loads(payload)
+                execution_id = payload.get('execution_id')
+                if not execution_id:
+                    logkv("No execution_id found", workflow_id=workflow_id)
+                    continue
+
+                # Add event name so it can be logged for tracking
+                payload["event_name"] = event_name
+                executions.setdefault(execution_id, []).append({
+                    "timestamp": timestamp,
+                    "message": json.dumps(payload)
+                })
+            except Exception as ex:
+                logkv("Error on processing record", error=str(ex), record=payload)
+                error_count += 1
+
+    return executions, num_payloads, error_count
+
+
+def batch_log_events(log_events):
+    ''' Splits log events into batches within the limits of a single
+    `put_log_events` call.
+    '''
+    batch, batch_bytes = [], 0
+    for log_event in log_events:
+        size = len(log_event['message']) + LOG_EVENT_OVERHEAD_BYTES
+        if batch and (len(batch) >= LOG_EVENTS_MAX_COUNT or batch_bytes + size > LOG_EVENTS_MAX_BYTES):
+            yield batch
+            batch, batch_bytes = [], 0
+        batch.append(log_event)
+        batch_bytes += size
+    if batch:
+        yield batch
+
+
+def log_to_stream(logs, log_group, log_stream, token, log_events):
+    ''' Puts log events to a stream and returns the sequence token of the
+    next put.
+    '''
+    kwargs = {"sequenceToken": token} if token else {}
+    response = logs.put_log_events(logGroupName=log_group,
+                                   logStreamName=log_stream,
+                                   logEvents=log_events,
+                                   **kwargs)
+    logkv("Logged to stream", log_group=log_group, log_stream=log_stream, num_events=len(log_events))
+    return response.get('nextSequenceToken')
+
+
+def try_log_to_stream(logs, log_streams, log_group, log_stream, log_events):
+    ''' Logs the events of an execution, sorted by timestamp, with as few
+    calls as the limits of `put_log_events` allow. Returns True if all of
+    them were logged.
+
+    The sequence token comes from `log_streams` and is only looked up again
+    when it turns out to be invalid, e.g. after another tracker wrote to the
+    stream.
+    '''
     total_retries = 10
-    retry_count = 0
-    last_ex = None
-    logged = False
-    while not logged and retry_count <= total_retries:
-        s = describe_stream(logs, log_group, log_stream)
-        token = s.get('uploadSequenceToken')
-        try:
-            log_to_stream(logs, log_group, log_stream, token, payload)
-            logged = True
-        except botocore.exceptions.ClientError as ex:
-            last_ex = ex
-            if ex.response['Error']['Code'] == ["InvalidSequenceTokenException", "DataAlreadyAcceptedException"]:
-                retry_count += 1
-                time.sleep(3)
-                continue
-            else:
+    log_events = sorted(log_events, key=lambda e: e['timestamp'])
+    token = log_streams.get(log_stream)
+    for batch in batch_log_events(log_events):
+        retry_count = 0
+        while True:
+            try:
+                token = log_to_stream(logs, log_group, log_stream, token, batch)
                 break
-
-    if not logged:
-        logkv("ERROR Logging to stream",
-              log_group=log_group,
-              log_stream=log_stream, payload=payload, error=str(last_ex))
+            except botocore.exceptions.ClientError as ex:
+                code = ex.response['Error']['Code']
+                if code in ["InvalidSequenceTokenException", "DataAlreadyAcceptedException"] \
+                   and retry_count < total_retries:
+                    # Continue from the token the stream expects, or else its
+                    # current one
+                    token = ex.response.get('expectedSequenceToken') or \
+                            describe_stream(logs, log_group, log_stream).get('uploadSequenceToken')
+                    if code == "DataAlreadyAcceptedException":
+                        break
+                    retry_count += 1
+                    continue
+                logkv("ERROR Logging to stream",
+                      log_group=log_group,
+                      log_stream=log_stream, num_events=len(batch), error=str(ex))
+                log_streams.remove(log_stream)
+                return False
+    log_streams.put(log_stream, token)
+    return True
 
 
 def log(event, context):
@@ -119,48 +283,30 @@ def log(event, context):
     log_group = get_log_group_name(config)
     logkv("Successfully read config", workflow_id=workflow_id, log_group=log_group)
 
-    error_count = 0
     logkv("Executing tracker")
-    logs = boto3.client('logs')
+    logs = get_logs_client()
+    log_streams = get_log_streams()
 
     logkv("Received event", event=json.dumps(event, indent=2))
-    for record in event['Records']:
-        event_name = record['eventSourceARN'].split("/")[1]
-        payload = base64.b64decode(record['kinesis']['data'])
-        logkv("Decoded payload", payload=payload)
-
-        # Handle all sorts of error by logging them
-        # So that the tracker keeps moving forward for events in the stream
+    executions, num_payloads, error_count = group_by_execution(event, workflow_id)
+
+    # The events of every stream, an execution's or a bucket's, are logged
+    # with a single write
+    streams = {}
+    for execution_id, log_events in executions.items():
+        streams.setdefault(get_log_stream_name(config, execution_id), []).extend(log_events)
+    for log_stream, log_events in streams.items():
         try:
-            # Extract execution_id. If there is no execution_id, return
-            payload = json.loads(payload)
-            execution_id = payload.get('execution_id')
-            if not execution_id:
-                logkv("No execution_id found", workflow_id=workflow_id)
-                continue
-
-            # Add event name so it can be logged for tracking
-            payload["event_name"] = event_name
-
-            # Get or create log stream from execution_id
-            log_stream = generate_log_stream_name(log_group, execution_id)
-            ok = create_log_stream(logs, log_group, log_stream)
-            if not ok:
-                continue
-
-            # Try logging to the stream
-            try_log_to_stream(logs, log_group, log_stream, json.dumps(payload))
-
+            ok = log_stream in log_streams or create_log_stream(logs, log_group, log_stream)
+            ok = ok and try_log_to_stream(logs, log_streams, log_group, log_stream, log_events)
         except Exception as ex:
-            logkv("Error on processing record", error=str(ex), record=payload)
-            error_count += 1
+            logkv("Error on logging to stream", error=str(ex), log_stream=log_stream)
+            ok = False
+        if not ok:
+            error_count += len(log_events)
 
-    return 'Processed %s records with %s failures.' % (len(event['Records']), error_count)
+    return 'Processed %s records of %s executions with %s failures.' % (num_payloads, len(executions), error_count)
 
 
-def generate_code(destination):
-    filepath = os.path.abspath(inspect.stack()[0][1])
-    with open(filepath) as f:
-        contents = f.read()
-    with open(destination, 'w') as f:
-        f.write(contents)
+def source_file():
+    return os.path.abspath(inspect.stack()[0][1])
@@ -1,11 +1,13 @@
+import io
 import os
 import os.path
 import json
+import random
 import yaml
 import inspect
 from urlparse import urlparse
 import zipfile
-from zipfile import ZipFile
+from zipfile import ZipFile, ZipInfo
 
 
 def is_valid_json(contents):
@@ -31,18 +33,33 @@ def write_file(filename, contents):
         f.write(contents)
 
 
-def zip_file(filename, otherfiles=None):
-    def get_arcname(fname):
-        splitted = fname.rsplit('/', 1)
-        return splitted[1] if len(splitted) > 1 else splitted[0]
+# Archives get fixed timestamps and permissions so that the same files
+# always produce the same bytes
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+ZIP_FILE_MODE = 0644 << 16
 
-    zip_filename = filename + '.zip'
-    with ZipFile(zip_filename, 'w', zipfile.ZIP_DEFLATED) as zf:
-        zf.write(filename, get_arcname(filename))
-        otherfiles = otherfiles or []
-        for of in otherfiles:
-            zf.write(of, get_arcname(of))
-    return zip_filename
+
+def read_files(filenames):
+    ''' Returns the (name, contents) of local files '''
+    files = []
+    for filename in filenames:
+        with open(filename, 'rb') as f:
+            files.append((os.path.basename(filename), f.read()))
+    return files
+
+
+def zip_files(files):
+    ''' Returns a deterministic zip archive of (name, contents) files,
+    built in memory.
+    '''
+    buf = io.BytesIO()
+    with ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for name, contents in sorted(files):
+            info = ZipInfo(name, date_time=ZIP_DATE_TIME)
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.external_attr = ZIP_FILE_MODE
+            zf.writestr(info, contents)
+    return buf.getvalue()
 
 
 def is_local_file(path):
@@ -96,5 +113,17 @@ def get_name_from_arn(arn):
     return arn.rsplit(":", 1)[1]
 
 
+def get_unqualified_arn(arn):
+    ''' Returns the ARN of a function without its version or alias '''
+    return ":".join(arn.split(":")[:7])
+
+
 def format_datetime(dt):
     return dt.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def backoff_delay(attempt, base=0.1, cap=5):
+    ''' Exponential backoff with full jitter: a random delay between zero
+    and `base * 2 ** attempt` seconds, capped at `cap` seconds.
+    '''
+    return random.uniform(0, min(cap, base * 2 ** attempt))